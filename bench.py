@@ -0,0 +1,458 @@
+"""无界面的性能基准：分词、高亮、单词补全、打开、保存、缩放背景
+
+    QT_QPA_PLATFORM=offscreen python bench.py run --out new.json
+    python bench.py compare old.json new.json
+
+每个用例在单独的子进程里跑，峰值内存（ru_maxrss）才是这个用例自己的；
+Windows 上没有 resource 模块，不记峰值内存。
+结果写成 JSON；compare 按指标方向比较两次结果，变差超过阈值的用例
+会被列出来，并以退出码 1 结束。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+HIGHLIGHT_SIZES = [1000, 10000, 100000]
+FILE_SIZES_MB = [1, 10, 50]
+RESIZE_STEPS = 50
+# 数值越大越好的指标，其余的都是越小越好
+HIGHER_IS_BETTER = {'lines_per_sec', 'cached_lines_per_sec', 'cache_hit_rate', 'parallel_lines_per_sec', 'mb_per_sec'}
+
+CORPUS_LINES = {
+    'Python': [
+        'class Widget{i}(Base):',
+        '    """docstring {i}',
+        '    spans lines"""',
+        '    @property',
+        '    def value_{i}(self, x=1.5):',
+        "        # comment {i}",
+        "        return self.call({i}, 'text', \"more\") if x else None",
+        '',
+    ],
+    'Java': [
+        'public class Item{i} extends Base {{',
+        '    /* block comment {i}',
+        '       continues */',
+        '    private static final int VALUE = {i};',
+        '    public String name() {{ return "item" + \'x\'; }} // trailing',
+        '}}',
+    ],
+    'JavaScript': [
+        'function handler{i}(event) {{',
+        '    /* note {i}',
+        '       more */',
+        "    const label = `tpl ${{event}}` + 'a' + \"b\";",
+        '    return label.length > {i} ? null : undefined; // check',
+        '}}',
+    ],
+    'C++': [
+        '#include <vector>',
+        'template <typename T> struct Node{i} {{',
+        '    /* comment {i}',
+        '       spans */',
+        '    static constexpr int size = {i}; // inline',
+        '    const char *name = "node";',
+        '}};',
+    ],
+    'HTML': [
+        '<div class="row" id="r{i}">',
+        '  <!-- comment {i}',
+        '       spans -->',
+        '  <a href="/page/{i}" title="link">text {i}</a><br/>',
+        '</div>',
+    ],
+    'Markdown': [
+        '# Heading {i}',
+        'Some **bold** and *italic* text with `code` and [link](http://x/{i}).',
+        '    indented code {i}',
+        '',
+        '- item __strong__ _em_',
+    ],
+}
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 上单位是字节，Linux 上是 KB
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def make_corpus(language, lines):
+    template = CORPUS_LINES[language]
+    return '\n'.join(
+        template[number % len(template)].format(i=number // len(template)) for number in range(lines)
+    ) + '\n'
+
+
+app = None
+
+
+def application():
+    # 要一直持有 QApplication 的引用，否则会被回收
+    global app
+    if app is None:
+        from PyQt5.QtWidgets import QApplication
+        app = QApplication(sys.argv[:1])
+    return app
+
+
+def bench_tokenize(language_name, lines):
+    """纯 Python 的分词核心，不创建 QApplication：不带缓存时整篇分词的吞吐量和
+    每行耗时分布，带一个新的行缓存时第二遍（比如重新挂上高亮器）的吞吐量和命中率，
+    以及在进程池里并行分词（包括接上各段的入口状态）的吞吐量，随核数变化"""
+    from languages import registry
+    from tokenizer import Tokenizer, TokenCache
+    from parallel_highlight import ParallelTokenizer
+
+    language = registry.get(language_name)
+    tokenizer = Tokenizer(language, cache=None)
+    corpus = make_corpus(language_name, lines).split('\n')
+    start = time.perf_counter()
+    for _ in tokenizer.tokenize_lines(corpus):
+        pass
+    seconds = time.perf_counter() - start
+    durations = []
+    state = 0
+    for text in corpus:
+        line_start = time.perf_counter_ns()
+        tokens = list(tokenizer.tokenize(text, state))
+        durations.append(time.perf_counter_ns() - line_start)
+        state = tokens[-1][3] if tokens else 0
+    cache = TokenCache()
+    cached = Tokenizer(language, cache)
+    for _ in cached.tokenize_lines(corpus):
+        pass
+    start = time.perf_counter()
+    for _ in cached.tokenize_lines(corpus):
+        pass
+    cached_seconds = time.perf_counter() - start
+    text = '\n'.join(corpus)
+    # 第一遍要启动进程池，只算第二遍
+    for _ in range(2):
+        parallel = ParallelTokenizer(language.name, [text])
+        start = time.perf_counter()
+        parallel.start()
+        while parallel.results.get() is not None:
+            pass
+        parallel_seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'lines_per_sec': lines / seconds,
+        'line_p50_us': percentile(durations, 0.50) / 1000,
+        'line_p99_us': percentile(durations, 0.99) / 1000,
+        'cached_lines_per_sec': lines / cached_seconds,
+        'cache_hit_rate': cache.stats()['hit_rate'],
+        'parallel_lines_per_sec': lines / parallel_seconds,
+    }
+
+
+def bench_complete(language_name, lines):
+    """单词索引：整篇统计的耗时，补全查询和单行改动的增量更新的耗时分布，不创建 QApplication"""
+    import random
+    from word_index import WordIndex, count_words
+
+    corpus = make_corpus(language_name, lines)
+    start = time.perf_counter()
+    index = WordIndex()
+    index.update(count_words(corpus))
+    seconds = time.perf_counter() - start
+    rng = random.Random(0)
+    words = index.words
+    queries = []
+    for word in rng.sample(words, min(1000, len(words))):
+        for length in (1, 2, 3):
+            query_start = time.perf_counter_ns()
+            index.complete(word[:length])
+            queries.append(time.perf_counter_ns() - query_start)
+    edits = []
+    for line in rng.sample(corpus.split('\n'), min(1000, lines)):
+        edit_start = time.perf_counter_ns()
+        index.edit(line, line + 'x')
+        index.edit(line + 'x', line)
+        edits.append((time.perf_counter_ns() - edit_start) // 2)
+    return {
+        'seconds': seconds,
+        'lines_per_sec': lines / seconds,
+        'query_p50_us': percentile(queries, 0.50) / 1000,
+        'query_p99_us': percentile(queries, 0.99) / 1000,
+        'edit_p99_us': percentile(edits, 0.99) / 1000,
+    }
+
+
+def bench_highlight(language_name, lines):
+    """整篇高亮的吞吐量，以及每个块的 highlightBlock 耗时分布"""
+    application()
+    from PyQt5.QtWidgets import QPlainTextEdit
+    from languages import registry
+    from main import Highlighter
+
+    durations = []
+
+    class TimedHighlighter(Highlighter):
+        def highlightBlock(self, text):
+            start = time.perf_counter_ns()
+            super().highlightBlock(text)
+            durations.append(time.perf_counter_ns() - start)
+
+    edit = QPlainTextEdit()
+    edit.setPlainText(make_corpus(language_name, lines))
+    app.processEvents()
+    language = registry.get(language_name)
+    start = time.perf_counter()
+    highlighter = Highlighter(edit.document(), language)
+    highlighter.rehighlight()
+    seconds = time.perf_counter() - start
+    highlighter.setDocument(None)
+    timed = TimedHighlighter(edit.document(), language)
+    timed.rehighlight()
+    return {
+        'seconds': seconds,
+        'lines_per_sec': lines / seconds,
+        'block_p50_us': percentile(durations, 0.50) / 1000,
+        'block_p99_us': percentile(durations, 0.99) / 1000,
+    }
+
+
+def main_window():
+    application()
+    from main import MainGui
+    window = MainGui()
+    window.resize(1280, 800)
+    window.show()
+    return window
+
+
+def wait_until(condition):
+    application()
+    while not condition():
+        app.processEvents()
+        time.sleep(0.0005)
+
+
+def write_corpus_file(directory, megabytes):
+    path = os.path.join(directory, f'corpus_{megabytes}mb.py')
+    block = make_corpus('Python', 8000)
+    with open(path, 'w', encoding='utf-8') as file:
+        for _ in range(max(1, megabytes * 1024 * 1024 // len(block))):
+            file.write(block)
+    return path
+
+
+def bench_open(megabytes):
+    """MainGui 打开文件：第一块文本出现的延迟和全部读完的时间"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_corpus_file(directory, megabytes)
+        size = os.path.getsize(path)
+        window = main_window()
+        document = window.text_edit.document()
+        start = time.perf_counter()
+        window.load_file(path)
+        wait_until(lambda: document.characterCount() > 1 or not window.reader)
+        first_chunk = time.perf_counter() - start
+        wait_until(lambda: not window.reader)
+        seconds = time.perf_counter() - start
+        window.journal.discard()
+        return {
+            'first_chunk_ms': first_chunk * 1000,
+            'seconds': seconds,
+            'mb_per_sec': size / 1024 / 1024 / seconds,
+        }
+
+
+def bench_save(megabytes):
+    """MainGui.save：界面线程被占用的时间和后台写完的总时间"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_corpus_file(directory, megabytes)
+        size = os.path.getsize(path)
+        window = main_window()
+        window.load_file(path)
+        wait_until(lambda: not window.reader)
+        window.text_edit.textCursor().insertText('# edited\n')
+        start = time.perf_counter()
+        window.save()
+        blocked = time.perf_counter() - start
+        wait_until(lambda: not window.saver)
+        seconds = time.perf_counter() - start
+        window.journal.discard()
+        return {
+            'blocked_ms': blocked * 1000,
+            'seconds': seconds,
+            'mb_per_sec': size / 1024 / 1024 / seconds,
+        }
+
+
+def bench_resize():
+    """每次 resize 事件的耗时（快速缩放预览），以及停下来后平滑缩放一次的耗时"""
+    application()
+    window = main_window()
+    app.processEvents()
+    if window.background_pixmap is None:
+        # 没有背景图时缩放什么也不做，测出来的数没有意义
+        raise RuntimeError('background image not loaded')
+    steps = []
+    for step in range(RESIZE_STEPS):
+        start = time.perf_counter()
+        window.resize(900 + step * 7, 600 + step * 5)
+        app.processEvents()
+        steps.append(time.perf_counter() - start)
+    smooth = []
+    for step in range(5):
+        window.background_cache.clear()
+        window.resize(1000 + step, 700 + step)
+        start = time.perf_counter()
+        window.update_background()
+        smooth.append(time.perf_counter() - start)
+    return {
+        'resize_p50_ms': percentile(steps, 0.50) * 1000,
+        'resize_p99_ms': percentile(steps, 0.99) * 1000,
+        'smooth_ms': statistics.median(smooth) * 1000,
+    }
+
+
+def run_case(kind, argument):
+    if kind == 'tokenize':
+        language, lines = argument.rsplit(':', 1)
+        metrics = bench_tokenize(language, int(lines))
+    elif kind == 'highlight':
+        language, lines = argument.rsplit(':', 1)
+        metrics = bench_highlight(language, int(lines))
+    elif kind == 'complete':
+        language, lines = argument.rsplit(':', 1)
+        metrics = bench_complete(language, int(lines))
+    elif kind == 'open':
+        metrics = bench_open(int(argument))
+    elif kind == 'save':
+        metrics = bench_save(int(argument))
+    else:
+        metrics = bench_resize()
+    peak_rss = peak_rss_kb()
+    if peak_rss is not None:
+        metrics['peak_rss_kb'] = peak_rss
+    return metrics
+
+
+def cases(arguments):
+    for language in arguments.languages:
+        for lines in arguments.lines:
+            yield f'tokenize/{language}/{lines}', 'tokenize', f'{language}:{lines}'
+            yield f'highlight/{language}/{lines}', 'highlight', f'{language}:{lines}'
+            yield f'complete/{language}/{lines}', 'complete', f'{language}:{lines}'
+    for megabytes in arguments.file_sizes:
+        yield f'open/{megabytes}MB', 'open', str(megabytes)
+        yield f'save/{megabytes}MB', 'save', str(megabytes)
+    yield 'resize', 'resize', ''
+
+
+def run(arguments):
+    from PyQt5.QtCore import QT_VERSION_STR
+    results = []
+    for name, kind, argument in cases(arguments):
+        # 每个用例一个子进程，避免互相影响峰值内存和缓存
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'case', kind, argument],
+            capture_output=True, text=True, env=dict(os.environ, HOME=arguments.home)
+        )
+        if completed.returncode != 0:
+            print(f'{name}: failed\n{completed.stderr}', file=sys.stderr)
+            continue
+        metrics = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append({'name': name, 'metrics': metrics})
+        print(name, ' '.join(f'{key}={value:.4g}' for key, value in metrics.items()), file=sys.stderr)
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if arguments.out:
+        with open(arguments.out, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare(arguments):
+    """逐项比较两次结果，变差超过 threshold 的算回归"""
+    with open(arguments.old, encoding='utf-8') as file:
+        old = {result['name']: result['metrics'] for result in json.load(file)['results']}
+    with open(arguments.new, encoding='utf-8') as file:
+        new = {result['name']: result['metrics'] for result in json.load(file)['results']}
+    regressions = 0
+    for name in new:
+        if name not in old:
+            continue
+        for key, value in new[name].items():
+            before = old[name].get(key)
+            if not before:
+                continue
+            change = (value - before) / before
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > arguments.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            elif worse < -arguments.threshold:
+                flag = '  improved'
+            print(f'{name:32} {key:16} {before:12.4g} -> {value:12.4g} {change:+8.1%}{flag}')
+    print(f'{regressions} regression(s) over {arguments.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks and write JSON')
+    run_parser.add_argument('--out', help='output file (default: stdout)')
+    run_parser.add_argument('--languages', nargs='+', default=list(CORPUS_LINES))
+    run_parser.add_argument('--lines', nargs='+', type=int, default=HIGHLIGHT_SIZES,
+                            help='corpus sizes in lines, e.g. 1000 10000 1000000')
+    run_parser.add_argument('--file-sizes', nargs='+', type=int, default=FILE_SIZES_MB,
+                            help='open/save file sizes in MB')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='relative change counted as a regression (default 0.10)')
+    case_parser = commands.add_parser('case')
+    case_parser.add_argument('kind', choices=['tokenize', 'highlight', 'complete', 'open', 'save', 'resize'])
+    case_parser.add_argument('argument', nargs='?', default='')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'case':
+        print(json.dumps(run_case(arguments.kind, arguments.argument)))
+    elif arguments.command == 'run':
+        # 用临时的 HOME，不读写真实的恢复日志
+        with tempfile.TemporaryDirectory() as home:
+            arguments.home = home
+            run(arguments)
+    else:
+        sys.exit(compare(arguments))
@@ -0,0 +1,199 @@
+"""与界面无关的文件读写工具，main.py 和 tk_prototype.py 共用"""
+import codecs
+import hashlib
+import io
+import mmap
+import os
+import queue
+import stat
+import threading
+
+import instrument
+
+# 后台读取时每块的字节数
+CHUNK_SIZE = 256 * 1024
+# 后台保存时每次编码、写入的最大字符数
+SAVE_BLOCK_SIZE = 1024 * 1024
+# 计算文件哈希时每次读的字节数
+HASH_BLOCK_SIZE = 1024 * 1024
+# 临时文件打开方式：O_BINARY 让 Windows 的 C 运行库不再转换换行
+TEMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_NOINHERIT', 0)
+
+
+def create_temp(directory, name):
+    """在 directory 里新建 .name.xxx.tmp，返回 (fd, 路径)
+
+    和 tempfile.mkstemp 不同，权限按 0o666 申请，由内核套用 umask，和直接新建
+    文件一样；读 umask 只能先改掉它，会影响别的线程。
+    """
+    while True:
+        path = os.path.join(directory, f'.{name}.{os.urandom(6).hex()}.tmp')
+        try:
+            return os.open(path, TEMP_FLAGS, 0o666), path
+        except FileExistsError:
+            continue
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(path, block_size=HASH_BLOCK_SIZE):
+    """按块读出整个文件算哈希，不会把整个文件读进内存"""
+    digest = new_digest()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def stat_state(info):
+    return info.st_mtime_ns, info.st_size
+
+
+def disk_state(path, digest=None):
+    """磁盘上文件的 (修改时间, 大小, 哈希)，读不到时返回 None；哈希可以是 None（不知道）"""
+    try:
+        return stat_state(os.stat(path)) + (digest,)
+    except OSError:
+        return None
+
+
+class ChunkReader(threading.Thread):
+    """在工作线程里用 mmap 分块读取并解码文件
+
+    解码后的文本块放进有界队列 chunks，界面线程定时取出追加到文档里；
+    队列满了读取线程就等着，所以内存里最多只多出几块文本。
+    读完（或出错、取消）之后会放入一个 None 作为结束标记。读的同时顺便
+    算出文件的哈希，读完后 disk_state 是读到的那份文件的 (修改时间, 大小, 哈希)。
+    """
+
+    def __init__(self, path, encoding='utf-8', chunk_size=CHUNK_SIZE, max_pending=4):
+        super().__init__(daemon=True)
+        self.path = path
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+        self.error = None
+        self.disk_state = None
+        self.chunks = queue.Queue(max_pending)
+        self.cancelled = threading.Event()
+
+    def run(self):
+        with instrument.span('open.read', 'io', {'bytes': self.size}):
+            self.read()
+
+    def read(self):
+        try:
+            # 和 open(..., "r") 一样做换行符统一
+            decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder(self.encoding)(), translate=True
+            )
+            digest = new_digest()
+            with open(self.path, 'rb') as file:
+                state = stat_state(os.fstat(file.fileno()))
+                if self.size:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        for offset in range(0, len(data), self.chunk_size):
+                            if self.cancelled.is_set():
+                                return
+                            block = data[offset:offset + self.chunk_size]
+                            digest.update(block)
+                            text = decoder.decode(block)
+                            self.bytes_read = min(offset + self.chunk_size, len(data))
+                            if text and not self.put(text):
+                                return
+                text = decoder.decode(b'', final=True)
+                if text:
+                    self.put(text)
+            self.disk_state = state + (digest.digest(),)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.put(None)
+
+    def put(self, text):
+        """队列满时等待；取消后放弃，返回是否放进去了"""
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(text, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self):
+        """已读取的百分比"""
+        if not self.size:
+            return 100
+        return self.bytes_read * 100 // self.size
+
+
+class AtomicSaver(threading.Thread):
+    """在工作线程里把文本块写进同目录的临时文件，fsync 之后改名覆盖目标文件
+
+    写到一半崩溃或者磁盘满了，原文件都不受影响。chunks 必须是一份不会
+    再变的快照（比如 PieceTable.snapshot() 的各段），因为写的同时界面
+    还可以继续编辑。结束后 done 被置位，失败时 error 记录异常，成功时
+    disk_state 是写好的文件的 (修改时间, 大小, 哈希)。
+    """
+
+    def __init__(self, path, chunks, encoding='utf-8'):
+        # 不设成守护线程：程序退出时也要等保存写完
+        super().__init__()
+        self.path = os.path.realpath(path)
+        self.chunks = chunks
+        self.encoding = encoding
+        self.error = None
+        self.disk_state = None
+        self.done = threading.Event()
+
+    def run(self):
+        with instrument.span('save.write', 'io'):
+            self.write()
+
+    def write(self):
+        temp_path = None
+        try:
+            directory, name = os.path.split(self.path)
+            fd, temp_path = create_temp(directory, name)
+            with open(fd, 'w', encoding=self.encoding) as file:
+                for chunk in self.chunks:
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            # 刚写完还在页缓存里，重读一遍算哈希很便宜
+            digest = file_digest(temp_path)
+            try:
+                os.chmod(temp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+            except FileNotFoundError:
+                # 新文件：创建临时文件时已经按 umask 定好了权限
+                pass
+            os.replace(temp_path, self.path)
+            temp_path = None
+            self.disk_state = disk_state(self.path, digest)
+            fsync_directory(directory)
+        except Exception as e:
+            self.error = e
+        finally:
+            if temp_path:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+            self.done.set()
+
+
+def fsync_directory(directory):
+    """让改名本身也落盘；Windows 上打不开目录，跳过"""
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,165 @@
+"""与界面无关的外部修改检测和增量重新加载
+
+打开、保存时记下文件的 (修改时间, 大小, 哈希)。检查时先只 stat 一次，
+修改时间和大小都没变就认为没变；变了再按块算一遍哈希，只是被 touch
+过、或者被同样的内容覆盖时不算修改。
+
+确认被别的程序改过之后，changed_regions 按行比较旧文本和新文本，只把
+变了的几段交给界面替换进文档：没变的部分的撤销历史、光标和高亮状态都
+留着，不用整篇 setPlainText。
+"""
+import difflib
+from itertools import accumulate
+
+from file_io import disk_state, file_digest
+
+# 比较公共前后缀时每次比较的字符数
+COMPARE_BLOCK = 64 * 1024
+# 两边都不超过这么多行的段才交给 difflib 逐行细分
+SMALL_DIFF_LINES = 200
+# 找锚点时依次试的位置（占这一段的比例）
+ANCHOR_FRACTIONS = (0.5, 0.25, 0.75, 0.375, 0.625, 0.125, 0.875)
+
+
+def check_file(path, known):
+    """返回 (是否被改过, 现在的状态)；known 是上次读写时记下的状态
+
+    文件读不到（比如被删掉了）时不算修改，没有内容可以重新加载；不知道
+    上次的状态时（没保存过的文档）也不算。
+    """
+    state = disk_state(path)
+    if state is None or known is None or state[:2] == known[:2]:
+        return False, known
+    if known[2] is None:
+        # 没有记哈希（比如只读查看的大文件），只能按修改时间和大小算
+        return True, state
+    try:
+        digest = file_digest(path)
+    except OSError:
+        return False, known
+    return digest != known[2], state[:2] + (digest,)
+
+
+def common_prefix(old, new, old_start, old_end, new_start, new_end):
+    """old[old_start:old_end] 和 new[new_start:new_end] 的公共前缀长度：先按块比较，再在第一个不同的块里二分"""
+    limit = min(old_end - old_start, new_end - new_start)
+    length = 0
+    while length + COMPARE_BLOCK <= limit and \
+            old[old_start + length:old_start + length + COMPARE_BLOCK] == \
+            new[new_start + length:new_start + length + COMPARE_BLOCK]:
+        length += COMPARE_BLOCK
+    low, high = length, min(length + COMPARE_BLOCK, limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[old_start + length:old_start + middle] == new[new_start + length:new_start + middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(old, new, old_end, new_end, limit):
+    """old[:old_end] 和 new[:new_end] 的公共后缀长度，不超过 limit"""
+    length = 0
+    while length + COMPARE_BLOCK <= limit and \
+            old[old_end - length - COMPARE_BLOCK:old_end - length] == \
+            new[new_end - length - COMPARE_BLOCK:new_end - length]:
+        length += COMPARE_BLOCK
+    low, high = length, min(length + COMPARE_BLOCK, limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[old_end - middle:old_end - length] == new[new_end - middle:new_end - length]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def split_lines(text):
+    """按 \\n 切成行，每行带着自己的换行符"""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def changed_regions(old, new):
+    """把 old 变成 new 要做的替换 [(开始, 结束, 新文本)]
+
+    位置是 old 里的，按从后往前的顺序排好，界面依次替换时前面的位置不受
+    影响。每段都从行首开始、到行尾（换行符之后）结束。
+
+    先去掉公共的前后缀；中间部分找一行在两边都只出现一次的行，从它那里
+    切成前后两半分别再比较。比较和查找都是字符串的整块操作，改动少时
+    几乎只是扫几遍内存；切到足够小的段才交给 difflib 逐行细分。
+    """
+    regions = []
+    stack = [(0, len(old), 0, len(new))]
+    while stack:
+        old_start, old_end, new_start, new_end = stack.pop()
+        prefix = common_prefix(old, new, old_start, old_end, new_start, new_end)
+        if prefix == old_end - old_start == new_end - new_start:
+            continue
+        # 前缀退到行首，后缀推到行首，中间就都是整行
+        newline = old.rfind('\n', old_start, old_start + prefix)
+        prefix = newline + 1 - old_start if newline != -1 else 0
+        old_start += prefix
+        new_start += prefix
+        suffix = common_suffix(old, new, old_end, new_end, min(old_end - old_start, new_end - new_start))
+        if suffix and old[old_end - suffix - 1:old_end - suffix] not in ('\n', ''):
+            newline = old.find('\n', old_end - suffix, old_end)
+            suffix = old_end - newline - 1 if newline != -1 else 0
+        old_end -= suffix
+        new_end -= suffix
+        if old_start == old_end or new_start == new_end:
+            # 纯插入或者纯删除
+            regions.append((old_start, old_end, new[new_start:new_end]))
+            continue
+        split = find_anchor(old, new, old_start, old_end, new_start, new_end)
+        if split is None:
+            regions.extend(diff_small(old, new, old_start, old_end, new_start, new_end))
+            continue
+        old_split, new_split, length = split
+        # 后一半先压栈，先处理前一半，结果按位置从前往后
+        stack.append((old_split + length, old_end, new_split + length, new_end))
+        stack.append((old_start, old_split, new_start, new_split))
+    regions.reverse()
+    return regions
+
+
+def find_anchor(old, new, old_start, old_end, new_start, new_end):
+    """在两边都只出现一次的一整行，返回 (旧位置, 新位置, 长度)；段很小或者找不到时返回 None"""
+    if old.count('\n', old_start, old_end) < SMALL_DIFF_LINES and \
+            new.count('\n', new_start, new_end) < SMALL_DIFF_LINES:
+        return None
+    # 从中间开始试几处，每处试相邻的两行，尽量对半切开
+    for fraction in ANCHOR_FRACTIONS:
+        line_start = max(old.rfind('\n', old_start, old_start + int((old_end - old_start) * fraction)) + 1,
+                         old_start)
+        for _ in range(2):
+            line_end = old.find('\n', line_start, old_end)
+            if line_end == -1:
+                break
+            key = old[line_start:line_end + 1]
+            # 作为子串在两边都只出现一次，新的那边还得正好在行首
+            if len(key) > 1 and old.count(key, old_start, old_end) == 1 and new.count(key, new_start, new_end) == 1:
+                position = new.find(key, new_start, new_end)
+                if position == new_start or new[position - 1] == '\n':
+                    return line_start, position, len(key)
+            line_start = line_end + 1
+    return None
+
+
+def diff_small(old, new, old_start, old_end, new_start, new_end):
+    """逐行细分一小段；段太大（没找到锚点）时整段替换"""
+    old_lines = split_lines(old[old_start:old_end])
+    new_lines = split_lines(new[new_start:new_end])
+    if max(len(old_lines), len(new_lines)) > SMALL_DIFF_LINES:
+        return [(old_start, old_end, new[new_start:new_end])]
+    old_offsets = list(accumulate(map(len, old_lines), initial=old_start))
+    new_offsets = list(accumulate(map(len, new_lines), initial=new_start))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [(old_offsets[old_first], old_offsets[old_last], new[new_offsets[new_first]:new_offsets[new_last]])
+            for tag, old_first, old_last, new_first, new_last in matcher.get_opcodes() if tag != 'equal']
@@ -0,0 +1,265 @@
+"""与界面无关的在文件夹里查找
+
+协调线程遍历文件夹，把文件分成小组交给进程池并行搜索（正则匹配会占着
+GIL，只有多进程才能随核数扩展）；每个文件用 mmap 打开，开头几 KB 里有
+NUL 字节的当作二进制文件跳过。结果按文件分批放进队列，界面线程定时取出。
+
+SearchCache 按 (路径, 修改时间, 大小) 记住每个文件的结果：同一个查询再搜
+一遍时没变的文件直接用缓存；字面量查询变长（比如边打字边搜）时，上一次
+已经确定不包含较短查询的文件也不用再搜。
+"""
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from folder_scan import IGNORED_NAMES
+
+# 用来判断是不是二进制文件的开头字节数
+SNIFF_SIZE = 8192
+# 每个进程池任务搜索的文件数
+FILES_PER_TASK = 32
+# 每个文件最多报告的匹配行数
+MAX_MATCHES_PER_FILE = 1000
+# 结果里每行文本最多保留的字符数
+MAX_LINE_LENGTH = 300
+# 缓存最近多少个查询的结果
+CACHED_QUERIES = 16
+
+_executor = None
+
+
+def executor():
+    """进程池在第一次用到时创建，之后所有搜索和大文件的并行分词（parallel_highlight）共用"""
+    global _executor
+    if _executor is None:
+        # 界面进程里有 Qt/Tk 的线程，不能直接 fork
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def compile_query(query, regex=False, case_sensitive=True):
+    """查询编译成 bytes 正则，直接在 mmap 上匹配；正则写错时抛出 re.error"""
+    pattern = query.encode('utf-8')
+    if not regex:
+        pattern = re.escape(pattern)
+    flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+    return re.compile(pattern, flags)
+
+
+def search_file(path, expression):
+    """返回 (是否二进制, [(行号, 列, 行文本)])，行号和列都从 0 开始，每行只报告一次"""
+    matches = []
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return False, matches
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if b'\0' in data[:SNIFF_SIZE]:
+                return True, matches
+            line = 0
+            counted = 0
+            line_end = -1
+            for match in expression.finditer(data):
+                start = match.start()
+                if start <= line_end:
+                    continue
+                # mmap 没有 count，切片只复制两次匹配之间的部分，总量是线性的
+                line += data[counted:start].count(b'\n')
+                counted = start
+                line_start = data.rfind(b'\n', 0, start) + 1
+                line_end = data.find(b'\n', start)
+                if line_end == -1:
+                    line_end = len(data)
+                text = data[line_start:min(line_end, line_start + MAX_LINE_LENGTH * 4)]
+                column = len(data[line_start:start].decode('utf-8', 'replace'))
+                matches.append((line, column, text.decode('utf-8', 'replace')[:MAX_LINE_LENGTH].rstrip('\r')))
+                if len(matches) >= MAX_MATCHES_PER_FILE:
+                    break
+    return False, matches
+
+
+def search_files(files, pattern, flags):
+    """进程池里执行：搜索一组 (路径, 修改时间, 大小)，返回 [(路径, 修改时间, 大小, 是否二进制, 匹配)]"""
+    expression = re.compile(pattern, flags)
+    results = []
+    for path, mtime, size in files:
+        try:
+            binary, matches = search_file(path, expression)
+        except (OSError, ValueError):
+            binary, matches = False, []
+        results.append((path, mtime, size, binary, matches))
+    return results
+
+
+def walk(folder, cancelled):
+    """递归列出文件夹里的文件 (路径, 修改时间, 大小)，跳过忽略的目录，不跟随目录的符号链接"""
+    stack = [folder]
+    while stack and not cancelled.is_set():
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in IGNORED_NAMES:
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            info = entry.stat()
+                            yield entry.path, info.st_mtime_ns, info.st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+
+class SearchCache:
+    """按 (路径, 修改时间, 大小) 缓存的搜索结果，多个搜索线程共用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.binaries = {}
+        # (查询, 是否正则, 是否区分大小写) -> {路径: (修改时间, 大小, 匹配)}
+        self.queries = OrderedDict()
+        self.complete = set()
+
+    def results_for(self, key):
+        with self.lock:
+            results = self.queries.get(key)
+            if results is None:
+                results = self.queries[key] = {}
+                if len(self.queries) > CACHED_QUERIES:
+                    old_key, _ = self.queries.popitem(last=False)
+                    self.complete.discard(old_key)
+            else:
+                self.queries.move_to_end(key)
+            return results
+
+    def narrowing(self, key):
+        """字面量查询：找一个已经搜完、且是当前查询子串的旧查询的结果"""
+        query, regex, case_sensitive = key
+        if regex:
+            return None
+        with self.lock:
+            best = None
+            for old_key in self.complete:
+                old_query, old_regex, old_case = old_key
+                if old_regex or old_key == key or not old_query:
+                    continue
+                # 新查询匹配到的每一行都必须也能被旧查询匹配到
+                if old_case:
+                    contained = case_sensitive and old_query in query
+                else:
+                    # 和 bytes 正则的 IGNORECASE 一样只折叠 ASCII 字母：'ü' 匹配不到 'Ü'
+                    contained = old_query.encode('utf-8').lower() in query.encode('utf-8').lower()
+                if contained and (best is None or len(old_query) > len(best[0])):
+                    best = old_key
+            return self.queries.get(best) if best else None
+
+    def is_binary(self, path, mtime, size):
+        return self.binaries.get(path) == (mtime, size)
+
+    def mark_binary(self, path, mtime, size):
+        self.binaries[path] = (mtime, size)
+
+    def mark_complete(self, key):
+        with self.lock:
+            if key in self.queries:
+                self.complete.add(key)
+
+
+class FileSearch(threading.Thread):
+    """一次在文件夹里的查找
+
+    结果以 (路径, [(行号, 列, 行文本)]) 的列表分批放进 results，只包含有匹配
+    的文件；结束（或取消）时放入 None。error 记录查询本身的错误（比如正则写错）。
+    """
+
+    def __init__(self, folder, query, regex=False, case_sensitive=True, cache=None):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.key = (query, regex, case_sensitive)
+        self.cache = cache or SearchCache()
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.error = None
+        self.files_searched = 0
+        self.files_matched = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            expression = compile_query(*self.key)
+        except re.error as e:
+            self.error = e
+            self.results.put(None)
+            return
+        try:
+            self.search(expression)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.results.put(None)
+
+    def search(self, expression):
+        cache = self.cache
+        cached = cache.results_for(self.key)
+        narrowing = cache.narrowing(self.key)
+        pool = executor()
+        # 同时在跑的任务数有上限，取消时不会留下一大堆排队的任务
+        limit = 2 * (os.cpu_count() or 1)
+        pending = set()
+        batch = []
+        for path, mtime, size in walk(self.folder, self.cancelled):
+            if cache.is_binary(path, mtime, size):
+                continue
+            previous = cached.get(path)
+            if previous and previous[:2] == (mtime, size):
+                self.report(path, previous[2])
+                continue
+            if narrowing:
+                older = narrowing.get(path)
+                if older and older[:2] == (mtime, size) and not older[2]:
+                    # 较短的查询都没有匹配，更长的也不会有
+                    cached[path] = (mtime, size, [])
+                    self.files_searched += 1
+                    continue
+            batch.append((path, mtime, size))
+            if len(batch) >= FILES_PER_TASK:
+                pending.add(pool.submit(search_files, batch, expression.pattern, expression.flags))
+                batch = []
+                while len(pending) >= limit and not self.cancelled.is_set():
+                    pending = self.collect(pending, cached)
+        if batch:
+            pending.add(pool.submit(search_files, batch, expression.pattern, expression.flags))
+        while pending and not self.cancelled.is_set():
+            pending = self.collect(pending, cached)
+        if self.cancelled.is_set():
+            for future in pending:
+                future.cancel()
+        else:
+            cache.mark_complete(self.key)
+
+    def collect(self, pending, cached):
+        done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        for future in done:
+            for path, mtime, size, binary, matches in future.result():
+                if binary:
+                    self.cache.mark_binary(path, mtime, size)
+                    continue
+                cached[path] = (mtime, size, matches)
+                self.report(path, matches)
+        return pending
+
+    def report(self, path, matches):
+        self.files_searched += 1
+        if matches and not self.cancelled.is_set():
+            self.files_matched += 1
+            self.results.put((path, matches))
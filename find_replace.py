@@ -0,0 +1,302 @@
+"""与界面无关的文档内查找/替换：维护当前查询的全部匹配位置
+
+MatchIndex 对着 piece table（任何有 text(start, end)、line_start、
+line_column 和 len() 的文档）工作，位置单位和文档一致。
+
+- 查询变长（边打字边搜）时只在上一次的匹配附近验证，不重新扫整篇；
+- 编辑后按 contentsChange 那样的 (位置, 删掉的长度, 插入的长度) 只重扫
+  改动附近的一小段；
+- 匹配位置按间隙缓冲区的方式存放：间隙之前存绝对位置，之后存相对文档
+  末尾的位置。在同一处连续输入时，后面成千上万个匹配的位置不用逐个平移；
+- 全部替换给出每个匹配各自的新文本，由界面在一个编辑事务里逐个替换（一步
+  撤销），只有匹配到的地方改动，不会把第一个到最后一个匹配之间整段重写。
+
+字面量查询记录所有（可以重叠的）出现位置，这样更长的查询一定能在较短
+查询的结果里找到；替换时从前往后取互不重叠的那些。正则查询只在一行之内
+匹配（不跨行，也不算空匹配），改动时重扫改动涉及的那几行就够了。
+"""
+import re
+from bisect import bisect_left, bisect_right
+
+# 查询变长时，旧匹配数不超过这么多才逐个验证，否则整篇重扫更快
+NARROW_LIMIT = 2000
+
+
+def compile_query(query, regex=False, case_sensitive=True):
+    """正则写错时抛出 re.error"""
+    pattern = query if regex else re.escape(query)
+    flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+    return re.compile(pattern, flags)
+
+
+class MatchIndex:
+    def __init__(self):
+        self.source = None
+        self.query = ''
+        self.regex = False
+        self.case_sensitive = True
+        self.expression = None
+        # 第 gap 个之前是绝对位置，之后是减去文档长度 length 的相对位置
+        self.starts = []
+        self.ends = []
+        self.gap = 0
+        self.length = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def clear(self):
+        self.__init__()
+
+    def search(self, source, query, regex=False, case_sensitive=True):
+        """换查询；能缩小上一次结果时就只验证旧匹配附近"""
+        expression = compile_query(query, regex, case_sensitive) if query else None
+        narrow_from = self.narrowable(source, query, regex, case_sensitive)
+        self.source = source
+        self.query = query
+        self.regex = regex
+        self.case_sensitive = case_sensitive
+        self.expression = expression
+        self.length = len(source)
+        if expression is None:
+            starts, ends = [], []
+        elif narrow_from is not None:
+            starts, ends = self.narrow(narrow_from)
+        else:
+            starts, ends = self.scan(0, self.length, self.length)
+        self.starts = starts
+        self.ends = ends
+        self.gap = len(starts)
+
+    def narrowable(self, source, query, regex, case_sensitive):
+        """新查询包含旧查询时，返回旧查询在新查询里的偏移"""
+        if regex or self.regex or self.expression is None or source is not self.source or \
+                case_sensitive != self.case_sensitive or len(source) != self.length or \
+                len(self.starts) > NARROW_LIMIT:
+            return None
+        match = self.expression.search(query)
+        return match.start() if match else None
+
+    def narrow(self, offset):
+        starts = []
+        ends = []
+        size = len(self.query)
+        for index in range(len(self.starts)):
+            start = self.start(index) - offset
+            if start < 0:
+                continue
+            match = self.expression.match(self.source.text(start, start + size))
+            if match:
+                starts.append(start)
+                ends.append(start + match.end())
+        return starts, ends
+
+    def scan(self, start, limit, end):
+        """起点在 [start, limit) 里的匹配，匹配不超过 end"""
+        if self.regex:
+            return self.scan_lines(start, limit)
+        text = self.source.text(start, end)
+        starts = []
+        ends = []
+        # 字面量：记录所有出现位置，包括互相重叠的
+        size = len(self.query)
+        limit -= start
+        if self.case_sensitive:
+            find = text.find
+            position = find(self.query)
+            while 0 <= position < limit:
+                starts.append(start + position)
+                ends.append(start + position + size)
+                position = find(self.query, position + 1)
+            return starts, ends
+        search = self.expression.search
+        match = search(text)
+        while match and match.start() < limit:
+            starts.append(start + match.start())
+            ends.append(start + match.end())
+            match = search(text, match.start() + 1)
+        return starts, ends
+
+    def scan_lines(self, start, limit):
+        """正则：[start, limit) 是整行，按行匹配；前后各多读一个字符，行首行尾的 ^、$ 和环视和在整篇里一样"""
+        before = 1 if start > 0 else 0
+        text = self.source.text(start - before, min(limit + 1, len(self.source)))
+        base = start - before
+        limit -= base
+        search = self.expression.search
+        starts = []
+        ends = []
+        position = before
+        while position <= limit:
+            match = search(text, position)
+            if not match or match.start() >= limit:
+                break
+            if match.end() == match.start():
+                position = match.end() + 1
+                continue
+            if '\n' in match.group():
+                # 跨行的匹配不算，只在起点所在的那一行里重新找
+                line_end = text.find('\n', match.start())
+                for match in self.expression.finditer(text, match.start(), line_end):
+                    if match.end() > match.start():
+                        starts.append(base + match.start())
+                        ends.append(base + match.end())
+                position = line_end + 1
+                continue
+            starts.append(base + match.start())
+            ends.append(base + match.end())
+            position = match.end()
+        return starts, ends
+
+    def start(self, index):
+        return self.starts[index] if index < self.gap else self.starts[index] + self.length
+
+    def end(self, index):
+        return self.ends[index] if index < self.gap else self.ends[index] + self.length
+
+    def span(self, index):
+        return self.start(index), self.end(index)
+
+    def first_starting_at(self, position):
+        """第一个起点 >= position 的匹配的序号"""
+        index = bisect_left(self.starts, position, 0, self.gap)
+        if index < self.gap:
+            return index
+        return bisect_left(self.starts, position - self.length, self.gap)
+
+    def first_ending_after(self, position):
+        """第一个终点 > position 的匹配的序号（终点和起点一样是递增的）"""
+        index = bisect_right(self.ends, position, 0, self.gap)
+        if index < self.gap:
+            return index
+        return bisect_right(self.ends, position - self.length, self.gap)
+
+    def move_gap(self, index):
+        length = self.length
+        if index < self.gap:
+            self.starts[index:self.gap] = [start - length for start in self.starts[index:self.gap]]
+            self.ends[index:self.gap] = [end - length for end in self.ends[index:self.gap]]
+        elif index > self.gap:
+            self.starts[self.gap:index] = [start + length for start in self.starts[self.gap:index]]
+            self.ends[self.gap:index] = [end + length for end in self.ends[self.gap:index]]
+        self.gap = index
+
+    def update(self, source, position, removed, added):
+        """文档在 position 处删掉 removed、插入 added 个单位之后调用（source 已经是改过的）"""
+        if self.expression is None:
+            return
+        new_length = len(source)
+        if source is not self.source or new_length != self.length + added - removed:
+            # 文档整个换掉了，或者漏掉了改动，直接重新搜
+            self.search(source, self.query, self.regex, self.case_sensitive)
+            return
+        if self.regex:
+            low, high = self.affected_lines(position, removed, added)
+        else:
+            # 和改动范围有重叠的旧匹配要去掉；新匹配的起点最早在 position - len + 1
+            low, high = position, position + removed
+        first = self.first_ending_after(low)
+        last = max(self.first_starting_at(high), first)
+        delta = added - removed
+        if self.regex:
+            scan_start, scan_limit = low, high + delta
+            scan_end = scan_limit
+        else:
+            scan_start = max(position - len(self.query) + 1, 0)
+            scan_limit = position + added
+            scan_end = min(scan_limit + len(self.query) - 1, new_length)
+        # 扫描要读改过的文档，所以先把新长度记下；间隙之后存的是相对末尾的位置，不受影响
+        self.move_gap(first)
+        del self.starts[first:last]
+        del self.ends[first:last]
+        self.length = new_length
+        starts, ends = self.scan(scan_start, scan_limit, scan_end)
+        self.starts[first:first] = starts
+        self.ends[first:first] = ends
+        self.gap = first + len(starts)
+
+    def affected_lines(self, position, removed, added):
+        """正则：改动涉及的整行，返回改动前坐标里的 (行首, 行尾)"""
+        source = self.source
+        low = source.line_start(source.line_column(position)[0])
+        line, _ = source.line_column(position + added)
+        high = source.line_start(line + 1)
+        if line + 1 < source.line_count():
+            high -= 1
+        return low, high - added + removed
+
+    def spans_between(self, start, end):
+        """和 [start, end) 有重叠的匹配，界面只给可见范围里的这些上色"""
+        index = self.first_ending_after(start)
+        spans = []
+        while index < len(self.starts):
+            span = self.span(index)
+            if span[0] >= end:
+                break
+            spans.append(span)
+            index += 1
+        return spans
+
+    def check_replacement(self, replacement):
+        """正则时检查替换文本里的 \\1、\\g<name> 之类的引用，写错时抛出 re.error"""
+        if not self.regex or self.expression is None or '\\' not in replacement:
+            return
+        try:
+            # 模板在替换之前就解析，空字符串上没有匹配也会检查
+            self.expression.sub(replacement, '')
+        except IndexError as e:
+            # 引用了不存在的组名时是 IndexError
+            raise re.error(str(e)) from e
+
+    def replacement(self, index, replacement):
+        """替换第 index 个匹配得到的文本，正则时展开 \\1 之类的引用；引用写错时抛出 re.error"""
+        start, end = self.span(index)
+        if not self.regex:
+            return replacement
+        self.check_replacement(replacement)
+        line_start = self.source.line_start(self.source.line_column(start)[0])
+        text = self.source.text(line_start, end)
+        match = self.expression.match(text, start - line_start)
+        return match.expand(replacement) if match else replacement
+
+    def replace_all(self, replacement):
+        """返回 [(开始, 结束, 新文本)]，从前往后、互不重叠；没有匹配时返回 None
+
+        界面在一个编辑事务里逐个替换，位置要加上前面替换造成的偏移。正则的
+        替换文本里引用写错时抛出 re.error。
+        """
+        if not self.starts:
+            return None
+        self.check_replacement(replacement)
+        if self.regex and '\\' in replacement:
+            return self.expand_all(replacement)
+        edits = []
+        previous = 0
+        for index in range(len(self.starts)):
+            start, end = self.span(index)
+            # 字面量的匹配可以重叠，和 str.replace 一样从前往后取不重叠的那些
+            if start >= previous:
+                edits.append((start, end, replacement))
+                previous = end
+        return edits
+
+    def expand_all(self, replacement):
+        """正则：按索引里的（行内）匹配逐个展开 \\1 之类的引用，和查找看到的完全一致"""
+        source = self.source
+        match = self.expression.match
+        edits = []
+        line_start = line_end = 0
+        text = ''
+        for index in range(len(self.starts)):
+            start, end = self.span(index)
+            if start >= line_end:
+                # 同一行的匹配只读一次这一行
+                line, _ = source.line_column(start)
+                line_start = source.line_start(line)
+                line_end = source.line_start(line + 1)
+                text = source.text(line_start, line_end)
+            found = match(text, start - line_start)
+            if found is None or found.end() != end - line_start:
+                found = match(text, start - line_start, end - line_start)
+            edits.append((start, end, found.expand(replacement) if found else replacement))
+        return edits
@@ -0,0 +1,86 @@
+"""与界面无关的目录扫描：工作线程按需列出目录，结果分批交给界面线程"""
+import os
+import queue
+import threading
+
+# 侧边栏里不显示、也不会去扫描的目录
+IGNORED_NAMES = frozenset({
+    '.git', '.hg', '.svn', 'node_modules', '__pycache__', '.venv', 'venv',
+    '.tox', '.nox', '.mypy_cache', '.pytest_cache', '.ruff_cache', '.idea',
+})
+# 每批最多的条目数，界面每次插入一批
+SCAN_BATCH = 256
+
+
+def entry_key(entry):
+    """目录在前，名字不区分大小写排序"""
+    name, is_directory = entry
+    return not is_directory, name.lower(), name
+
+
+def sort_entries(entries):
+    return sorted(entries, key=entry_key)
+
+
+class FolderScanner(threading.Thread):
+    """在工作线程里用 os.scandir 列目录，只列被请求的那一层
+
+    request(path) 把目录放进请求队列；结果以 (目录, [(名字, 是否目录)], 是否结束, 错误)
+    分批放进 results，界面线程定时取出插入树里。展开一个目录才会请求它的
+    子目录，所以再大的仓库打开时也只扫最上面一层。
+    """
+
+    def __init__(self, batch_size=SCAN_BATCH):
+        super().__init__(daemon=True)
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+        self.pending = 0
+
+    def request(self, path):
+        self.pending += 1
+        self.requests.put(path)
+
+    def run(self):
+        while not self.stopped.is_set():
+            path = self.requests.get()
+            if path is None:
+                return
+            self.scan(path)
+
+    def scan(self, path):
+        batch = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if self.stopped.is_set():
+                        return
+                    if entry.name in IGNORED_NAMES:
+                        continue
+                    try:
+                        is_directory = entry.is_dir()
+                    except OSError:
+                        is_directory = False
+                    batch.append((entry.name, is_directory))
+                    if len(batch) >= self.batch_size:
+                        self.results.put((path, sort_entries(batch), False, None))
+                        batch = []
+        except OSError as e:
+            self.results.put((path, sort_entries(batch), True, e))
+            return
+        self.results.put((path, sort_entries(batch), True, None))
+
+    def take(self):
+        """界面线程取一批结果，没有时返回 None"""
+        try:
+            result = self.results.get_nowait()
+        except queue.Empty:
+            return None
+        if result[2]:
+            self.pending -= 1
+        return result
+
+    def stop(self):
+        self.stopped.set()
+        self.requests.put(None)
@@ -0,0 +1,181 @@
+"""可选的性能埋点：直方图、屏幕 HUD 用的摘要、Chrome trace 导出
+
+默认关闭。设置环境变量 ADORABLE_KATZE_TRACE=1（或者一个输出路径），
+或者用 --trace[=路径] 启动时打开。关闭时 span() 直接返回一个共用的空
+上下文管理器，热路径（每块高亮）只在打开时才换成带计时的实现，所以
+不开的时候几乎没有开销。
+
+退出时把记录写成 Chrome trace-event JSON，可以用 chrome://tracing
+或 https://ui.perfetto.dev 打开；直方图摘要也附在同一个文件里。
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_TRACE_PATH = 'adorable_katze_trace.json'
+# trace 里最多保留的事件数，超过后丢掉最早的
+MAX_EVENTS = 200000
+
+enabled = False
+# 是否在窗口上显示实时的耗时摘要
+hud = False
+trace_path = None
+histograms = {}
+# 名字 -> 返回计数器字典的函数（比如缓存的命中数），HUD 和导出时才调用
+counters = {}
+events = deque(maxlen=MAX_EVENTS)
+PID = os.getpid()
+
+
+class Histogram:
+    """按 2 的幂分桶的耗时直方图（纳秒），记录一次只是几次整数运算"""
+
+    __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.buckets = [0] * 64
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+        self.buckets[duration.bit_length()] += 1
+
+    def percentile(self, fraction):
+        """估计值：返回所在桶的上界，最大不超过实际最大值"""
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((1 << index) - 1, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count / 1000 if self.count else 0,
+            'p50_us': self.percentile(0.50) / 1000,
+            'p99_us': self.percentile(0.99) / 1000,
+            'max_us': self.maximum / 1000,
+        }
+
+
+def record(name, start, end, category='editor', args=None):
+    """记一段耗时，start/end 是 time.perf_counter_ns() 的值"""
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.add(end - start)
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': start / 1000,
+        'dur': (end - start) / 1000,
+        'pid': PID,
+        'tid': threading.get_ident(),
+    }
+    if args:
+        event['args'] = args
+    events.append(event)
+
+
+class Span:
+    __slots__ = ('name', 'category', 'args', 'start')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.perf_counter_ns(), self.category, self.args)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, category='editor', args=None):
+    """with span('save.write'): ... 计时；没打开埋点时什么也不做"""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+
+def summary(limit=None):
+    """按总耗时从大到小排列的 (名字, 摘要)"""
+    items = sorted(histograms.items(), key=lambda item: item[1].total, reverse=True)
+    return [(name, histogram.summary()) for name, histogram in items[:limit]]
+
+
+def register_counters(name, function):
+    """登记一组计数器；不管埋点是否打开都可以登记，读的时候才调用 function()"""
+    counters[name] = function
+
+
+def counter_values():
+    return {name: function() for name, function in counters.items()}
+
+
+def dump(path=None):
+    path = path or trace_path or DEFAULT_TRACE_PATH
+    report = {
+        'traceEvents': list(events),
+        'displayTimeUnit': 'ms',
+        'histograms': dict(summary()),
+        'counters': counter_values(),
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file)
+    return path
+
+
+def enable(path=None):
+    global enabled, trace_path
+    if enabled:
+        return
+    enabled = True
+    trace_path = path or DEFAULT_TRACE_PATH
+    atexit.register(dump)
+
+
+def enable_from_environment(argv=()):
+    """ADORABLE_KATZE_TRACE 环境变量或 --trace[=路径] 参数；--hud（或 ADORABLE_KATZE_HUD=1）同时打开 HUD"""
+    global hud
+    value = os.environ.get('ADORABLE_KATZE_TRACE')
+    hud = os.environ.get('ADORABLE_KATZE_HUD', '0') != '0'
+    for argument in argv:
+        if argument == '--trace':
+            value = value or '1'
+        elif argument.startswith('--trace='):
+            value = argument.split('=', 1)[1]
+        elif argument == '--hud':
+            hud = True
+    if hud and not value:
+        value = '1'
+    if value and value != '0':
+        enable(None if value == '1' else value)
+    return enabled
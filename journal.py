@@ -0,0 +1,311 @@
+"""崩溃恢复日志：只追加编辑的增量，下次启动时在原文件上重放
+
+每个打开的文件对应恢复目录里的一个 .journal 文件，文件名由路径和进程号
+决定，两个编辑器实例（包括 Qt 和 Tk 两种前端）打开同一个文件也各写各的。
+第一行是 JSON 头，记录原文件路径、大小、修改时间和进程号；之后每行一条
+[位置, 删除长度, 插入文本]。日志大小只和编辑量有关，与文件大小无关。
+
+写日志的进程在日志存在期间一直对旁边同名的 .lock 文件持有排他锁，进程
+退出（包括崩溃）时由系统释放；find_journals 跳过还锁着的日志，所以不会
+把正在运行的实例的日志当成崩溃留下的。锁不加在日志本身上，压缩时才能把
+新文件原子地换上去（Windows 上不能改名到打开着的文件上）。
+"""
+import hashlib
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from piece_table import PieceTable
+
+RECOVERY_DIR = os.path.join(os.path.expanduser('~'), '.adorable_katze', 'recovery')
+# 已写盘的记录超过这么多条时尝试压缩
+COMPACT_RECORDS = 1000
+
+
+def merge_record(last, record):
+    """能合并成一条的两条连续记录返回合并结果，否则返回 None"""
+    position, removed, text = last
+    new_position, new_removed, new_text = record
+    if not new_removed and new_position == position + len(text):
+        # 接着上一次插入的位置继续输入
+        return [position, removed, text + new_text]
+    if new_removed and not new_text:
+        if new_position + new_removed == position + len(text) and new_removed <= len(text):
+            # 退格删掉刚输入的内容
+            return [position, removed, text[:len(text) - new_removed]]
+        if not text and new_position + new_removed == position:
+            # 连续退格
+            return [new_position, removed + new_removed, '']
+        if not text and new_position == position:
+            # 连续向后删除
+            return [position, removed + new_removed, '']
+    return None
+
+
+def compact_records(records):
+    compacted = []
+    for record in records:
+        merged = merge_record(compacted[-1], record) if compacted else None
+        if merged is None:
+            compacted.append(list(record))
+        elif merged[1] or merged[2]:
+            compacted[-1] = merged
+        else:
+            compacted.pop()
+    return compacted
+
+
+def lock_path(journal_path):
+    return os.path.splitext(journal_path)[0] + '.lock'
+
+
+def lock_file(file):
+    """对锁文件加排他锁（不等待），已经被别的打开锁住时抛出 OSError"""
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        # 锁住第一个字节，文件是空的也可以
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def is_locked(journal_path):
+    """日志是否正被一个还在运行的编辑器写着"""
+    try:
+        with open(lock_path(journal_path), 'rb') as file:
+            try:
+                lock_file(file)
+            except OSError:
+                return True
+            if not fcntl:
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            return False
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True
+
+
+def remove_journal(journal_path):
+    """删掉崩溃留下的日志和它的锁文件"""
+    for path in (journal_path, lock_path(journal_path)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def file_fingerprint(path):
+    try:
+        info = os.stat(path)
+    except (OSError, TypeError):
+        return None, None
+    return info.st_size, info.st_mtime_ns
+
+
+class RecoveryJournal:
+    """一个文档的恢复日志
+
+    record() 只把增量放进内存里的待写列表，并尽量和上一条合并，
+    每次按键的开销是微秒级；flush() 由界面的定时器调用，把待写记录
+    追加到磁盘，记录多了再压缩重写。units 记录位置的单位
+    （Qt 用 'utf-16'，Tk 用 'chars'），重放时由同一种前端处理。
+    """
+
+    def __init__(self, path, units, directory=RECOVERY_DIR):
+        self.units = units
+        self.directory = directory
+        self.reset(path)
+
+    def reset(self, path):
+        """换成 path 对应的一份空日志；旧的日志文件要由调用方先关掉或删掉"""
+        self.path = os.path.abspath(path) if path else None
+        # 带上进程号：别的实例打开同一个文件时不会截断这一份
+        key = f'{self.path}-{os.getpid()}' if self.path else f'untitled-{os.getpid()}-{id(self)}'
+        self.journal_path = os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.journal')
+        self.records = []
+        self.pending = []
+        self.checkpoint = None
+        self.compacted_size = 0
+        self.file = None
+        self.lock = None
+
+    def header(self):
+        size, mtime_ns = file_fingerprint(self.path)
+        return {
+            'path': self.path,
+            'units': self.units,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'pid': os.getpid(),
+            'created': time.time(),
+        }
+
+    def record(self, position, removed, text):
+        record = [position, removed, text]
+        if self.pending:
+            merged = merge_record(self.pending[-1], record)
+            if merged is not None:
+                if merged[1] or merged[2]:
+                    self.pending[-1] = merged
+                else:
+                    self.pending.pop()
+                return
+        self.pending.append(record)
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.hold_lock()
+            self.file = open(self.journal_path, 'w', encoding='utf-8')
+            self.file.write(json.dumps(self.header()) + '\n')
+        self.file.write(''.join(json.dumps(record) + '\n' for record in self.pending))
+        self.file.flush()
+        self.records.extend(self.pending)
+        self.pending = []
+        if self.checkpoint is None and len(self.records) > max(COMPACT_RECORDS, 2 * self.compacted_size):
+            self.compact()
+
+    def compact(self):
+        """把已写盘的记录合并后原子地重写日志"""
+        self.records = compact_records(self.records)
+        self.compacted_size = len(self.records)
+        self.rewrite()
+
+    def rewrite(self):
+        if not self.records and not self.pending:
+            self.remove_file()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # 整个过程中一直拿着锁文件的锁，别的实例不会把日志当成崩溃留下的
+        self.hold_lock()
+        content = json.dumps(self.header()) + '\n' + ''.join(json.dumps(record) + '\n' for record in self.records)
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        # Windows 上不能改名到打开着的文件上，先关掉旧的
+        if self.file:
+            self.file.close()
+            self.file = None
+        try:
+            os.replace(temp_path, self.journal_path)
+        except OSError:
+            # 别的进程正好打开着日志（比如在读头）时 Windows 上改名会失败，改成原地重写
+            os.unlink(temp_path)
+            with open(self.journal_path, 'w', encoding='utf-8') as file:
+                file.write(content)
+        self.file = open(self.journal_path, 'a', encoding='utf-8')
+
+    def hold_lock(self):
+        if self.lock is None:
+            # 'ab' 不会截断；文件名带着进程号，只有自己会锁它
+            self.lock = open(lock_path(self.journal_path), 'ab')
+            try:
+                lock_file(self.lock)
+            except OSError:
+                self.lock.close()
+                self.lock = None
+                raise
+
+    def set_checkpoint(self):
+        """开始保存时调用：之后的记录不再和之前的合并，保存成功后只保留它们"""
+        self.flush()
+        self.checkpoint = len(self.records)
+
+    def rebase(self, path):
+        """保存成功后，以刚保存的文件为基准，只保留检查点之后的记录"""
+        self.flush()
+        records = self.records[self.checkpoint or 0:]
+        if path and os.path.abspath(path) != self.path:
+            # 另存为：日志换成新文件名对应的那一份
+            self.remove_file()
+            self.reset(path)
+        self.records = records
+        self.checkpoint = None
+        self.compacted_size = 0
+        self.rewrite()
+
+    def discard(self):
+        """文档已保存或者放弃修改，删掉日志"""
+        self.pending = []
+        self.records = []
+        self.checkpoint = None
+        self.remove_file()
+
+    def remove_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        try:
+            os.unlink(self.journal_path)
+        except FileNotFoundError:
+            pass
+        # 日志删掉之后才放开锁
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+            try:
+                os.unlink(lock_path(self.journal_path))
+            except FileNotFoundError:
+                pass
+
+
+def find_journals(units, directory=RECOVERY_DIR):
+    """恢复目录里属于这种前端的日志，按时间从新到旧返回 (日志路径, 头)"""
+    journals = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return journals
+    for name in names:
+        if not name.endswith('.journal'):
+            continue
+        journal_path = os.path.join(directory, name)
+        if is_locked(journal_path):
+            # 还在运行的实例（包括自己）正在写的日志
+            continue
+        try:
+            with open(journal_path, encoding='utf-8') as file:
+                header = json.loads(file.readline())
+        except (OSError, ValueError):
+            continue
+        if header.get('units') == units:
+            journals.append((journal_path, header))
+    journals.sort(key=lambda journal: journal[1].get('created', 0), reverse=True)
+    return journals
+
+
+def read_records(journal_path):
+    """读出日志里的记录；崩溃时最后一行可能只写了一半，忽略它"""
+    records = []
+    with open(journal_path, encoding='utf-8') as file:
+        file.readline()
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+def base_changed(header):
+    """原文件在崩溃之后是否被别的程序改过"""
+    return file_fingerprint(header.get('path')) != (header.get('size'), header.get('mtime_ns'))
+
+
+def replay(base_text, records):
+    """在原文件内容上重放记录，返回 PieceTable：保存点是原文件，当前内容是恢复后的文本"""
+    table = PieceTable(base_text)
+    for position, removed, text in records:
+        table.delete(position, removed)
+        table.insert(position, text)
+    table.clear_history()
+    return table
@@ -0,0 +1,153 @@
+"""进程内共用的语言注册表
+
+语言定义放在 languages/ 目录下的 JSON 文件里（扩展名、解释器名、
+样式、规则、关键字）。第一次查找时才读这些文件；每种语言的组合正则
+在第一次使用时编译一次，之后所有文档共用同一份，切换语言只是查字典。
+"""
+import json
+import os
+import re
+
+LANGUAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'languages')
+# 按内容识别语言时只看开头这么多字符
+DETECT_SIZE = 4096
+
+SHEBANG = re.compile(r'#!\s*(\S+)(.*)')
+INTERPRETER_NAME = re.compile(r'[A-Za-z+_-]*[A-Za-z+_]')
+# -*- mode: python -*- 或 -*- python -*-
+EMACS_MODELINE = re.compile(r'-\*-\s*(?:[^\n]*?\bmode\s*:\s*)?([\w+-]+)[^\n]*?-\*-', re.IGNORECASE)
+# vim: set ft=python: / vi: filetype=python
+VIM_MODELINE = re.compile(r'\b(?:vim?|ex):[^\n]*?\b(?:ft|filetype|syntax)=([\w+-]+)')
+
+
+class Language:
+    """一种语言的定义；compile() 之后带上共用的组合正则"""
+
+    def __init__(self, definition):
+        self.name = definition['name']
+        self.extensions = [extension.lower() for extension in definition.get('extensions', [])]
+        self.filenames = definition.get('filenames', [])
+        self.interpreters = definition.get('interpreters', [])
+        self.aliases = [alias.lower() for alias in definition.get('aliases', [])]
+        self.styles = definition.get('styles', {})
+        # rules 按优先级排列，同一位置上先声明的规则胜出
+        self.rules = [tuple(rule) for rule in definition.get('rules', [])]
+        # 可以跨行的 (开始, 结束, 样式)，块状态就是它在这里的序号 + 1
+        self.multiline = [tuple(rule) for rule in definition.get('multiline', [])]
+        self.keywords = frozenset(definition.get('keywords', []))
+        self.keyword_style = definition.get('keyword_style')
+        self.expression = None
+        self.group_styles = {}
+        self.multiline_groups = {}
+        self.multiline_ends = {}
+
+    def compile(self):
+        """把所有规则编译成一个命名分组的组合正则，只在第一次调用时编译"""
+        if self.expression is not None:
+            return self
+        # 多行规则的开始标记优先级最高，状态号从 1 开始
+        groups = [('m%d' % state, start) for state, (start, _, _) in enumerate(self.multiline, 1)]
+        groups += [('r%d' % index, pattern) for index, (pattern, _) in enumerate(self.rules)]
+        if self.keywords:
+            # 兜底的单词分组：吃掉整个单词，交给关键字集合判断
+            groups.append(('word', r'\b\w+\b'))
+        self.group_styles = {'r%d' % index: style for index, (_, style) in enumerate(self.rules)}
+        self.group_styles['word'] = None
+        self.multiline_ends = {
+            state: (re.compile(end), style) for state, (_, end, style) in enumerate(self.multiline, 1)
+        }
+        self.multiline_groups = {'m%d' % state: state for state in self.multiline_ends}
+        self.expression = re.compile('|'.join('(?P<%s>%s)' % group for group in groups))
+        return self
+
+
+class LanguageRegistry:
+    """按文件名或文件开头的内容找到对应的 Language"""
+
+    def __init__(self, directory=LANGUAGE_DIR):
+        self.directory = directory
+        self.languages = None
+        self.by_extension = {}
+        self.by_filename = {}
+        self.by_interpreter = {}
+        self.by_alias = {}
+
+    def load(self):
+        if self.languages is not None:
+            return
+        self.languages = {}
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as file:
+                    language = Language(json.load(file))
+            except (OSError, ValueError, KeyError) as e:
+                print(e)
+                continue
+            self.languages[language.name] = language
+            for extension in language.extensions:
+                self.by_extension[extension] = language
+            for filename in language.filenames:
+                self.by_filename[filename] = language
+            for interpreter in language.interpreters:
+                self.by_interpreter[interpreter] = language
+            self.by_alias[language.name.lower()] = language
+            for alias in language.aliases:
+                self.by_alias[alias] = language
+
+    def names(self):
+        self.load()
+        return list(self.languages)
+
+    def get(self, name):
+        """按名字或别名（如 'py'、'c++'）查找"""
+        self.load()
+        if not name:
+            return None
+        return self.languages.get(name) or self.by_alias.get(name.lower())
+
+    def detect(self, path=None, head=''):
+        """先看文件名和扩展名，认不出来再看开头的 shebang 和 modeline"""
+        self.load()
+        if path:
+            filename = os.path.basename(path)
+            language = self.by_filename.get(filename)
+            if language:
+                return language
+            _, extension = os.path.splitext(filename)
+            language = self.by_extension.get(extension.lower())
+            if language:
+                return language
+        head = head[:DETECT_SIZE]
+        return self.detect_modeline(head) or self.detect_shebang(head)
+
+    def detect_modeline(self, head):
+        for pattern in (EMACS_MODELINE, VIM_MODELINE):
+            match = pattern.search(head)
+            if match:
+                language = self.by_alias.get(match.group(1).lower())
+                if language:
+                    return language
+        return None
+
+    def detect_shebang(self, head):
+        match = SHEBANG.match(head.partition('\n')[0])
+        if not match:
+            return None
+        interpreter = os.path.basename(match.group(1))
+        if interpreter == 'env':
+            # #!/usr/bin/env [-S] python3
+            arguments = [argument for argument in match.group(2).split() if not argument.startswith('-')]
+            if not arguments:
+                return None
+            interpreter = os.path.basename(arguments[0])
+        name = INTERPRETER_NAME.match(interpreter)
+        return self.by_interpreter.get(name.group() if name else interpreter)
+
+
+registry = LanguageRegistry()
@@ -0,0 +1,76 @@
+"""只读的大文件模型：mmap 映射文件，后台建立行首偏移索引，按行号取文本"""
+import mmap
+import os
+import threading
+from array import array
+from itertools import accumulate
+
+# 建索引时每次扫描的字节数
+INDEX_CHUNK = 16 * 1024 * 1024
+
+
+class LargeFile:
+    """mmap 打开的大文件
+
+    offsets 是每一行行首的字节偏移（array('Q')，每行 8 字节），由后台线程
+    一边扫描一边追加，所以行号定位和按比例跳转都是 O(1)。除了索引以外，
+    内存占用与文件大小无关，文本只在绘制时按行解码。
+    """
+
+    def __init__(self, path, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.offsets = array('Q', [0])
+        self.indexed = threading.Event()
+        self.closed = False
+        self.indexer = threading.Thread(target=self.build_index, daemon=True)
+        self.indexer.start()
+
+    def build_index(self):
+        try:
+            position = 0
+            while position < self.size and not self.closed:
+                chunk = self.data[position:position + INDEX_CHUNK]
+                parts = chunk.split(b'\n')
+                if len(parts) > 1:
+                    # 第一个换行之后的行首，再依次加上每行长度 + 1
+                    first = position + len(parts[0]) + 1
+                    self.offsets.extend(accumulate(map((1).__add__, map(len, parts[1:-1])), initial=first))
+                position += len(chunk)
+        except ValueError:
+            # 索引还没建完文件就被关掉了
+            pass
+        finally:
+            self.indexed.set()
+
+    def line_count(self):
+        """目前已知的行数；索引建完之前最后一行可能还没读到结尾，不算在内"""
+        if self.indexed.is_set():
+            return len(self.offsets)
+        return len(self.offsets) - 1
+
+    def line(self, number, limit=None):
+        """第 number 行的文本，limit 限制最多解码的字节数"""
+        start = self.offsets[number]
+        if number + 1 < len(self.offsets):
+            end = self.offsets[number + 1] - 1
+        else:
+            end = self.size
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.data[start:end].decode(self.encoding, errors='replace').rstrip('\r')
+
+    def line_at_fraction(self, fraction):
+        """按百分比跳转时对应的行号"""
+        count = self.line_count()
+        return min(max(int(fraction * count), 0), max(count - 1, 0))
+
+    def close(self):
+        self.closed = True
+        self.indexer.join()
+        if self.size:
+            self.data.close()
+        self.file.close()
@@ -1,11 +1,71 @@
 import os
+import re
 import sys
+import time
+import queue
+import zlib
+from bisect import bisect
+from collections import OrderedDict
 
 from PyQt5 import QtCore
-from PyQt5.QtCore import Qt, QRegExp
-from PyQt5.QtGui import QKeySequence, QFont, QPixmap, QSyntaxHighlighter, QTextCharFormat, QColor
+from PyQt5.QtCore import Qt, QTimer, QPoint, QFileSystemWatcher, QStringListModel
+from PyQt5.QtGui import QKeySequence, QFont, QPixmap, QSyntaxHighlighter, QTextCharFormat, QColor, QTextCursor, \
+    QPainter
 from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QVBoxLayout, QShortcut, QFileDialog, \
-    QMessageBox, QPlainTextEdit, QLabel
+    QMessageBox, QPlainTextEdit, QLabel, QProgressDialog, QInputDialog, QHBoxLayout, QTreeWidget, \
+    QTreeWidgetItem, QLineEdit, QCheckBox, QListWidget, QListWidgetItem, QPushButton, QTextEdit, QTabBar, \
+    QCompleter
+
+from file_io import ChunkReader, AtomicSaver, SAVE_BLOCK_SIZE, disk_state, file_digest
+from journal import RecoveryJournal, find_journals, read_records, remove_journal, base_changed, replay
+from large_file import LargeFile
+from piece_table import PieceTable, iter_chunks
+from languages import registry, DETECT_SIZE
+import instrument
+from folder_scan import FolderScanner, entry_key
+from find_in_files import FileSearch, SearchCache
+from find_replace import MatchIndex
+from parallel_highlight import ParallelTokenizer, PreparedTokens
+from file_watch import check_file, changed_regions
+from tokenizer import Tokenizer
+from word_index import WordIndex, WordCounter, complete, INLINE_SIZE
+
+# 超过这么多行的文档改用延迟高亮
+LAZY_HIGHLIGHT_BLOCKS = 2000
+# 超过这么多行、而且有多个核时，延迟高亮的首遍分词交给进程池并行做
+PARALLEL_HIGHLIGHT_BLOCKS = 50000
+# 后台高亮每次占用事件循环的时间（秒）
+LAZY_HIGHLIGHT_SLICE = 0.004
+# 后台高亮每次级联处理的块数
+LAZY_HIGHLIGHT_CHUNK = 128
+# 打开文件时每次往文档里追加文本占用事件循环的时间（秒）
+LOAD_SLICE = 0.010
+# 超过这个大小的文件用只读的大文件查看器打开
+LARGE_FILE_SIZE = 256 * 1024 * 1024
+# 大文件查看器每行最多解码、绘制的字节数
+LARGE_FILE_LINE_LIMIT = 4096
+# 恢复日志写盘的间隔（毫秒）
+JOURNAL_FLUSH_INTERVAL = 1000
+# 背景图放在程序旁边，不管从哪个目录启动都能找到
+BACKGROUND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'background.jpeg')
+# 窗口停止缩放这么久（毫秒）之后再做一次平滑缩放
+BACKGROUND_DEBOUNCE = 150
+# 按窗口大小缓存的平滑缩放结果个数
+BACKGROUND_CACHE_SIZE = 4
+# 侧边栏每次往树里插入扫描结果占用事件循环的时间（秒）
+FOLDER_SLICE = 0.008
+# 在文件夹里查找：停止输入这么久（毫秒）之后才开始搜
+FIND_DEBOUNCE = 150
+# 每次把搜索结果放进列表占用事件循环的时间（秒）
+FIND_SLICE = 0.008
+# 列表里最多显示的匹配行数，更多的只计数
+FIND_MAX_RESULTS = 5000
+# 不活动的标签页一共最多占用的内存（MB），可以用 ADORABLE_KATZE_TAB_BUDGET_MB 改
+TAB_MEMORY_BUDGET_MB = 64
+# 文件被改动的通知到了之后等这么久（毫秒）再检查，别的程序往往分几次写完
+WATCH_DEBOUNCE = 200
+# 检查后台单词统计是否完成的间隔（毫秒）
+WORD_POLL_INTERVAL = 50
 
 class FileInfo:
     def __init__(self):
@@ -14,6 +74,8 @@ class FileInfo:
         self.encoding = 'utf-8'
         self.saved = True
         self.modified = False
+        # 最后一次读写时磁盘上文件的 (修改时间, 大小, 哈希)，用来发现别的程序改了文件
+        self.disk_state = None
 
     def get_absolute_file_path(self):
         if self.parent_file_path and self.file_name:
@@ -21,375 +83,1094 @@ class FileInfo:
         else:
             return None
 
+class Tab:
+    """一个打开的文档
+
+    活动标签页的内容在编辑器和 MainGui 的 piece table 里。切走时只留下
+    UTF-8 字节和光标、滚动位置，QTextDocument 的排版、撤销历史和高亮状态
+    都丢掉，切回来时再重建。超出内存预算时，最久没用的标签页先压缩；没有
+    修改过的文件干脆连字节也丢掉，切回来时重新从磁盘读。
+    """
+
+    def __init__(self, file_info, journal):
+        self.file_info = file_info
+        self.journal = journal
+        # 不活动时的内容，compressed 时是 zlib 压缩过的；None 表示要从磁盘重读
+        self.data = None
+        self.compressed = False
+        self.large_file = False
+        # (anchor, position)
+        self.cursor = (0, 0)
+        self.scroll = 0
+
+    def memory(self):
+        return len(self.data) if self.data else 0
+
+    def text(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode('utf-8', 'surrogatepass')
+
+    def title(self):
+        name = self.file_info.file_name or "untitled"
+        return name + " *" if self.file_info.modified else name
+
 class Highlighter(QSyntaxHighlighter):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.highlighting_rules = []
-    def highlightBlock(self, text):
-        for pattern, fmt in self.highlighting_rules:
-            expression = QRegExp(pattern)
-            index = expression.indexIn(text)
-            while index >= 0:
-                length = expression.matchedLength()
-                self.setFormat(index, length, fmt)
-                index = expression.indexIn(text, index + length)
+    """高亮器：把 tokenizer 的分词结果换成 QTextCharFormat
 
-class PythonHighlighter(Highlighter):
-    """Python 语法高亮"""
+    分词本身与界面无关（见 tokenizer.py），这里只负责把位置换算成 UTF-16、
+    把行尾状态存成块状态。QSyntaxHighlighter 只在某一块的状态变化时才继续
+    重排下一块，所以编辑后只会重新高亮状态真正改变的那一段。
 
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
-
-        # 关键字格式
-        keyword_format = QTextCharFormat()
-        keyword_format.setForeground(QColor("#0077CC"))
-        keyword_format.setFontWeight(QFont.Bold)
-
-        python_keywords = [
-            'and', 'as', 'assert', 'break', 'class', 'continue',
-            'def', 'del', 'elif', 'else', 'except', 'False',
-            'finally', 'for', 'from', 'global', 'if', 'import',
-            'in', 'is', 'lambda', 'None', 'nonlocal', 'not',
-            'or', 'pass', 'raise', 'return', 'True', 'try',
-            'while', 'with', 'yield', 'self'
-        ]
-
-        # 添加关键字规则
-        for word in python_keywords:
-            pattern = r'\b' + word + r'\b'
-            self.highlighting_rules.append((pattern, keyword_format))
-
-        # 类名格式
-        class_format = QTextCharFormat()
-        class_format.setForeground(QColor("#9944CC"))
-        class_format.setFontWeight(QFont.Bold)
-        self.highlighting_rules.append((r'\b[A-Z][a-zA-Z0-9_]*\b', class_format))
-
-        # 函数名格式
-        function_format = QTextCharFormat()
-        function_format.setForeground(QColor("#DD7700"))
-        self.highlighting_rules.append((r'\b\w+(?=\()', function_format))
-
-        # 字符串格式
-        string_format = QTextCharFormat()
-        string_format.setForeground(QColor("#22AA22"))
-        self.highlighting_rules.extend([
-            (r'".*?"', string_format),
-            (r"'.*?'", string_format),
-            (r'""".*?"""', string_format),
-            (r"'''.*?'''", string_format)
-        ])
-
-        # 注释格式
-        comment_format = QTextCharFormat()
-        comment_format.setForeground(QColor("#888888"))
-        comment_format.setFontItalic(True)
-        self.highlighting_rules.append((r'#.*$', comment_format))
-
-        # 数字格式
-        number_format = QTextCharFormat()
-        number_format.setForeground(QColor("#AA5500"))
-        self.highlighting_rules.append((r'\b\d+(\.\d+)?\b', number_format))
-
-        # 装饰器格式
-        decorator_format = QTextCharFormat()
-        decorator_format.setForeground(QColor("#AA00AA"))
-        self.highlighting_rules.append((r'@\w+', decorator_format))
-
-class JavaHighlighter(Highlighter):
-    """Java 语法高亮"""
+    QTextCharFormat 按语言缓存在 text_formats 里，同一语言的所有文档共用，
+    新建高亮器不需要重建任何规则。
+    """
 
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
-
-        # 关键字格式
-        keyword_format = QTextCharFormat()
-        keyword_format.setForeground(QColor("#0077CC"))
-        keyword_format.setFontWeight(QFont.Bold)
-
-        java_keywords = [
-            'abstract', 'assert', 'boolean', 'break', 'byte', 'case',
-            'catch', 'char', 'class', 'const', 'continue', 'default',
-            'do', 'double', 'else', 'enum', 'extends', 'final',
-            'finally', 'float', 'for', 'goto', 'if', 'implements',
-            'import', 'instanceof', 'int', 'interface', 'long', 'native',
-            'new', 'package', 'private', 'protected', 'public', 'return',
-            'short', 'static', 'strictfp', 'super', 'switch', 'synchronized',
-            'this', 'throw', 'throws', 'transient', 'try', 'void',
-            'volatile', 'while', 'true', 'false', 'null'
-        ]
-
-        for word in java_keywords:
-            pattern = r'\b' + word + r'\b'
-            self.highlighting_rules.append((pattern, keyword_format))
-
-        # 类名格式
-        class_format = QTextCharFormat()
-        class_format.setForeground(QColor("#9944CC"))
-        class_format.setFontWeight(QFont.Bold)
-        self.highlighting_rules.append((r'\b[A-Z][a-zA-Z0-9_]*\b', class_format))
-
-        # 字符串格式
-        string_format = QTextCharFormat()
-        string_format.setForeground(QColor("#22AA22"))
-        self.highlighting_rules.extend([
-            (r'".*?"', string_format),
-            (r"'.'", string_format)
-        ])
-
-        # 注释格式
-        comment_format = QTextCharFormat()
-        comment_format.setForeground(QColor("#888888"))
-        comment_format.setFontItalic(True)
-        self.highlighting_rules.extend([
-            (r'//.*$', comment_format),
-            (r'/\*.*?\*/', comment_format)
-        ])
-
-        # 数字格式
-        number_format = QTextCharFormat()
-        number_format.setForeground(QColor("#AA5500"))
-        self.highlighting_rules.append((r'\b\d+(\.\d+)?[fFlL]?\b', number_format))
-
-class JavaScriptHighlighter(Highlighter):
-    """JavaScript 语法高亮"""
+    # 语言名 -> {样式名: QTextCharFormat}
+    text_formats = {}
 
-    def __init__(self, parent=None):
+    def __init__(self, parent, language):
         super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
-
-        # 关键字格式
-        keyword_format = QTextCharFormat()
-        keyword_format.setForeground(QColor("#0077CC"))
-        keyword_format.setFontWeight(QFont.Bold)
-
-        js_keywords = [
-            'break', 'case', 'catch', 'class', 'const', 'continue',
-            'debugger', 'default', 'delete', 'do', 'else', 'export',
-            'extends', 'finally', 'for', 'function', 'if', 'import',
-            'in', 'instanceof', 'let', 'new', 'return', 'super',
-            'switch', 'this', 'throw', 'try', 'typeof', 'var',
-            'void', 'while', 'with', 'yield', 'true', 'false',
-            'null', 'undefined', 'NaN', 'Infinity'
-        ]
-
-        for word in js_keywords:
-            pattern = r'\b' + word + r'\b'
-            self.highlighting_rules.append((pattern, keyword_format))
-
-        # 字符串格式
-        string_format = QTextCharFormat()
-        string_format.setForeground(QColor("#22AA22"))
-        self.highlighting_rules.extend([
-            (r'".*?"', string_format),
-            (r"'.*?'", string_format),
-            (r'`.*?`', string_format)
-        ])
-
-        # 注释格式
-        comment_format = QTextCharFormat()
-        comment_format.setForeground(QColor("#888888"))
-        comment_format.setFontItalic(True)
-        self.highlighting_rules.extend([
-            (r'//.*$', comment_format),
-            (r'/\*.*?\*/', comment_format)
-        ])
-
-        # 函数格式
-        function_format = QTextCharFormat()
-        function_format.setForeground(QColor("#DD7700"))
-        self.highlighting_rules.append((r'\b\w+(?=\()', function_format))
-
-class CppHighlighter(Highlighter):
-    """C++ 语法高亮"""
+        self.tokenizer = Tokenizer(language)
+        self.formats = self.formats_for(language)
+        # 按 Language.styles 的顺序排好，并行分词的结果里样式是序号
+        self.style_formats = [self.formats.get(name) for name in language.styles]
+        # 并行首遍分好的词（PreparedTokens），核对得上的块直接用
+        self.prepared = None
+        # 延迟高亮：frontier 之前的块已经按顺序高亮过，之后从没高亮过的块先跳过
+        self.lazy = False
+        self.frontier = 0
+        self.forced_block = -1
+        # 编辑事务期间什么也不做（块状态也不变），提交时再重排改动过的块
+        self.suspended = False
+
+    @classmethod
+    def formats_for(cls, language):
+        formats = cls.text_formats.get(language.name)
+        if formats is None:
+            formats = {name: text_format(style) for name, style in language.styles.items()}
+            cls.text_formats[language.name] = formats
+        return formats
 
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
-
-        # 关键字格式
-        keyword_format = QTextCharFormat()
-        keyword_format.setForeground(QColor("#0077CC"))
-        keyword_format.setFontWeight(QFont.Bold)
-
-        cpp_keywords = [
-            'alignas', 'alignof', 'and', 'and_eq', 'asm', 'auto',
-            'bitand', 'bitor', 'bool', 'break', 'case', 'catch',
-            'char', 'char8_t', 'char16_t', 'char32_t', 'class',
-            'compl', 'concept', 'const', 'consteval', 'constexpr',
-            'const_cast', 'continue', 'co_await', 'co_return',
-            'co_yield', 'decltype', 'default', 'delete', 'do',
-            'double', 'dynamic_cast', 'else', 'enum', 'explicit',
-            'export', 'extern', 'false', 'float', 'for', 'friend',
-            'goto', 'if', 'inline', 'int', 'long', 'mutable',
-            'namespace', 'new', 'noexcept', 'not', 'not_eq',
-            'nullptr', 'operator', 'or', 'or_eq', 'private',
-            'protected', 'public', 'register', 'reinterpret_cast',
-            'requires', 'return', 'short', 'signed', 'sizeof',
-            'static', 'static_assert', 'static_cast', 'struct',
-            'switch', 'template', 'this', 'thread_local', 'throw',
-            'true', 'try', 'typedef', 'typeid', 'typename',
-            'union', 'unsigned', 'using', 'virtual', 'void',
-            'volatile', 'wchar_t', 'while', 'xor', 'xor_eq'
-        ]
-
-        for word in cpp_keywords:
-            pattern = r'\b' + word + r'\b'
-            self.highlighting_rules.append((pattern, keyword_format))
-
-        # 预处理器格式
-        preprocessor_format = QTextCharFormat()
-        preprocessor_format.setForeground(QColor("#AA00AA"))
-        self.highlighting_rules.append((r'^#.*$', preprocessor_format))
-
-        # 字符串格式
-        string_format = QTextCharFormat()
-        string_format.setForeground(QColor("#22AA22"))
-        self.highlighting_rules.append((r'".*?"', string_format))
-
-        # 注释格式
-        comment_format = QTextCharFormat()
-        comment_format.setForeground(QColor("#888888"))
-        comment_format.setFontItalic(True)
-        self.highlighting_rules.extend([
-            (r'//.*$', comment_format),
-            (r'/\*.*?\*/', comment_format)
-        ])
-
-class HtmlHighlighter(Highlighter):
-    """HTML 语法高亮"""
+    def highlightBlock(self, text):
+        if self.suspended:
+            return
+        if self.lazy and self.currentBlockState() == -1:
+            number = self.currentBlock().blockNumber()
+            if number >= self.frontier and number != self.forced_block:
+                return
+        offsets = utf16_offsets(text)
+        state = max(self.previousBlockState(), 0)
+        if self.prepared is not None:
+            prepared = self.prepared.lookup(self.currentBlock().blockNumber(), state, text)
+            if prepared is not None:
+                self.apply_prepared(offsets, *prepared)
+                return
+        formats = self.formats
+        tokens, state = self.tokenizer.tokens(text, state)
+        for start, length, style, _ in tokens:
+            fmt = formats.get(style)
+            if fmt is None:
+                continue
+            if offsets:
+                start, length = offsets[start], offsets[start + length] - offsets[start]
+            self.setFormat(start, length, fmt)
+        self.setCurrentBlockState(state)
+
+    def apply_prepared(self, offsets, tokens, state):
+        """tokens 是 (开始, 长度, 样式序号) 依次排开的整数数组"""
+        style_formats = self.style_formats
+        for index in range(0, len(tokens), 3):
+            fmt = style_formats[tokens[index + 2]]
+            if fmt is None:
+                continue
+            start, length = tokens[index], tokens[index + 1]
+            if offsets:
+                start, length = offsets[start], offsets[start + length] - offsets[start]
+            self.setFormat(start, length, fmt)
+        self.setCurrentBlockState(state)
+
+class TimedExpression:
+    """包一层组合正则，把每次 search 的耗时记到匹配到的那条规则名下"""
+
+    def __init__(self, expression, rule_names, no_match):
+        self.expression = expression
+        self.rule_names = rule_names
+        self.no_match = no_match
+
+    def search(self, text, position):
+        start = time.perf_counter_ns()
+        match = self.expression.search(text, position)
+        name = self.rule_names[match.lastgroup] if match else self.no_match
+        instrument.record(name, start, time.perf_counter_ns(), 'highlight.rule')
+        return match
+
+class TracedHighlighter(Highlighter):
+    """打开埋点时用的高亮器：记录每块、每条规则的耗时"""
+
+    def __init__(self, parent, language):
+        super().__init__(parent, language)
+        prefix = f'highlight.rule.{language.name}.'
+        rule_names = {name: prefix + (style or name) for name, style in language.group_styles.items()}
+        rule_names.update({name: prefix + 'multiline' for name in language.multiline_groups})
+        # 最后一次没匹配上的 search 扫完了行尾，单独记一项
+        self.tokenizer.expression = TimedExpression(self.tokenizer.expression, rule_names, prefix + 'no_match')
+        self.block_name = f'highlight.{language.name}'
+
+    def highlightBlock(self, text):
+        start = time.perf_counter_ns()
+        super().highlightBlock(text)
+        instrument.record(self.block_name, start, time.perf_counter_ns(), 'highlight')
+
+def text_format(style):
+    """语言文件里的样式（color、bold、italic、family）转成 QTextCharFormat"""
+    fmt = QTextCharFormat()
+    if 'color' in style:
+        fmt.setForeground(QColor(style['color']))
+    if style.get('bold'):
+        fmt.setFontWeight(QFont.Bold)
+    if style.get('italic'):
+        fmt.setFontItalic(True)
+    if 'family' in style:
+        fmt.setFontFamily(style['family'])
+    return fmt
+
+ASTRAL_CHARACTER = re.compile('[\U00010000-\U0010FFFF]')
+SURROGATE = re.compile('[\uD800-\uDFFF]')
+
+def utf16_offsets(text):
+    """QTextBlock 按 UTF-16 计位置；行里有 BMP 以外的字符时返回下标换算表"""
+    if text.isascii() or not ASTRAL_CHARACTER.search(text):
+        return None
+    offsets = [0]
+    for char in text:
+        offsets.append(offsets[-1] + (2 if ord(char) > 0xFFFF else 1))
+    return offsets
+
+def surrogate_pair(match):
+    code = ord(match.group()) - 0x10000
+    return chr(0xD800 + (code >> 10)) + chr(0xDC00 + (code & 0x3FF))
+
+def split_surrogates(text):
+    """把 BMP 以外的字符拆成 UTF-16 代理对，让字符串下标和 Qt 文档的位置一致"""
+    if text.isascii() or not ASTRAL_CHARACTER.search(text):
+        return text
+    return ASTRAL_CHARACTER.sub(surrogate_pair, text)
+
+def join_surrogates(chunks):
+    """split_surrogates 的反过程，处理一对代理被切在两段之间的情况"""
+    pending = ''
+    for chunk in chunks:
+        chunk = pending + chunk
+        pending = ''
+        if SURROGATE.search(chunk):
+            if '\uD800' <= chunk[-1] <= '\uDBFF':
+                pending = chunk[-1]
+                chunk = chunk[:-1]
+            chunk = chunk.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'surrogatepass')
+        yield chunk
+    if pending:
+        yield pending
+
+class LazyHighlighter(QtCore.QObject):
+    """大文档的延迟高亮
+
+    先高亮视口里的块，其余的块由 0 间隔的 QTimer 在空闲时按顺序推进
+    frontier，每次大约占用 LAZY_HIGHLIGHT_SLICE 秒。每次重绘（包括滚动）
+    之后都会先把视口里还没高亮的块补上，所以可见区域总是排在队首。
+
+    给了 texts（文档内容的文本块）时，同时用 ParallelTokenizer 在进程池里
+    并行分词；每一步先取出已经分好的段，这些块在界面线程里只剩设置格式，
+    还没分好的块照常自己分词，不用等。
+    """
+
+    def __init__(self, highlighter, text_edit, texts=None):
+        super().__init__(text_edit)
+        self.highlighter = highlighter
+        self.text_edit = text_edit
+        self.document = text_edit.document()
+        self.block_count = self.document.blockCount()
+        self.visible_pending = False
+        highlighter.lazy = True
+        highlighter.frontier = 0
+        self.parallel = None
+        if texts is not None:
+            self.parallel = ParallelTokenizer(highlighter.tokenizer.name, texts)
+            highlighter.prepared = PreparedTokens()
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.step)
+        self.document.contentsChange.connect(self.on_contents_change)
+        self.text_edit.updateRequest.connect(self.schedule_visible)
+
+    def start(self):
+        if self.parallel:
+            self.parallel.start()
+        self.schedule_visible()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.document.contentsChange.disconnect(self.on_contents_change)
+        self.text_edit.updateRequest.disconnect(self.schedule_visible)
+        self.highlighter.lazy = False
+        if self.parallel:
+            self.parallel.cancel()
+            self.parallel = None
+        self.highlighter.prepared = None
+
+    def schedule_visible(self, *args):
+        if not self.visible_pending:
+            self.visible_pending = True
+            QTimer.singleShot(0, self.highlight_visible)
+
+    def highlight_visible(self):
+        self.visible_pending = False
+        if not self.highlighter.lazy:
+            return
+        viewport = self.text_edit.viewport()
+        block = self.text_edit.cursorForPosition(QPoint(0, 0)).block()
+        last = self.text_edit.cursorForPosition(QPoint(0, viewport.height())).block()
+        while block.isValid():
+            if block.userState() == -1:
+                self.highlighter.forced_block = block.blockNumber()
+                self.highlighter.rehighlightBlock(block)
+            if block == last:
+                break
+            block = block.next()
+        self.highlighter.forced_block = -1
+
+    def step(self):
+        with instrument.span('highlight.lazy_step', 'highlight'):
+            self.advance()
+
+    def collect(self):
+        """取出协调线程已经接好的段，丢掉已经高亮过的"""
+        prepared = self.highlighter.prepared
+        while self.parallel:
+            try:
+                chunk = self.parallel.results.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                if self.parallel.error:
+                    print(self.parallel.error)
+                self.parallel = None
+                break
+            prepared.add(chunk)
+        prepared.discard_before(self.highlighter.frontier)
+
+    def advance(self):
+        deadline = time.perf_counter() + LAZY_HIGHLIGHT_SLICE
+        if self.highlighter.prepared is not None:
+            self.collect()
+        block = self.document.findBlockByNumber(self.highlighter.frontier)
+        while block.isValid():
+            # 先把 frontier 挪到这一段的末尾：没高亮过的块状态从 -1 变成别的值，
+            # QSyntaxHighlighter 会一路级联下去，一次 rehighlightBlock 就能处理整段
+            end = block.blockNumber() + LAZY_HIGHLIGHT_CHUNK
+            self.highlighter.frontier = end
+            while block.isValid() and block.blockNumber() < end:
+                if block.userState() == -1:
+                    self.highlighter.rehighlightBlock(block)
+                block = block.next()
+            if time.perf_counter() >= deadline:
+                return
+        self.stop()
+
+    def on_contents_change(self, position, chars_removed, chars_added):
+        # frontier 之前增删了行时，把 frontier 跟着平移，保证它指向的还是同一块
+        block_count = self.document.blockCount()
+        delta = block_count - self.block_count
+        self.block_count = block_count
+        if delta and self.document.findBlock(position).blockNumber() < self.highlighter.frontier:
+            self.highlighter.frontier = max(0, self.highlighter.frontier + delta)
+
+class EditTransaction:
+    """一组编辑算一步撤销，期间暂停高亮和修改标记的通知，提交时只重新高亮改动过的块
+
+        with main_window.edit_transaction() as edit:
+            edit.replace(start, end, text)
+            edit.insert(position, text)
+            edit.apply(lambda cursor: ...)
+
+    位置按文档的 UTF-16 单位。整组在 piece table 的撤销历史里是一个组
+    （begin_group/end_group），所以只有一步撤销；每一步各开一个编辑块，
+    仍然各自发出 contentsChange，只报告自己改的那一段，不会合成一个从第一
+    处改动到最后一处改动的大范围。piece table 和查找索引照常增量同步，这里
+    只用 QTextCursor 记下改动的范围，后面的编辑会自动平移它们。
+
+    期间高亮器不处理任何块，也不会因为中间状态一遍遍地往后级联；提交时把
+    这些范围里的块标成 UNHIGHLIGHTED，对每段的第一块 rehighlightBlock 一次，
+    QSyntaxHighlighter 会一路处理完整段，状态有变化时再往后级联。嵌套使用
+    时算同一个事务，最外层结束时提交。
+    """
+
+    # 提交时标记要重排的块；和任何真实状态（包括表示没高亮过的 -1）都不同，所以整段都会级联到
+    UNHIGHLIGHTED = -2
+    # 离上一段改动不到这么多字符的改动并进同一段：文档每改一次 Qt 都要平移所有光标，
+    # 全部替换成千上万处时不能每处留一个
+    MERGE_DISTANCE = 4096
+
+    def __init__(self, main_window):
+        self.main_window = main_window
+        self.document = main_window.text_edit.document()
+        self.cursor = QTextCursor(self.document)
+        self.depth = 0
+        self.ranges = []
+        # 开始时的 piece table；事务期间整篇重建了镜像也要在它上面结束这一组
+        self.piece_table = None
+
+    def __enter__(self):
+        if self.depth == 0:
+            if self.main_window.highlighter:
+                self.main_window.highlighter.suspended = True
+            self.piece_table = self.main_window.piece_table
+            self.piece_table.begin_group()
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            self.commit()
+        return False
+
+    def apply(self, function):
+        """在一个编辑块里执行 function(cursor)，返回它的结果"""
+        self.cursor.beginEditBlock()
+        try:
+            return function(self.cursor)
+        finally:
+            self.cursor.endEditBlock()
+
+    def replace(self, start, end, text):
+        """把 [start, end) 换成 text，返回插入之后的位置"""
+        def edit(cursor):
+            cursor.setPosition(start)
+            cursor.setPosition(end, QTextCursor.KeepAnchor)
+            cursor.insertText(text)
+            return cursor.position()
+        return self.apply(edit)
+
+    def insert(self, position, text):
+        return self.replace(position, position, text)
+
+    def remove(self, start, end):
+        return self.replace(start, end, '')
+
+    def record(self, start, end):
+        """MainGui.on_contents_change 报告的一次改动，[start, end) 是改动后的位置"""
+        if self.ranges:
+            cursor = self.ranges[-1]
+            low, high = cursor.selectionStart(), cursor.selectionEnd()
+            if start - self.MERGE_DISTANCE <= high and low - self.MERGE_DISTANCE <= end:
+                cursor.setPosition(min(low, start))
+                cursor.setPosition(max(high, end), QTextCursor.KeepAnchor)
+                return
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(start)
+        cursor.setPosition(end, QTextCursor.KeepAnchor)
+        self.ranges.append(cursor)
+
+    def commit(self):
+        main_window = self.main_window
+        main_window.transaction = None
+        self.piece_table.end_group()
+        self.piece_table = None
+        highlighter = main_window.highlighter
+        # 事务期间换了高亮器（比如另存为换了语言）时，新的那个已经整篇重排过了
+        if highlighter and highlighter.suspended:
+            highlighter.suspended = False
+            with instrument.span('edit.rehighlight', 'highlight'):
+                self.rehighlight(highlighter)
+        self.ranges = []
+        main_window.update_modified()
+
+    def rehighlight(self, highlighter):
+        document = self.document
+        last_position = document.characterCount() - 1
+        first_blocks = []
+        for start, end in sorted((cursor.selectionStart(), cursor.selectionEnd()) for cursor in self.ranges):
+            block = document.findBlock(min(start, last_position))
+            last = document.findBlock(min(end, last_position))
+            first_blocks.append(block)
+            while block.isValid():
+                block.setUserState(self.UNHIGHLIGHTED)
+                if block == last:
+                    break
+                block = block.next()
+        for block in first_blocks:
+            # 前一段往后级联时可能已经处理过这一段了
+            if block.userState() == self.UNHIGHLIGHTED:
+                highlighter.rehighlightBlock(block)
+
+class TranslucentTextEdit(QPlainTextEdit):
+    """半透明效果的编辑器：背景图和白色蒙版预先混合成一张图缓存起来
+
+    视口设成不透明，Qt 就不会每次重绘都把窗口背景的 QLabel 在下面再合成
+    一遍；重绘时只把缓存图上受损的那一块画上去，按键的绘制开销与窗口大小
+    无关。只有视口大小或背景图变化时才重新混合。
+    """
+
+    TINT = QColor(255, 255, 255, 178)
+
+    # 补全列表打开时交给它处理的按键（选中、关闭）
+    COMPLETER_KEYS = {Qt.Key_Enter, Qt.Key_Return, Qt.Key_Escape, Qt.Key_Tab, Qt.Key_Backtab}
+
+    # 撤销、重做由 MainGui 按 piece table 的撤销历史来做，文档自己不记撤销
+    undo_requested = QtCore.pyqtSignal()
+    redo_requested = QtCore.pyqtSignal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
+        # 单词补全（WordCompleter），由 MainGui 设置
+        self.completer = None
+        # 右键菜单里撤销、重做是否可用，由 MainGui 设置
+        self.can_undo = lambda: False
+        self.can_redo = lambda: False
+        self.background = None
+        self.background_color = QColor('#2c3e50')
+        self.blended = None
+        # 埋点打开时记录按键到下一次绘制完成的延迟
+        self.key_time = None
+        self.viewport().setAttribute(Qt.WA_OpaquePaintEvent)
+
+    def set_background(self, pixmap=None, color=None):
+        """窗口背景变了（缩放、换图）时调用，pixmap 与窗口一样大"""
+        self.background = pixmap
+        if color is not None:
+            self.background_color = color
+        self.blended = None
+        self.viewport().update()
+
+    def blended_background(self):
+        if self.blended is None:
+            viewport = self.viewport()
+            ratio = viewport.devicePixelRatioF()
+            blended = QPixmap(viewport.size() * ratio)
+            blended.setDevicePixelRatio(ratio)
+            blended.fill(self.background_color)
+            painter = QPainter(blended)
+            if self.background and not self.background.isNull():
+                origin = viewport.mapTo(self.window(), QPoint(0, 0))
+                painter.drawPixmap(0, 0, self.background, origin.x(), origin.y(),
+                                   viewport.width(), viewport.height())
+            painter.fillRect(viewport.rect(), self.TINT)
+            painter.end()
+            self.blended = blended
+        return self.blended
+
+    def paintEvent(self, event):
+        with instrument.span('paint', 'paint'):
+            painter = QPainter(self.viewport())
+            rect = event.rect()
+            painter.drawPixmap(rect, self.blended_background(), rect)
+            painter.end()
+            super().paintEvent(event)
+        if self.key_time is not None:
+            instrument.record('keystroke_to_paint', self.key_time, time.perf_counter_ns(), 'paint')
+            self.key_time = None
+
+    def keyPressEvent(self, event):
+        completer = self.completer
+        if completer and completer.popup().isVisible() and event.key() in self.COMPLETER_KEYS:
+            event.ignore()
+            return
+        if event.key() == Qt.Key_Space and event.modifiers() == Qt.ControlModifier:
+            if completer:
+                completer.refresh()
+            return
+        if event.matches(QKeySequence.Undo):
+            self.undo_requested.emit()
+            return
+        if event.matches(QKeySequence.Redo):
+            self.redo_requested.emit()
+            return
+        if not instrument.enabled:
+            super().keyPressEvent(event)
+        else:
+            if self.key_time is None:
+                self.key_time = time.perf_counter_ns()
+            # 包括文档修改、重新排版和高亮
+            with instrument.span('edit.key', 'edit'):
+                super().keyPressEvent(event)
+        if completer and completer.popup().isVisible():
+            # 列表打开时随输入更新，前面不再是单词时关掉
+            completer.refresh()
+
+    def contextMenuEvent(self, event):
+        menu = self.createStandardContextMenu(event.pos())
+        # 标准菜单的撤销、重做连着文档自己的撤销栈，改接到我们的信号上
+        for action in menu.actions():
+            if action.objectName() == 'edit-undo':
+                action.triggered.disconnect()
+                action.triggered.connect(self.undo_requested.emit)
+                action.setEnabled(self.can_undo() and not self.isReadOnly())
+            elif action.objectName() == 'edit-redo':
+                action.triggered.disconnect()
+                action.triggered.connect(self.redo_requested.emit)
+                action.setEnabled(self.can_redo() and not self.isReadOnly())
+        menu.exec_(event.globalPos())
+        menu.deleteLater()
 
-        # 标签格式
-        tag_format = QTextCharFormat()
-        tag_format.setForeground(QColor("#0077CC"))
-        self.highlighting_rules.append((r'<\/?\w+[^>]*>', tag_format))
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.blended = None
+
+    def scrollContentsBy(self, dx, dy):
+        # 滚动时 Qt 会把视口内容整块平移，背景是固定的，所以要整个重画
+        super().scrollContentsBy(dx, dy)
+        self.viewport().update()
+
+class WordCompleter(QCompleter):
+    """单词补全的弹出列表：Ctrl+Space 打开，打开时随输入更新
+
+    候选词来自 MainGui 的单词索引（WordIndex），每次只取前缀后面的几十个，
+    和文档大小无关。位置、单词都按 piece table 的 UTF-16 单位算。
+    """
+
+    # 光标前正在输入的单词，不从数字中间开始
+    WORD_BEFORE = re.compile(r'(?<!\w)[^\W\d]\w*$')
+
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.model = QStringListModel(self)
+        self.setModel(self.model)
+        self.setWidget(main_window.text_edit)
+        self.setCaseSensitivity(Qt.CaseSensitive)
+        self.setModelSorting(QCompleter.CaseSensitivelySortedModel)
+        # 要被换掉的前缀的开始位置
+        self.start = 0
+        self.activated[str].connect(self.insert)
+
+    def refresh(self):
+        text_edit = self.widget()
+        cursor = text_edit.textCursor()
+        match = None
+        if not cursor.hasSelection() and not text_edit.isReadOnly():
+            before = split_surrogates(cursor.block().text())[:cursor.positionInBlock()]
+            match = self.WORD_BEFORE.search(before)
+        words = self.main_window.complete_word(match.group()) if match else []
+        if not words:
+            self.popup().hide()
+            return
+        prefix = match.group()
+        self.start = cursor.position() - len(prefix)
+        with instrument.span('complete.popup', 'edit'):
+            self.model.setStringList([''.join(join_surrogates([word])) for word in words])
+            self.setCompletionPrefix(''.join(join_surrogates([prefix])))
+            popup = self.popup()
+            popup.setCurrentIndex(self.completionModel().index(0, 0))
+            rect = text_edit.cursorRect()
+            rect.setWidth(popup.sizeHintForColumn(0) + popup.verticalScrollBar().sizeHint().width())
+            self.complete(rect)
+
+    def insert(self, word):
+        # 一次替换：piece table 里是一步撤销
+        cursor = self.widget().textCursor()
+        cursor.setPosition(self.start, QTextCursor.KeepAnchor)
+        cursor.insertText(word)
+        self.widget().setTextCursor(cursor)
+
+class InstrumentHud(QLabel):
+    """埋点打开时叠在窗口右上角的耗时摘要，每半秒刷新一次"""
 
-        # 属性名格式
-        attr_name_format = QTextCharFormat()
-        attr_name_format.setForeground(QColor("#9944CC"))
-        self.highlighting_rules.append((r'\b(\w+)=', attr_name_format))
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFont(QFont("Consolas", 9))
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: #E0E0E0; padding: 4px;")
+        self.timer = QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+
+    def refresh(self):
+        lines = [f"{'name':36} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}"]
+        for name, stats in instrument.summary(12):
+            lines.append(f"{name[-36:]:36} {stats['count']:7} {stats['p50_us'] / 1000:8.2f} {stats['p99_us'] / 1000:8.2f}")
+        for name, values in instrument.counter_values().items():
+            lines.append(f"{name}: " + ' '.join(
+                f"{key}={value:.0%}" if isinstance(value, float) else f"{key}={value}" for key, value in values.items()
+            ))
+        self.setText('\n'.join(lines))
+        self.adjustSize()
+        parent = self.parentWidget()
+        if parent:
+            self.move(parent.width() - self.width() - 8, 8)
+        self.raise_()
+
+class FindBar(QWidget):
+    """编辑器下方的查找/替换栏：边输入边搜，只给视口里的匹配上色
+
+    匹配位置由 MatchIndex 在 piece table 上维护（UTF-16 位置，和文档一致），
+    文档改动时按 contentsChange 增量更新；全部替换是一次编辑、一步撤销。
+    """
+
+    MATCH_COLOR = QColor(255, 230, 120)
+    CURRENT_COLOR = QColor(255, 160, 60)
+
+    def __init__(self, main_window):
+        super().__init__()
+        self.main_window = main_window
+        self.text_edit = main_window.text_edit
+        self.index = MatchIndex()
+        # 开始查找时光标的位置，边输入边搜时从这里往后找第一个匹配
+        self.anchor = 0
+        self.current = -1
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 2, 4, 2)
+        self.query = QLineEdit()
+        self.query.setPlaceholderText("find")
+        self.replacement = QLineEdit()
+        self.replacement.setPlaceholderText("replace")
+        self.regex = QCheckBox("regex")
+        self.case_sensitive = QCheckBox("case")
+        self.case_sensitive.setChecked(True)
+        self.status = QLabel()
+        self.status.setMinimumWidth(90)
+        previous_button = QPushButton("prev")
+        next_button = QPushButton("next")
+        replace_button = QPushButton("replace")
+        replace_all_button = QPushButton("all")
+        for widget in (self.query, self.regex, self.case_sensitive, self.status, previous_button, next_button,
+                       self.replacement, replace_button, replace_all_button):
+            layout.addWidget(widget)
+        self.setStyleSheet("FindBar { background-color: rgba(255, 255, 255, 0.6); }")
+        self.setAttribute(Qt.WA_StyledBackground)
+        # 滚动时只在事件循环空下来后重新给可见的匹配上色一次
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(0)
+        self.refresh_timer.timeout.connect(self.refresh_highlights)
+        self.query.textChanged.connect(self.search)
+        self.regex.toggled.connect(self.search)
+        self.case_sensitive.toggled.connect(self.search)
+        self.query.returnPressed.connect(self.find_next)
+        self.replacement.returnPressed.connect(self.replace_current)
+        previous_button.clicked.connect(self.find_previous)
+        next_button.clicked.connect(self.find_next)
+        replace_button.clicked.connect(self.replace_current)
+        replace_all_button.clicked.connect(self.replace_all)
+        previous_shortcut = QShortcut(QKeySequence("Shift+Return"), self)
+        previous_shortcut.setContext(Qt.WidgetWithChildrenShortcut)
+        previous_shortcut.activated.connect(self.find_previous)
+        close_shortcut = QShortcut(QKeySequence("Escape"), self)
+        close_shortcut.setContext(Qt.WidgetWithChildrenShortcut)
+        close_shortcut.activated.connect(self.close_bar)
+        self.text_edit.verticalScrollBar().valueChanged.connect(self.refresh_timer.start)
+
+    def open_bar(self, replace=False):
+        cursor = self.text_edit.textCursor()
+        self.anchor = cursor.selectionStart()
+        selected = cursor.selectedText()
+        self.show()
+        if selected and '\u2029' not in selected:
+            # 选中的文本直接作为查询；和当前查询一样时 textChanged 不会触发，要自己搜
+            if selected == self.query.text():
+                self.search()
+            self.query.setText(selected)
+        else:
+            self.search()
+        field = self.replacement if replace else self.query
+        field.setFocus()
+        field.selectAll()
+
+    def close_bar(self):
+        self.hide()
+        self.index.clear()
+        self.current = -1
+        self.text_edit.setExtraSelections([])
+        self.text_edit.setFocus()
+
+    def search(self):
+        if not self.isVisible():
+            return
+        try:
+            self.index.search(self.main_window.piece_table, split_surrogates(self.query.text()),
+                              self.regex.isChecked(), self.case_sensitive.isChecked())
+        except re.error as e:
+            self.index.clear()
+            self.current = -1
+            self.status.setText("bad regex")
+            self.status.setToolTip(str(e))
+            self.refresh_highlights()
+            return
+        self.status.setToolTip("")
+        self.select_from(self.anchor)
+
+    def select_from(self, position, backwards=False):
+        count = len(self.index)
+        if not count:
+            self.current = -1
+            self.status.setText("no matches" if self.query.text() else "")
+            self.refresh_highlights()
+            return
+        index = self.index.first_starting_at(position)
+        if backwards:
+            index -= 1
+        self.select(index % count)
+
+    def select(self, index):
+        self.current = index
+        start, end = self.index.span(index)
+        cursor = QTextCursor(self.text_edit.document())
+        cursor.setPosition(start)
+        cursor.setPosition(end, QTextCursor.KeepAnchor)
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.ensureCursorVisible()
+        self.status.setText(f"{index + 1} of {len(self.index)}")
+        self.refresh_highlights()
+
+    def find_next(self):
+        cursor = self.text_edit.textCursor()
+        position = cursor.selectionStart() + 1 if cursor.hasSelection() else cursor.position()
+        self.select_from(position)
+        self.anchor = self.text_edit.textCursor().selectionStart()
+
+    def find_previous(self):
+        self.select_from(self.text_edit.textCursor().selectionStart(), backwards=True)
+        self.anchor = self.text_edit.textCursor().selectionStart()
+
+    def current_match(self):
+        """选区正好是一个匹配时返回它的序号"""
+        cursor = self.text_edit.textCursor()
+        if not cursor.hasSelection():
+            return None
+        index = self.index.first_starting_at(cursor.selectionStart())
+        if index < len(self.index) and self.index.span(index) == (cursor.selectionStart(), cursor.selectionEnd()):
+            return index
+        return None
+
+    def replace_current(self):
+        index = self.current_match()
+        if index is None:
+            self.find_next()
+            return
+        try:
+            text = self.index.replacement(index, split_surrogates(self.replacement.text()))
+        except re.error as e:
+            self.bad_replacement(e)
+            return
+        cursor = self.text_edit.textCursor()
+        cursor.insertText(''.join(join_surrogates([text])))
+        self.select_from(cursor.position())
+
+    def replace_all(self):
+        try:
+            result = self.index.replace_all(split_surrogates(self.replacement.text()))
+        except re.error as e:
+            self.bad_replacement(e)
+            return
+        if result is None:
+            return
+        # 逐个替换匹配到的地方：一步撤销，提交时只重新高亮这些地方，其余内容不动
+        delta = 0
+        with self.main_window.edit_transaction() as edit:
+            for start, end, text in result:
+                position = edit.replace(start + delta, end + delta, ''.join(join_surrogates([text])))
+                delta += len(text) - (end - start)
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(position)
+        self.text_edit.setTextCursor(cursor)
+        self.current = -1
+        self.status.setText(f"replaced {len(result)}")
+        self.refresh_highlights()
+
+    def bad_replacement(self, error):
+        # 和写错的查找正则一样只显示在状态里，文档不动
+        self.status.setText("bad replacement")
+        self.status.setToolTip(str(error))
+
+    def on_contents_change(self, position, removed, added):
+        """piece table 已经同步了这次改动"""
+        if self.index.expression is None:
+            return
+        self.index.update(self.main_window.piece_table, position, removed, added)
+        self.current = -1
+        self.status.setText(f"{len(self.index)} matches")
+        self.refresh_timer.start()
+
+    def refresh_highlights(self):
+        if not self.isVisible() or not len(self.index):
+            self.text_edit.setExtraSelections([])
+            return
+        viewport = self.text_edit.viewport()
+        start = self.text_edit.firstVisibleBlock().position()
+        last = self.text_edit.cursorForPosition(QPoint(viewport.width(), viewport.height())).block()
+        end = last.position() + last.length()
+        current = self.index.span(self.current) if 0 <= self.current < len(self.index) else None
+        selections = []
+        for span in self.index.spans_between(start, end):
+            selection = QTextEdit.ExtraSelection()
+            selection.format.setBackground(self.CURRENT_COLOR if span == current else self.MATCH_COLOR)
+            selection.cursor = QTextCursor(self.text_edit.document())
+            selection.cursor.setPosition(span[0])
+            selection.cursor.setPosition(span[1], QTextCursor.KeepAnchor)
+            selections.append(selection)
+        self.text_edit.setExtraSelections(selections)
+
+class FindInFilesPanel(QWidget):
+    """在打开的文件夹里查找：边输入边搜，结果随搜索进度出现，双击跳到对应行"""
+
+    def __init__(self, main_window):
+        super().__init__(main_window, Qt.Tool)
+        self.main_window = main_window
+        self.folder = None
+        self.search = None
+        # 多次搜索共用，同一个查询再搜时没变的文件直接用上次的结果
+        self.cache = SearchCache()
+        self.match_count = 0
+        self.setWindowTitle("find in folder")
+        self.resize(640, 420)
+        layout = QVBoxLayout(self)
+        options = QHBoxLayout()
+        self.query = QLineEdit()
+        self.regex = QCheckBox("regex")
+        self.case_sensitive = QCheckBox("case")
+        self.case_sensitive.setChecked(True)
+        options.addWidget(self.query)
+        options.addWidget(self.regex)
+        options.addWidget(self.case_sensitive)
+        layout.addLayout(options)
+        self.results = QListWidget()
+        self.results.setFont(QFont("Consolas", 10))
+        self.results.setUniformItemSizes(True)
+        layout.addWidget(self.results)
+        self.status = QLabel()
+        layout.addWidget(self.status)
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(FIND_DEBOUNCE)
+        self.debounce_timer.timeout.connect(self.start_search)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(10)
+        self.poll_timer.timeout.connect(self.poll)
+        self.query.textChanged.connect(self.debounce_timer.start)
+        self.query.returnPressed.connect(self.start_search)
+        self.regex.toggled.connect(self.debounce_timer.start)
+        self.case_sensitive.toggled.connect(self.debounce_timer.start)
+        self.results.itemActivated.connect(self.on_result_activated)
+
+    def show_for(self, folder):
+        if folder != self.folder:
+            self.folder = folder
+            self.start_search()
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        self.query.setFocus()
+        self.query.selectAll()
+
+    def start_search(self):
+        self.debounce_timer.stop()
+        self.stop_search()
+        self.results.clear()
+        self.match_count = 0
+        query = self.query.text()
+        if not query or not self.folder:
+            self.status.clear()
+            return
+        self.search = FileSearch(
+            self.folder, query, self.regex.isChecked(), self.case_sensitive.isChecked(), self.cache
+        )
+        self.search.start()
+        self.status.setText("searching...")
+        self.poll_timer.start()
+
+    def stop_search(self):
+        if self.search:
+            self.search.cancel()
+            self.search = None
+        self.poll_timer.stop()
+
+    def poll(self):
+        deadline = time.perf_counter() + FIND_SLICE
+        while time.perf_counter() < deadline:
+            try:
+                result = self.search.results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.finish_search()
+                return
+            path, matches = result
+            relative_path = os.path.relpath(path, self.folder)
+            for line, column, text in matches:
+                self.match_count += 1
+                if self.match_count > FIND_MAX_RESULTS:
+                    continue
+                item = QListWidgetItem(f"{relative_path}:{line + 1}: {text.strip()}")
+                item.setData(Qt.UserRole, (path, line))
+                self.results.addItem(item)
+        self.status.setText(f"searching... {self.match_count} matches in {self.search.files_matched} files")
+
+    def finish_search(self):
+        search = self.search
+        self.stop_search()
+        if search.error:
+            self.status.setText(f"error: {search.error}")
+            return
+        shown = '' if self.match_count <= FIND_MAX_RESULTS else f" (showing {FIND_MAX_RESULTS})"
+        self.status.setText(
+            f"{self.match_count} matches in {search.files_matched} of {search.files_searched} files{shown}"
+        )
 
-        # 属性值格式
-        attr_value_format = QTextCharFormat()
-        attr_value_format.setForeground(QColor("#22AA22"))
-        self.highlighting_rules.append((r'"[^"]*"', attr_value_format))
+    def on_result_activated(self, item):
+        path, line = item.data(Qt.UserRole)
+        self.main_window.open_at(path, line)
 
-        # 注释格式
-        comment_format = QTextCharFormat()
-        comment_format.setForeground(QColor("#888888"))
-        comment_format.setFontItalic(True)
-        self.highlighting_rules.append((r'<!--.*?-->', comment_format))
+    def closeEvent(self, event):
+        self.stop_search()
+        super().closeEvent(event)
 
-class MarkdownHighlighter(Highlighter):
-    """Markdown 语法高亮"""
+class LargeFileViewer(QWidget):
+    """只读的大文件查看器，只解码、绘制视口里的那几行"""
 
-    def __init__(self, parent=None):
+    def __init__(self, large_file, parent=None):
         super().__init__(parent)
-        self.init_formats()
-
-    def init_formats(self):
-        """初始化高亮格式"""
-
-        # 标题格式
-        header_format = QTextCharFormat()
-        header_format.setForeground(QColor("#0077CC"))
-        header_format.setFontWeight(QFont.Bold)
-        self.highlighting_rules.extend([
-            (r'^#{1,6}\s.*$', header_format),
-            (r'^=+$', header_format),
-            (r'^-+$', header_format)
-        ])
-
-        # 粗体格式
-        bold_format = QTextCharFormat()
-        bold_format.setFontWeight(QFont.Bold)
-        self.highlighting_rules.extend([
-            (r'\*\*.*?\*\*', bold_format),
-            (r'__.*?__', bold_format)
-        ])
-
-        # 斜体格式
-        italic_format = QTextCharFormat()
-        italic_format.setFontItalic(True)
-        self.highlighting_rules.extend([
-            (r'\*.*?\*', italic_format),
-            (r'_.*?_', italic_format)
-        ])
-
-        # 代码块格式
-        code_format = QTextCharFormat()
-        code_format.setForeground(QColor("#22AA22"))
-        code_format.setFontFamily("Consolas")
-        self.highlighting_rules.extend([
-            (r'`.*?`', code_format),
-            (r'^    .*$', code_format),
-            (r'^\t.*$', code_format)
-        ])
-
-        # 链接格式
-        link_format = QTextCharFormat()
-        link_format.setForeground(QColor("#AA5500"))
-        self.highlighting_rules.extend([
-            (r'\[.*?\]\(.*?\)', link_format),
-            (r'\[.*?\]:.*$', link_format)
-        ])
+        self.large_file = large_file
+        self.first_line = 0
+        self.setFont(QFont("Consolas", 11))
+        self.setFocusPolicy(Qt.StrongFocus)
+        # 索引还在后台建立时定时刷新，让末尾的内容随索引进度显示出来
+        self.index_timer = QTimer(self)
+        self.index_timer.setInterval(200)
+        self.index_timer.timeout.connect(self.on_index_progress)
+        self.index_timer.start()
+
+    def on_index_progress(self):
+        if self.large_file.indexed.is_set():
+            self.index_timer.stop()
+        self.update()
+
+    def visible_line_count(self):
+        return max(1, self.height() // self.fontMetrics().lineSpacing())
+
+    def scroll_to(self, line):
+        last = max(self.large_file.line_count() - self.visible_line_count(), 0)
+        self.first_line = min(max(line, 0), last)
+        self.update()
+
+    def jump(self):
+        """跳到指定行（如 1200）或指定百分比（如 50%）"""
+        target, ok = QInputDialog.getText(self, "go to", "line or percent (e.g. 1200 or 50%)")
+        if not ok:
+            return
+        target = target.strip()
+        try:
+            if target.endswith('%'):
+                line = self.large_file.line_at_fraction(float(target[:-1]) / 100)
+            else:
+                line = int(target) - 1
+        except ValueError:
+            return
+        self.scroll_to(line)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(255, 255, 255, 178))
+        metrics = self.fontMetrics()
+        spacing = metrics.lineSpacing()
+        y = metrics.ascent()
+        end = min(self.first_line + self.visible_line_count() + 1, self.large_file.line_count())
+        for number in range(self.first_line, end):
+            painter.drawText(4, y, self.large_file.line(number, LARGE_FILE_LINE_LIMIT))
+            y += spacing
+
+    def wheelEvent(self, event):
+        self.scroll_to(self.first_line - event.angleDelta().y() // 40)
+
+    def keyPressEvent(self, event):
+        page = self.visible_line_count()
+        moves = {
+            Qt.Key_Up: -1,
+            Qt.Key_Down: 1,
+            Qt.Key_PageUp: -page,
+            Qt.Key_PageDown: page,
+        }
+        if event.key() in moves:
+            self.scroll_to(self.first_line + moves[event.key()])
+        elif event.key() == Qt.Key_Home and event.modifiers() & Qt.ControlModifier:
+            self.scroll_to(0)
+        elif event.key() == Qt.Key_End and event.modifiers() & Qt.ControlModifier:
+            self.scroll_to(self.large_file.line_count())
+        elif event.key() == Qt.Key_G and event.modifiers() & Qt.ControlModifier:
+            self.jump()
+        else:
+            super().keyPressEvent(event)
 
 class MainGui(QMainWindow):
     def __init__(self):
         super().__init__()
         self.highlighter = None
+        self.lazy_highlighter = None
+        # 正在进行的编辑事务，见 edit_transaction
+        self.transaction = None
+        # 正在把撤销、重做的结果同步到文档，这些改动 piece table 已经有了
+        self.applying_history = False
         self.background_label = None
         self.text_edit = None
+        self.editor_area = None
+        self.find_bar = None
+        self.document_area = None
+        self.tab_bar = None
+        # 当前标签页，它的状态就在下面这些属性里；切换时才打包进 Tab
+        self.active_tab = None
+        # 不活动的标签页，按最近使用排序，最久没用的在前
+        self.inactive_tabs = OrderedDict()
+        try:
+            budget = float(os.environ.get('ADORABLE_KATZE_TAB_BUDGET_MB', TAB_MEMORY_BUDGET_MB))
+        except ValueError:
+            budget = TAB_MEMORY_BUDGET_MB
+        self.tab_budget = int(budget * 1024 * 1024)
+        # 从磁盘重读的标签页读完后要恢复的 (光标, 滚动位置)
+        self.pending_view = None
+        # 只监视当前标签页的文件，切换标签页时检查一次
+        self.file_watcher = None
+        self.watch_timer = None
+        # 背景原图，每次缩放都从它开始，不在上一次缩放的结果上反复缩放
         self.background_pixmap = None
+        self.background_cache = OrderedDict()
+        self.background_timer = None
+        self.reader = None
+        self.load_timer = None
+        self.load_progress = None
+        self.large_file = None
+        self.large_file_viewer = None
+        # 文档内容的 piece table 镜像（按 UTF-16 位置），保存时逐段写出
+        self.piece_table = PieceTable()
+        self.saver = None
+        self.saving_path = None
+        self.saving_snapshot = None
+        self.save_timer = None
+        # 崩溃恢复日志，位置和 piece table 一样按 UTF-16 计
+        self.journal = RecoveryJournal(None, 'utf-16')
+        self.journal_timer = None
+        # 当前文档的单词索引，文档改动时增量更新；整篇换掉时由后台的 WordCounter 重新统计
+        self.word_index = WordIndex()
+        self.word_counter = None
+        # 打开的文件夹里其他文件的单词，补全时合进来；ADORABLE_KATZE_FOLDER_COMPLETION=0 关掉
+        self.folder_completion = os.environ.get('ADORABLE_KATZE_FOLDER_COMPLETION', '1') != '0'
+        self.folder_words = WordIndex()
+        self.folder_word_counter = None
+        self.word_timer = None
+        self.completer = None
+        self.hud = None
+        self.folder_tree = None
+        self.folder_scanner = None
+        self.folder_items = {}
+        # 每个已展开目录里子节点的排序键，分批到达的结果按它插到正确位置
+        self.folder_keys = {}
+        self.folder_timer = None
+        self.folder_path = None
+        self.find_panel = None
+        # 文件读完后要跳到的行（从在文件夹里查找的结果打开时）
+        self.pending_line = None
         self.file_info = FileInfo()
-        self.language_map = {
-            '.py': 'Python',
-            '.pyw': 'Python',
-            '.java': 'Java',
-            '.js': 'JavaScript',
-            '.jsx': 'JavaScript',
-            '.cpp': 'C++',
-            '.cc': 'C++',
-            '.cxx': 'C++',
-            '.h': 'C++',
-            '.hpp': 'C++',
-            '.html': 'HTML',
-            '.htm': 'HTML',
-            '.md': 'Markdown',
-            '.markdown': 'Markdown',
-            '.txt': 'None'
-        }
-        self.highlighters = {
-            'Python': PythonHighlighter,
-            'Java': JavaHighlighter,
-            'JavaScript': JavaScriptHighlighter,
-            'C++': CppHighlighter,
-            'HTML': HtmlHighlighter,
-            'Markdown': MarkdownHighlighter,
-            'None': None
-        }
         self.init_ui()
+        QTimer.singleShot(0, self.offer_recovery)
 
     def init_ui(self):
         self.size_position()
@@ -397,7 +1178,24 @@ class MainGui(QMainWindow):
         self.setup_background()
         self.editor()
         self.setup_shortcuts()
-        self.text_edit.textChanged.connect(self.on_text_changed)
+        self.text_edit.document().contentsChange.connect(self.on_contents_change)
+        self.journal_timer = QTimer(self)
+        self.journal_timer.setInterval(JOURNAL_FLUSH_INTERVAL)
+        self.journal_timer.timeout.connect(self.flush_journal)
+        self.journal_timer.start()
+        self.word_timer = QTimer(self)
+        self.word_timer.setInterval(WORD_POLL_INTERVAL)
+        self.word_timer.timeout.connect(self.poll_word_counters)
+        self.file_watcher = QFileSystemWatcher(self)
+        self.file_watcher.fileChanged.connect(self.on_file_changed)
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(WATCH_DEBOUNCE)
+        self.watch_timer.timeout.connect(self.check_external_change)
+        self.active_tab = Tab(self.file_info, self.journal)
+        self.tab_bar.setTabData(self.tab_bar.addTab(self.active_tab.title()), self.active_tab)
+        if instrument.hud:
+            self.toggle_hud()
         self.highlight()
 
     def del_title(self):
@@ -411,80 +1209,165 @@ class MainGui(QMainWindow):
         self.move(qr.topLeft())
 
     def highlight(self):
+        document = self.text_edit.document()
+        if self.lazy_highlighter:
+            if self.highlighter.lazy:
+                self.lazy_highlighter.stop()
+            self.lazy_highlighter.deleteLater()
+            self.lazy_highlighter = None
         if self.highlighter:
             self.highlighter.setDocument(None)
+            # 高亮器的父对象是文档，不删掉的话每换一次文档就留下一个
+            self.highlighter.deleteLater()
             self.highlighter = None
+            # 清掉旧高亮器留下的块状态，延迟高亮靠 -1 判断哪些块还没处理
+            block = document.begin()
+            while block.isValid():
+                block.setUserState(-1)
+                block = block.next()
         language = self.change_language()
-        if language != "None" and language in self.highlighters:
-            highlighter_class = self.highlighters[language]
-            if highlighter_class:
-                self.highlighter = highlighter_class(self.text_edit.document())
+        if language:
+            highlighter_class = TracedHighlighter if instrument.enabled else Highlighter
+            self.highlighter = highlighter_class(document, language)
+            if document.blockCount() > LAZY_HIGHLIGHT_BLOCKS:
+                texts = None
+                if document.blockCount() > PARALLEL_HIGHLIGHT_BLOCKS and (os.cpu_count() or 1) > 1 and \
+                        self.piece_table.line_count() == document.blockCount():
+                    # 协调线程读的是 piece table 现在的快照，之后的编辑不影响它
+                    texts = join_surrogates(self.piece_table.chunks())
+                self.lazy_highlighter = LazyHighlighter(self.highlighter, self.text_edit, texts)
+                self.lazy_highlighter.start()
 
     def change_language(self):
+        """按文件名找语言，认不出来时看开头几 KB 里的 shebang 和 modeline"""
         file_path = self.file_info.get_absolute_file_path()
-        if not file_path:
-            return "None"
-
-        _, ext = os.path.splitext(file_path)  # 从完整文件路径获取扩展名
-        language = self.language_map.get(ext.lower(), "None")
-        return language
+        return registry.detect(file_path, self.piece_table.text(0, min(DETECT_SIZE, len(self.piece_table))))
 
     def setup_background(self):
         self.background_label = QLabel(self)
-        pixmap = QPixmap(r"./background.jpeg")
+        pixmap = QPixmap(BACKGROUND_PATH)
         if pixmap.isNull():
             self.background_label.setStyleSheet("background-color: #2c3e50;")
         else:
+            self.background_pixmap = pixmap
             self.background_label.setScaledContents(False)  # 重要：不要自动缩放
             self.background_label.setPixmap(pixmap)
         self.background_label.setGeometry(0, 0, self.width(), self.height())
         self.background_label.lower()
+        # 拖动缩放时先用快速缩放顶着，停下来之后再平滑缩放一次
+        self.background_timer = QTimer(self)
+        self.background_timer.setSingleShot(True)
+        self.background_timer.setInterval(BACKGROUND_DEBOUNCE)
+        self.background_timer.timeout.connect(self.update_background)
+
+    def scaled_background(self, width, height, transformation):
+        """把原图等比缩放到铺满 width x height，再居中裁掉多出来的部分"""
+        name = 'background.smooth' if transformation == Qt.SmoothTransformation else 'background.fast'
+        with instrument.span(name, 'resize', {'width': width, 'height': height}):
+            scaled_pixmap = self.background_pixmap.scaled(
+                width,
+                height,
+                Qt.KeepAspectRatioByExpanding,
+                transformation
+            )
 
-    def update_background(self):
-        if not self.background_label or not self.background_label.pixmap():
-            return
-        window_size = self.size()
-        if window_size.width() == 0 or window_size.height() == 0:
+        if scaled_pixmap.width() > width or scaled_pixmap.height() > height:
+            x = (scaled_pixmap.width() - width) // 2
+            y = (scaled_pixmap.height() - height) // 2
+            scaled_pixmap = scaled_pixmap.copy(x, y, width, height)
+        return scaled_pixmap
+
+    def update_background(self, smooth=True):
+        if not self.background_label or not self.background_pixmap:
             return
-        original_pixmap = self.background_label.pixmap()
-        if original_pixmap.isNull():
+        width, height = self.width(), self.height()
+        if width == 0 or height == 0:
             return
-        scaled_pixmap = original_pixmap.scaled(
-            window_size.width(),
-            window_size.height(),
-            Qt.KeepAspectRatioByExpanding,
-            Qt.SmoothTransformation
-        )
-
-        if (scaled_pixmap.width() > window_size.width() or
-                scaled_pixmap.height() > window_size.height()):
-            x = (scaled_pixmap.width() - window_size.width()) // 2
-            y = (scaled_pixmap.height() - window_size.height()) // 2
-            scaled_pixmap = scaled_pixmap.copy(
-                x, y, window_size.width(), window_size.height()
-            )
+        key = (width, height)
+        scaled_pixmap = self.background_cache.get(key)
+        if scaled_pixmap is not None:
+            self.background_cache.move_to_end(key)
+            self.background_timer.stop()
+        elif smooth:
+            scaled_pixmap = self.scaled_background(width, height, Qt.SmoothTransformation)
+            self.background_cache[key] = scaled_pixmap
+            if len(self.background_cache) > BACKGROUND_CACHE_SIZE:
+                self.background_cache.popitem(last=False)
+        else:
+            scaled_pixmap = self.scaled_background(width, height, Qt.FastTransformation)
+            self.background_timer.start()
         self.background_label.setPixmap(scaled_pixmap)
+        if self.text_edit:
+            self.text_edit.set_background(scaled_pixmap)
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
         if self.background_label:
             self.background_label.setGeometry(0, 0, self.width(), self.height())
-            self.update_background()
+            self.update_background(smooth=False)
 
     def editor(self):
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
-        layout = QVBoxLayout(central_widget)
+        layout = QHBoxLayout(central_widget)
         layout.setContentsMargins(0, 0, 0, 0)
-        self.text_edit = QPlainTextEdit()
-        layout.addWidget(self.text_edit)
+        layout.setSpacing(0)
+        # 打开文件夹之前侧边栏是隐藏的
+        self.folder_tree = QTreeWidget()
+        self.folder_tree.setHeaderHidden(True)
+        self.folder_tree.setMinimumWidth(160)
+        self.folder_tree.setMaximumWidth(260)
+        self.folder_tree.setStyleSheet("""
+            QTreeWidget {
+                background-color: rgba(255, 255, 255, 0.6);
+                border: 1px solid rgba(255, 255, 255, 0.2);
+            }
+        """)
+        self.folder_tree.itemExpanded.connect(self.on_folder_expanded)
+        self.folder_tree.itemActivated.connect(self.on_folder_activated)
+        self.folder_tree.hide()
+        layout.addWidget(self.folder_tree)
+        # 标签栏，下面是编辑器（或者大文件查看器）
+        self.document_area = QWidget()
+        document_layout = QVBoxLayout(self.document_area)
+        document_layout.setContentsMargins(0, 0, 0, 0)
+        document_layout.setSpacing(0)
+        self.tab_bar = QTabBar()
+        self.tab_bar.setTabsClosable(True)
+        self.tab_bar.setMovable(True)
+        self.tab_bar.setExpanding(False)
+        self.tab_bar.setDocumentMode(True)
+        self.tab_bar.setStyleSheet("QTabBar { background-color: rgba(255, 255, 255, 0.6); }")
+        self.tab_bar.currentChanged.connect(self.on_tab_changed)
+        self.tab_bar.tabCloseRequested.connect(self.close_tab)
+        document_layout.addWidget(self.tab_bar)
+        # 编辑器和它下面的查找栏
+        self.editor_area = QWidget()
+        editor_layout = QVBoxLayout(self.editor_area)
+        editor_layout.setContentsMargins(0, 0, 0, 0)
+        editor_layout.setSpacing(0)
+        self.text_edit = TranslucentTextEdit()
+        # QTextDocument 的撤销栈没有上限，撤销历史改由 piece table 记（有内存预算）
+        self.text_edit.document().setUndoRedoEnabled(False)
+        self.text_edit.undo_requested.connect(self.undo)
+        self.text_edit.redo_requested.connect(self.redo)
+        self.text_edit.can_undo = lambda: self.piece_table.can_undo()
+        self.text_edit.can_redo = lambda: self.piece_table.can_redo()
+        self.completer = WordCompleter(self)
+        self.text_edit.completer = self.completer
+        editor_layout.addWidget(self.text_edit)
+        self.find_bar = FindBar(self)
+        self.find_bar.hide()
+        editor_layout.addWidget(self.find_bar)
+        document_layout.addWidget(self.editor_area)
+        layout.addWidget(self.document_area)
         self.text_edit.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.text_edit.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         font = QFont("Consolas", 11)
         self.text_edit.setFont(font)
         self.text_edit.setStyleSheet("""
             QPlainTextEdit {
-                background-color: rgba(255, 255, 255, 0.7);
+                background-color: transparent;
                 border: 1px solid rgba(255, 255, 255, 0.2);
             }
         """)
@@ -496,10 +1379,38 @@ class MainGui(QMainWindow):
         save_shortcut.activated.connect(self.save)
         open_shortcut = QShortcut(QKeySequence("Ctrl+O"), self)
         open_shortcut.activated.connect(self.open)
+        open_folder_shortcut = QShortcut(QKeySequence("Ctrl+Shift+O"), self)
+        open_folder_shortcut.activated.connect(self.open_folder)
+        find_in_folder_shortcut = QShortcut(QKeySequence("Ctrl+Shift+F"), self)
+        find_in_folder_shortcut.activated.connect(self.find_in_folder)
+        find_shortcut = QShortcut(QKeySequence("Ctrl+F"), self)
+        find_shortcut.activated.connect(lambda: self.find_bar.open_bar())
+        replace_shortcut = QShortcut(QKeySequence("Ctrl+H"), self)
+        replace_shortcut.activated.connect(lambda: self.find_bar.open_bar(replace=True))
+        new_tab_shortcut = QShortcut(QKeySequence("Ctrl+T"), self)
+        new_tab_shortcut.activated.connect(self.new_tab)
+        close_tab_shortcut = QShortcut(QKeySequence("Ctrl+W"), self)
+        close_tab_shortcut.activated.connect(lambda: self.close_tab(self.tab_bar.currentIndex()))
+        next_tab_shortcut = QShortcut(QKeySequence("Ctrl+Tab"), self)
+        next_tab_shortcut.activated.connect(lambda: self.cycle_tab(1))
+        previous_tab_shortcut = QShortcut(QKeySequence("Ctrl+Shift+Tab"), self)
+        previous_tab_shortcut.activated.connect(lambda: self.cycle_tab(-1))
         maximize_shortcut = QShortcut(QKeySequence("Ctrl+M"), self)
         maximize_shortcut.activated.connect(self.toggle_maximize)
         minimize_shortcut = QShortcut(QKeySequence("Ctrl+N"), self)
         minimize_shortcut.activated.connect(self.showMinimized)
+        if instrument.enabled:
+            hud_shortcut = QShortcut(QKeySequence("Ctrl+Shift+H"), self)
+            hud_shortcut.activated.connect(self.toggle_hud)
+
+    def toggle_hud(self):
+        if self.hud:
+            self.hud.deleteLater()
+            self.hud = None
+            return
+        self.hud = InstrumentHud(self)
+        self.hud.refresh()
+        self.hud.show()
 
     def toggle_maximize(self):
         if self.isMaximized():
@@ -507,77 +1418,929 @@ class MainGui(QMainWindow):
         else:
             self.showMaximized()
 
-    def on_text_changed(self):
-        if not self.file_info.modified:
-            self.file_info.modified = True
+    def edit_transaction(self):
+        """with self.edit_transaction() as edit: ...，见 EditTransaction；嵌套时返回外层的那个"""
+        if self.transaction is None:
+            self.transaction = EditTransaction(self)
+        return self.transaction
+
+    def update_modified(self):
+        # 修改标记跟着 piece table 的版本号：撤销、重做回到保存时的版本就变回没修改，
+        # 每次按键不用比较内容。文档关掉了撤销，连高亮器改格式都会设上它自己的修改
+        # 标记，所以不用它。编辑事务提交时才处理
+        if self.reader or self.transaction is not None:
+            return
+        modified = self.piece_table.is_modified()
+        if modified != self.file_info.modified:
+            self.file_info.modified = modified
+            self.update_tab_title()
 
-    def save(self):
-        file_path = self.file_info.get_absolute_file_path()
-        if file_path and os.path.exists(file_path):
+    def undo(self):
+        self.apply_history(self.piece_table.undo())
+
+    def redo(self):
+        self.apply_history(self.piece_table.redo())
+
+    def apply_history(self, changes):
+        """把 piece table 撤销、重做产生的 (位置, 要删掉的长度, 要插入的文本) 同步到文档
+
+        一步里的几处改动放在一个编辑事务里，只重排改到的块。
+        """
+        if self.reader or self.large_file or self.text_edit.isReadOnly():
+            return
+        document = self.text_edit.document()
+        position = None
+        reindex = False
+        self.applying_history = True
+        try:
+            with self.edit_transaction() as edit:
+                for position, length, text in changes:
+                    prepared = self.highlighter.prepared if self.highlighter else None
+                    if prepared is not None:
+                        line = document.findBlock(position).blockNumber()
+                        prepared.edit(line, document.findBlock(position + length).blockNumber() - line,
+                                      text.count('\n'))
+                    if length + len(text) <= INLINE_SIZE:
+                        # piece table 已经改好了，改动之前的那几行用文档里要被换掉的文本拼回来
+                        first, last = self.line_range(position, position + len(text))
+                        lines = self.piece_table.text(first, last)
+                        removed_text = ''
+                        if length:
+                            cursor = QTextCursor(document)
+                            cursor.setPosition(position)
+                            cursor.setPosition(position + length, QTextCursor.KeepAnchor)
+                            removed_text = split_surrogates(cursor.selectedText().replace('\u2029', '\n'))
+                        self.word_index.edit(
+                            lines[:position - first] + removed_text + lines[position + len(text) - first:], lines
+                        )
+                    else:
+                        reindex = True
+                    end = edit.replace(position, position + length, ''.join(join_surrogates([text])))
+                    edit.record(position, end)
+                    self.journal.record(position, length, text)
+                    self.find_bar.on_contents_change(position, length, len(text))
+                    position = end
+        finally:
+            self.applying_history = False
+        if reindex:
+            self.index_words()
+        if position is None:
+            return
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(position)
+        self.text_edit.setTextCursor(cursor)
+
+    def on_contents_change(self, position, chars_removed, chars_added):
+        if self.reader or self.applying_history:
+            return
+        # contentsChange 在整次编辑结束后才发出，改动可能拆成几次上报，
+        # 而且会把文档末尾隐含的段落符算进去，所以按当前文档长度截断
+        document = self.text_edit.document()
+        removed = max(0, min(chars_removed, len(self.piece_table) - position))
+        end = min(position + chars_added, document.characterCount() - 1)
+        text = ''
+        if end > position:
+            cursor = QTextCursor(document)
+            cursor.setPosition(position)
+            cursor.setPosition(end, QTextCursor.KeepAnchor)
+            text = split_surrogates(cursor.selectedText().replace('\u2029', '\n'))
+            if removed == len(text) and self.piece_table.text(position, end) == text:
+                # 高亮器只改了格式（比如换高亮器时整篇重新上色），内容没变
+                return
+        if not removed and not text:
+            return
+        prepared = self.highlighter.prepared if self.highlighter else None
+        if prepared is not None:
+            # 并行首遍分好的词按编辑之前的行号切掉改到的行
+            line = self.piece_table.line_column(position)[0]
+            removed_lines = self.piece_table.line_column(position + removed)[0] - line if removed else 0
+            prepared.edit(line, removed_lines, text.count('\n'))
+        lines = None
+        if removed + len(text) <= INLINE_SIZE:
+            # 单词索引只比较改动前后的那几整行
+            first, last = self.line_range(position, position + removed)
+            lines = self.piece_table.text(first, last)
+        if removed and text:
+            self.piece_table.replace(position, removed, text)
+        elif removed:
+            self.piece_table.delete(position, removed)
+        else:
+            self.piece_table.insert(position, text)
+        if lines is None:
+            self.index_words()
+        else:
+            self.word_index.edit(lines, lines[:position - first] + text + lines[position + removed - first:])
+        self.journal.record(position, removed, text)
+        self.find_bar.on_contents_change(position, removed, len(text))
+        if self.transaction is not None:
+            self.transaction.record(position, max(end, position))
+        self.update_modified()
+
+    def line_range(self, start, end):
+        """piece table 里包含 [start, end] 的那几整行的 (开始, 结束)，结束处不含换行符"""
+        table = self.piece_table
+        first = table.line_start(table.line_column(start)[0])
+        next_line = table.line_column(end)[0] + 1
+        return first, table.line_start(next_line) - 1 if next_line < table.line_count() else len(table)
+
+    def index_words(self):
+        """整篇换了内容之后重建单词索引：小文档直接统计，大的交给后台统计现在的快照，
+        之后的改动照常增量记进来，结果到了再加上"""
+        if self.word_counter:
+            self.word_counter.cancel()
+            self.word_counter = None
+        self.word_index = WordIndex()
+        if len(self.piece_table) <= INLINE_SIZE:
+            self.word_index.edit('', self.piece_table.text())
+            return
+        self.word_counter = WordCounter(self.piece_table.chunks())
+        self.word_counter.start()
+        self.word_timer.start()
+
+    def index_folder(self, folder):
+        """在后台统计文件夹里所有文件的单词，补全时合进来"""
+        if self.folder_word_counter:
+            self.folder_word_counter.cancel()
+            self.folder_word_counter = None
+        self.folder_words = WordIndex()
+        if not self.folder_completion:
+            return
+        self.folder_word_counter = WordCounter(folder=folder)
+        self.folder_word_counter.start()
+        self.word_timer.start()
+
+    def poll_word_counters(self):
+        counter = self.word_counter
+        if counter and counter.done.is_set():
+            self.word_counter = None
+            if counter.error:
+                print(counter.error)
+            else:
+                self.word_index.update(counter.counts)
+        counter = self.folder_word_counter
+        if counter and counter.done.is_set():
+            self.folder_word_counter = None
+            if counter.error:
+                print(counter.error)
+            else:
+                self.folder_words.update(counter.counts)
+        if not self.word_counter and not self.folder_word_counter:
+            self.word_timer.stop()
+
+    def complete_word(self, prefix):
+        """以 prefix 开头的单词，当前文档和打开的文件夹里的合在一起"""
+        with instrument.span('complete.query', 'edit'):
+            return complete(prefix, (self.word_index, self.folder_words))
+
+    def flush_journal(self):
+        try:
+            with instrument.span('journal.flush', 'io'):
+                self.journal.flush()
+        except OSError as e:
+            print(e)
+
+    def start_journal(self, path=None, records=()):
+        """换一个文档时丢掉旧的恢复日志，records 是恢复出来、还没保存的修改"""
+        self.journal.discard()
+        self.journal = RecoveryJournal(path, 'utf-16')
+        for record in records:
+            self.journal.record(*record)
+        self.flush_journal()
+
+    def offer_recovery(self):
+        """上次没有正常退出时，提示从恢复日志里找回没保存的修改"""
+        for journal_path, header in find_journals('utf-16'):
+            self.offer_journal(journal_path, header)
+
+    def offer_journal(self, journal_path, header):
+        path = header.get('path')
+        file_name = os.path.basename(path) if path else "untitled file"
+        message = f"{file_name} has unsaved changes from a previous session. Recover them?"
+        if path and base_changed(header):
+            message += f"\n{file_name} has been changed on disk since then, the recovered text may be wrong."
+        reply = QMessageBox.question(
+            self,
+            "Recover changes?",
+            message,
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.Yes
+        )
+        records = None
+        if reply == QMessageBox.Yes:
             try:
-                with open(str(file_path), "w", encoding=self.file_info.encoding) as file:
-                    file.write(self.text_edit.toPlainText())
-                    self.file_info.saved = True
-                    self.file_info.modified = False
-                    return True
-            except Exception as e:
+                # JSON 读回来时会把成对的代理项转义合成一个字符，要重新拆开
+                records = [[position, removed, split_surrogates(text)]
+                           for position, removed, text in read_records(journal_path)]
+            except (OSError, ValueError) as e:
                 print(e)
-                return False
-        else:
-            abs_file_path, _ = QFileDialog.getSaveFileName(
+        try:
+            remove_journal(journal_path)
+        except OSError as e:
+            print(e)
+        if records is not None:
+            self.recover(path, records)
+
+    def recover(self, path, records):
+        try:
+            base = ''
+            if path and os.path.exists(path):
+                with open(path, encoding=self.file_info.encoding) as file:
+                    base = file.read()
+            table = replay(split_surrogates(base), records)
+        except Exception as e:
+            print(e)
+            return
+        # 每个恢复出来的文档放在自己的标签页里
+        self.blank_tab()
+        self.close_large_file()
+        self.text_edit.setPlainText(''.join(join_surrogates(table.chunks())))
+        # 保存点是磁盘上的原文件，所以恢复后的文档是修改过的
+        self.piece_table = table
+        self.index_words()
+        encoding = self.file_info.encoding
+        self.file_info = FileInfo()
+        self.file_info.encoding = encoding
+        if path:
+            self.file_info.parent_file_path = os.path.dirname(path)
+            self.file_info.file_name = os.path.basename(path)
+        self.file_info.modified = table.is_modified()
+        if path:
+            try:
+                self.file_info.disk_state = disk_state(path, file_digest(path))
+            except OSError as e:
+                print(e)
+        self.start_journal(path, records)
+        self.highlight()
+        self.update_tab_title()
+        self.watch_file()
+
+    def sync_piece_table(self):
+        document = self.text_edit.document()
+        if len(self.piece_table) != document.characterCount() - 1:
+            # 镜像和文档对不上时按文档重建，宁可慢一次也不能写错；撤销历史随之丢掉
+            self.piece_table = PieceTable(split_surrogates(document.toPlainText()))
+            if self.file_info.modified:
+                self.piece_table.mark_unsaved()
+            self.index_words()
+
+    def save(self, wait=False):
+        """在后台线程里保存当前内容的快照，保存期间可以继续编辑
+
+        wait 为 True 时等写完才返回，结果表示是否保存成功（关闭、打开文件前
+        的询问需要）；否则返回是否开始了保存。
+        """
+        if self.large_file:
+            # 大文件查看器是只读的，没有要保存的内容
+            return True
+        if self.reader:
+            return False
+        file_path = self.file_info.get_absolute_file_path()
+        if not (file_path and os.path.exists(file_path)):
+            file_path, _ = QFileDialog.getSaveFileName(
                 self, "save", "", "all file (*.*)"
             )
-            if abs_file_path:
-                parent_file_path = os.path.dirname(abs_file_path)
-                file_name = os.path.basename(abs_file_path)
-                if not os.path.exists(parent_file_path):
-                    os.makedirs(parent_file_path, exist_ok=True)
-                try:
-                    with open(abs_file_path, "w", encoding=self.file_info.encoding) as file:
-                        file.write(self.text_edit.toPlainText())
-                        self.file_info.parent_file_path = parent_file_path
-                        self.file_info.file_name = file_name
-                        self.file_info.saved = True
-                        self.file_info.modified = False
-                        self.highlight()
-                        return True
-                except Exception as e:
-                    print(e)
-                    return False
+            if not file_path:
+                return False
+            parent_file_path = os.path.dirname(file_path)
+            if not os.path.exists(parent_file_path):
+                os.makedirs(parent_file_path, exist_ok=True)
+        elif not self.confirm_overwrite(file_path):
+            return False
+        if self.saver:
+            self.finish_saving()
+        with instrument.span('save.start', 'io'):
+            self.sync_piece_table()
+            self.journal.set_checkpoint()
+            self.saving_path = file_path
+            self.saving_snapshot = self.piece_table.snapshot()
+            # 保存点设在快照这个版本，保存期间的输入和撤销都按它算
+            self.piece_table.mark_saved()
+            self.update_modified()
+            self.saver = AtomicSaver(
+                file_path,
+                join_surrogates(iter_chunks(self.saving_snapshot, SAVE_BLOCK_SIZE)),
+                self.file_info.encoding
+            )
+            self.saver.start()
+        if wait:
+            return self.finish_saving()
+        self.save_timer = QTimer(self)
+        self.save_timer.setInterval(20)
+        self.save_timer.timeout.connect(self.check_saving)
+        self.save_timer.start()
+        return True
+
+    def check_saving(self):
+        if self.saver and self.saver.done.is_set():
+            self.finish_saving()
+
+    def finish_saving(self):
+        """等后台保存结束并更新 FileInfo，返回是否保存成功"""
+        with instrument.span('save.finish', 'io'):
+            return self.complete_saving()
+
+    def complete_saving(self):
+        saver = self.saver
+        saver.join()
+        self.saver = None
+        if self.save_timer:
+            self.save_timer.stop()
+            self.save_timer.deleteLater()
+            self.save_timer = None
+        if saver.error:
+            print(saver.error)
+            self.journal.checkpoint = None
+            # 没保存成功：取消开始保存时设的保存点，撤销回去也不会变成没修改
+            self.piece_table.mark_unsaved()
+            self.update_modified()
             return False
+        try:
+            # 保存期间的输入以刚保存的文件为基准留在日志里
+            self.journal.rebase(self.saving_path)
+        except OSError as e:
+            print(e)
+        renamed = self.saving_path != self.file_info.get_absolute_file_path()
+        self.file_info.parent_file_path = os.path.dirname(self.saving_path)
+        self.file_info.file_name = os.path.basename(self.saving_path)
+        self.saving_snapshot = None
+        self.file_info.saved = True
+        self.file_info.disk_state = saver.disk_state
+        if renamed:
+            self.highlight()
+        self.update_tab_title()
+        self.watch_file()
+        return True
+
+    def confirm_overwrite(self, file_path):
+        """文件打开之后被别的程序改过时，问一下是否覆盖"""
+        if self.saver:
+            # 自己正在写的那份不算别人的修改
+            return True
+        changed, _ = check_file(file_path, self.file_info.disk_state)
+        if not changed:
+            return True
+        reply = QMessageBox.question(
+            self,
+            "File changed",
+            f"{os.path.basename(file_path)} has been changed on disk by another program. Overwrite it?",
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.No
+        )
+        return reply == QMessageBox.Yes
+
+    def watch_file(self):
+        """监视当前文档的文件；改名覆盖（原子保存）之后原来的监视会失效，所以每次都重新加"""
+        path = self.file_info.get_absolute_file_path()
+        watched = self.file_watcher.files()
+        if watched and watched != [path]:
+            self.file_watcher.removePaths(watched)
+        if path and path not in watched and os.path.exists(path):
+            self.file_watcher.addPath(path)
+
+    def on_file_changed(self, path):
+        self.watch_timer.start()
+
+    def check_external_change(self):
+        """先比较修改时间和大小，变了再比较哈希；真的被改过才重新加载"""
+        path = self.file_info.get_absolute_file_path()
+        if not path or self.reader or self.saver:
+            return
+        self.watch_file()
+        changed, state = check_file(path, self.file_info.disk_state)
+        # 只是被 touch 过时也记下新的修改时间，下次不用再算哈希
+        self.file_info.disk_state = state
+        if not changed:
+            return
+        if self.large_file:
+            self.open_large_file(path)
+            return
+        if self.file_info.modified:
+            reply = QMessageBox.question(
+                self,
+                "File changed",
+                f"{self.file_info.file_name} has been changed on disk by another program. "
+                f"Reload it and lose your changes?",
+                QMessageBox.Yes | QMessageBox.No,
+                QMessageBox.No
+            )
+            if reply != QMessageBox.Yes:
+                # 保留自己的修改，之后保存时覆盖磁盘上的版本
+                return
+        self.reload_from_disk(path)
+
+    def reload_from_disk(self, path):
+        """只把变了的几段替换进文档，没变的部分的撤销历史、光标和高亮都留着；重新加载本身是一步撤销"""
+        try:
+            with open(path, encoding=self.file_info.encoding) as file:
+                text = split_surrogates(file.read())
+        except Exception as e:
+            print(e)
+            return
+        with instrument.span('reload.diff', 'io'):
+            self.sync_piece_table()
+            regions = changed_regions(self.piece_table.text(), text)
+        # 从后往前替换，前面的位置不受影响；只重排改过的那几段，不是从第一处到最后一处的整段
+        with self.edit_transaction() as edit:
+            for start, end, replacement in regions:
+                edit.replace(start, end, ''.join(join_surrogates([replacement])))
+        # 现在的内容就是磁盘上的文件，保存点和恢复日志都以它为准
+        self.piece_table.mark_saved()
+        self.start_journal(path)
+        self.update_modified()
+        self.update_tab_title()
 
     def open(self):
+        abs_file_path, _ = QFileDialog.getOpenFileName(
+            self, "open", "", "all file (*.*)"
+        )
+        if abs_file_path:
+            self.open_path(abs_file_path)
+
+    def confirm_discard(self):
+        """有未保存的修改时询问是否保存，返回是否可以继续换文档"""
         if self.file_info.modified:
             file_name = self.file_info.file_name or "untitled file"
             reply = QMessageBox.question(
                 self,
                 f"save {file_name}?",
+                f"Do you want to save changes to {file_name}?",
                 QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel,
                 QMessageBox.Yes
             )
             if reply == QMessageBox.Yes:
-                if not self.save():
-                    return
+                if not self.save(wait=True):
+                    return False
             elif reply == QMessageBox.Cancel:
+                return False
+        return True
+
+    def open_path(self, abs_file_path):
+        """在新标签页里打开（当前标签页是空的就直接用它）；已经打开的文件切到它的标签页"""
+        index = self.find_tab(abs_file_path)
+        if index is not None:
+            self.tab_bar.setCurrentIndex(index)
+            return
+        self.blank_tab()
+        try:
+            large = os.path.getsize(abs_file_path) >= LARGE_FILE_SIZE
+        except OSError as e:
+            print(e)
+            return
+        if large:
+            self.open_large_file(abs_file_path)
+        else:
+            self.load_file(abs_file_path)
+
+    def open_folder(self):
+        """在侧边栏里显示文件夹，子目录在展开时才由后台线程扫描"""
+        folder_path = QFileDialog.getExistingDirectory(self, "open folder")
+        if not folder_path:
+            return
+        folder_path = os.path.abspath(folder_path)
+        self.folder_path = folder_path
+        if self.find_panel and self.find_panel.isVisible():
+            self.find_panel.show_for(folder_path)
+        if self.folder_scanner:
+            self.folder_scanner.stop()
+        self.folder_scanner = FolderScanner()
+        self.folder_scanner.start()
+        self.index_folder(folder_path)
+        self.folder_tree.clear()
+        self.folder_items = {}
+        self.folder_keys = {}
+        root = QTreeWidgetItem([os.path.basename(folder_path) or folder_path])
+        self.folder_tree.addTopLevelItem(root)
+        self.add_folder_item(root, folder_path, True)
+        self.folder_tree.show()
+        root.setExpanded(True)
+
+    def add_folder_item(self, item, path, is_directory):
+        item.setData(0, Qt.UserRole, path)
+        if is_directory:
+            item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            self.folder_items[path] = item
+
+    def on_folder_expanded(self, item):
+        path = item.data(0, Qt.UserRole)
+        # 只有第一次展开时扫描；扫描完的目录不再有 ShowIndicator 策略
+        if item.childIndicatorPolicy() != QTreeWidgetItem.ShowIndicator or item.childCount():
+            return
+        item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicatorWhenChildless)
+        item.addChild(QTreeWidgetItem(["loading..."]))
+        self.folder_scanner.request(path)
+        if not self.folder_timer:
+            self.folder_timer = QTimer(self)
+            self.folder_timer.setInterval(10)
+            self.folder_timer.timeout.connect(self.poll_folder)
+        self.folder_timer.start()
+
+    def poll_folder(self):
+        deadline = time.perf_counter() + FOLDER_SLICE
+        while time.perf_counter() < deadline:
+            result = self.folder_scanner.take()
+            if result is None:
+                break
+            folder_path, entries, done, error = result
+            parent = self.folder_items.get(folder_path)
+            if parent is None:
+                continue
+            keys = self.folder_keys.get(folder_path)
+            if keys is None:
+                # 第一批：去掉 "loading..." 占位
+                keys = self.folder_keys[folder_path] = []
+                parent.takeChildren()
+            # 每批在工作线程里已经排好序，这里按键归并进已有的子节点
+            for entry in entries:
+                key = entry_key(entry)
+                index = bisect(keys, key)
+                keys.insert(index, key)
+                name, is_directory = entry
+                item = QTreeWidgetItem([name])
+                self.add_folder_item(item, os.path.join(folder_path, name), is_directory)
+                parent.insertChild(index, item)
+            if error:
+                print(error)
+        if not self.folder_scanner.pending:
+            self.folder_timer.stop()
+
+    def on_folder_activated(self, item):
+        path = item.data(0, Qt.UserRole)
+        if path is None or path in self.folder_items:
+            return
+        self.open_path(path)
+
+    def find_in_folder(self):
+        if not self.folder_path:
+            self.open_folder()
+            if not self.folder_path:
                 return
-        abs_file_path, _ = QFileDialog.getOpenFileName(
-            self, "open", "", "all file (*.*)"
+        if not self.find_panel:
+            self.find_panel = FindInFilesPanel(self)
+        self.find_panel.show_for(self.folder_path)
+
+    def open_at(self, abs_file_path, line):
+        """打开文件并跳到指定行（从 0 开始）；已经打开的文件直接跳"""
+        if abs_file_path == self.file_info.get_absolute_file_path() and not self.reader:
+            self.go_to_line(line)
+            return
+        self.open_path(abs_file_path)
+        if self.reader:
+            # 还在后台读，读完之后再跳
+            self.pending_line = line
+        else:
+            self.go_to_line(line)
+
+    def go_to_line(self, line):
+        if self.large_file:
+            self.large_file_viewer.scroll_to(line)
+            return
+        block = self.text_edit.document().findBlockByNumber(line)
+        if not block.isValid():
+            return
+        self.text_edit.setTextCursor(QTextCursor(block))
+        self.text_edit.centerCursor()
+        self.text_edit.setFocus()
+
+    def find_tab(self, abs_file_path):
+        path = os.path.normcase(os.path.abspath(abs_file_path))
+        for index in range(self.tab_bar.count()):
+            tab_path = self.tab_bar.tabData(index).file_info.get_absolute_file_path()
+            if tab_path and os.path.normcase(os.path.abspath(tab_path)) == path:
+                return index
+        return None
+
+    def is_blank(self):
+        """当前标签页是不是没有文件、没有内容的新标签页"""
+        return not (self.file_info.get_absolute_file_path() or self.file_info.modified or self.large_file or
+                    len(self.piece_table))
+
+    def blank_tab(self):
+        """打开、恢复文档之前：当前标签页不是空的就新开一个"""
+        self.cancel_loading()
+        if not self.is_blank():
+            self.new_tab()
+
+    def new_tab(self):
+        if self.reader:
+            return
+        tab = Tab(FileInfo(), RecoveryJournal(None, 'utf-16'))
+        tab.file_info.encoding = self.file_info.encoding
+        index = self.tab_bar.addTab(tab.title())
+        self.tab_bar.setTabData(index, tab)
+        self.tab_bar.setCurrentIndex(index)
+
+    def cycle_tab(self, step):
+        if self.reader or self.tab_bar.count() < 2:
+            return
+        self.tab_bar.setCurrentIndex((self.tab_bar.currentIndex() + step) % self.tab_bar.count())
+
+    def update_tab_title(self):
+        if self.active_tab is None:
+            return
+        self.active_tab.file_info = self.file_info
+        for index in range(self.tab_bar.count()):
+            if self.tab_bar.tabData(index) is self.active_tab:
+                self.tab_bar.setTabText(index, self.active_tab.title())
+                self.tab_bar.setTabToolTip(index, self.file_info.get_absolute_file_path() or "")
+                return
+
+    def close_tab(self, index):
+        if index < 0 or self.reader:
+            return
+        if self.tab_bar.tabData(index) is not self.active_tab:
+            # 先切过去，有修改时才能照常询问、保存
+            self.tab_bar.setCurrentIndex(index)
+        if not self.confirm_discard():
+            return
+        if self.saver:
+            self.finish_saving()
+        # 切过去时可能又开始从磁盘重读了
+        self.cancel_loading()
+        self.close_large_file()
+        self.journal.discard()
+        self.active_tab = None
+        if self.tab_bar.count() == 1:
+            # 最后一个标签页不关，换成空文档
+            tab = Tab(FileInfo(), RecoveryJournal(None, 'utf-16'))
+            tab.file_info.encoding = self.file_info.encoding
+            self.tab_bar.setTabData(0, tab)
+            self.activate_tab(tab)
+            return
+        # 关掉的标签页不用打包，currentChanged 直接激活旁边的那个
+        self.tab_bar.removeTab(index)
+
+    def on_tab_changed(self, index):
+        tab = self.tab_bar.tabData(index) if index >= 0 else None
+        if tab is None or tab is self.active_tab:
+            return
+        if self.active_tab is not None:
+            self.deactivate_tab(self.active_tab)
+        self.activate_tab(tab)
+
+    def deactivate_tab(self, tab):
+        """把当前文档打包成紧凑的表示留在 tab 里"""
+        if self.saver:
+            self.finish_saving()
+        self.cancel_loading()
+        self.flush_journal()
+        tab.file_info = self.file_info
+        tab.journal = self.journal
+        if self.large_file:
+            tab.large_file = True
+            self.close_large_file()
+        else:
+            cursor = self.text_edit.textCursor()
+            tab.cursor = (cursor.anchor(), cursor.position())
+            tab.scroll = self.text_edit.verticalScrollBar().value()
+            self.sync_piece_table()
+            text = ''.join(join_surrogates(self.piece_table.chunks()))
+            tab.data = text.encode('utf-8', 'surrogatepass')
+            tab.compressed = False
+        self.inactive_tabs[tab] = None
+        self.enforce_tab_budget()
+
+    def activate_tab(self, tab):
+        """从 tab 里的紧凑表示重建文档"""
+        self.inactive_tabs.pop(tab, None)
+        self.active_tab = tab
+        # 先换上这个标签页的日志，打开文件时 start_journal 丢掉的是它而不是上一个标签页的
+        self.file_info = tab.file_info
+        self.journal = tab.journal
+        path = self.file_info.get_absolute_file_path()
+        if tab.large_file:
+            tab.large_file = False
+            self.open_large_file(path)
+        elif tab.data is None and path:
+            # 超出预算时丢掉了内容（没有修改过），从磁盘重读
+            self.pending_view = (tab.cursor, tab.scroll)
+            self.load_file(path)
+            if not self.reader:
+                # 文件已经读不了了，不能留着上一个标签页的内容
+                self.pending_view = None
+                self.set_document_text('')
+                self.highlight()
+        else:
+            self.set_document_text(tab.text() if tab.data else '')
+            tab.data = None
+            self.highlight()
+            self.restore_view(tab.cursor, tab.scroll)
+            if self.find_bar.isVisible():
+                self.find_bar.anchor = self.text_edit.textCursor().selectionStart()
+                self.find_bar.search()
+            # 不活动期间文件可能被别的程序改过
+            self.check_external_change()
+        self.update_tab_title()
+        self.watch_file()
+
+    def set_document_text(self, text):
+        """整篇换掉，piece table 直接按新内容建，不经过 contentsChange 的镜像和恢复日志
+
+        撤销历史随之清空，标签页原来的修改标记保留（没有保存点可以撤销回去了）。
+        """
+        document = self.text_edit.document()
+        modified = self.file_info.modified
+        document.contentsChange.disconnect(self.on_contents_change)
+        self.text_edit.setPlainText(text)
+        document.contentsChange.connect(self.on_contents_change)
+        self.file_info.modified = modified
+        self.piece_table = PieceTable(split_surrogates(text))
+        if modified:
+            self.piece_table.mark_unsaved()
+        self.index_words()
+
+    def restore_view(self, cursor_position, scroll):
+        anchor, position = cursor_position
+        last = self.text_edit.document().characterCount() - 1
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(min(anchor, last))
+        cursor.setPosition(min(position, last), QTextCursor.KeepAnchor)
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.verticalScrollBar().setValue(scroll)
+        self.text_edit.setFocus()
+
+    def enforce_tab_budget(self):
+        """不活动的标签页超出预算时，从最久没用的开始：没修改过的文件丢掉内容，其余的压缩"""
+        total = sum(tab.memory() for tab in self.inactive_tabs)
+        for tab in self.inactive_tabs:
+            if total <= self.tab_budget:
+                break
+            if not tab.data:
+                continue
+            size = tab.memory()
+            path = tab.file_info.get_absolute_file_path()
+            if not tab.file_info.modified and path and os.path.exists(path):
+                tab.data = None
+            elif not tab.compressed:
+                tab.data = zlib.compress(tab.data, 1)
+                tab.compressed = True
+            total -= size - tab.memory()
+
+    def open_large_file(self, abs_file_path):
+        """超大文件不放进 QPlainTextEdit，改用 mmap 的只读查看器"""
+        self.cancel_loading()
+        self.close_large_file()
+        try:
+            self.large_file = LargeFile(str(abs_file_path), self.file_info.encoding)
+        except Exception as e:
+            print(e)
+            return
+        encoding = self.file_info.encoding
+        self.file_info = FileInfo()
+        self.file_info.encoding = encoding
+        self.highlight()
+        self.text_edit.clear()
+        self.piece_table = PieceTable()
+        self.index_words()
+        self.update_modified()
+        self.start_journal()
+        self.file_info.parent_file_path = os.path.dirname(abs_file_path)
+        self.file_info.file_name = os.path.basename(abs_file_path)
+        self.file_info.modified = False
+        # 大文件不算哈希，修改时间或大小变了就重新打开
+        self.file_info.disk_state = disk_state(abs_file_path)
+        self.large_file_viewer = LargeFileViewer(self.large_file)
+        self.document_area.layout().addWidget(self.large_file_viewer)
+        self.find_bar.close_bar()
+        self.editor_area.hide()
+        self.large_file_viewer.setFocus()
+        self.update_tab_title()
+        self.watch_file()
+
+    def close_large_file(self):
+        if self.large_file:
+            self.large_file_viewer.index_timer.stop()
+            self.large_file_viewer.deleteLater()
+            self.large_file_viewer = None
+            self.large_file.close()
+            self.large_file = None
+            self.editor_area.show()
+            self.text_edit.setFocus()
+
+    def load_file(self, abs_file_path):
+        """在后台线程里分块读取文件，边读边追加到编辑器里"""
+        self.cancel_loading()
+        self.close_large_file()
+        try:
+            self.reader = ChunkReader(str(abs_file_path), self.file_info.encoding)
+        except Exception as e:
+            print(e)
+            return
+        encoding = self.file_info.encoding
+        self.file_info = FileInfo()
+        self.file_info.encoding = encoding
+        self.highlight()
+        self.text_edit.clear()
+        self.piece_table = PieceTable()
+        self.text_edit.setReadOnly(True)
+        # 读完之前不能切换标签页
+        self.tab_bar.setEnabled(False)
+        self.load_progress = QProgressDialog(
+            f"opening {os.path.basename(abs_file_path)}", "cancel", 0, 100, self
         )
-        if abs_file_path:
+        self.load_progress.setWindowModality(Qt.NonModal)
+        self.load_progress.setMinimumDuration(500)
+        self.load_progress.canceled.connect(self.cancel_loading)
+        self.load_timer = QTimer(self)
+        self.load_timer.setInterval(0)
+        self.load_timer.timeout.connect(lambda: self.append_chunks(abs_file_path))
+        self.reader.start()
+        self.load_timer.start()
+
+    def append_chunks(self, abs_file_path):
+        with instrument.span('open.append', 'io'):
+            self.append_pending_chunks(abs_file_path)
+
+    def append_pending_chunks(self, abs_file_path):
+        deadline = time.perf_counter() + LOAD_SLICE
+        cursor = QTextCursor(self.text_edit.document())
+        cursor.movePosition(QTextCursor.End)
+        while time.perf_counter() < deadline:
             try:
-                with open(str(abs_file_path), "r", encoding=self.file_info.encoding) as file:
-                    content = file.read()
-                    self.text_edit.setPlainText(content)
-                    self.file_info.parent_file_path = os.path.dirname(abs_file_path)
-                    self.file_info.file_name = os.path.basename(abs_file_path)
-                    self.file_info.saved = True
-                    self.file_info.modified = False
-                    self.highlight()
-            except Exception as e:
-                print(e)
+                text = self.reader.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if text is None:
+                self.finish_loading(abs_file_path)
+                return
+            self.piece_table.insert(cursor.position(), split_surrogates(text))
+            cursor.insertText(text)
+        self.load_progress.setValue(min(self.reader.progress(), 99))
+
+    def finish_loading(self, abs_file_path):
+        with instrument.span('open.finish', 'io'):
+            self.complete_loading(abs_file_path)
+
+    def complete_loading(self, abs_file_path):
+        reader = self.reader
+        self.stop_loading()
+        line, self.pending_line = self.pending_line, None
+        view, self.pending_view = self.pending_view, None
+        if reader.error:
+            print(reader.error)
+            self.text_edit.clear()
+            self.piece_table = PieceTable()
+            self.index_words()
+            self.start_journal()
+            self.file_info.modified = False
+            self.update_tab_title()
+            return
+        self.piece_table.clear_history()
+        self.piece_table.mark_saved()
+        self.index_words()
+        self.start_journal(abs_file_path)
+        self.text_edit.moveCursor(QTextCursor.Start)
+        self.file_info.parent_file_path = os.path.dirname(abs_file_path)
+        self.file_info.file_name = os.path.basename(abs_file_path)
+        self.file_info.saved = True
+        self.file_info.modified = False
+        self.file_info.disk_state = reader.disk_state
+        self.highlight()
+        if view is not None:
+            self.restore_view(*view)
+        # 查找栏开着时，在新文档里重新搜
+        self.find_bar.anchor = self.text_edit.textCursor().selectionStart()
+        self.find_bar.search()
+        if line is not None:
+            self.go_to_line(line)
+        self.update_tab_title()
+        self.watch_file()
+
+    def cancel_loading(self):
+        """取消正在进行的打开，丢掉已经读进来的部分"""
+        if self.reader:
+            self.pending_line = None
+            self.pending_view = None
+            self.stop_loading()
+            self.text_edit.clear()
+            self.piece_table = PieceTable()
+            self.index_words()
+            self.start_journal()
+            self.file_info.modified = False
+
+    def stop_loading(self):
+        self.reader.cancel()
+        self.reader = None
+        self.load_timer.stop()
+        self.load_timer.deleteLater()
+        self.load_timer = None
+        self.load_progress.canceled.disconnect(self.cancel_loading)
+        self.load_progress.close()
+        self.load_progress.deleteLater()
+        self.load_progress = None
+        self.text_edit.setReadOnly(False)
+        self.tab_bar.setEnabled(True)
 
     def closeEvent(self, event):
-        if self.file_info.modified:
+        self.cancel_loading()
+        if self.saver:
+            self.finish_saving()
+        self.update_tab_title()
+        # 逐个询问有修改的标签页，取消任何一个就不关闭
+        for index in range(self.tab_bar.count()):
+            tab = self.tab_bar.tabData(index)
+            if not tab.file_info.modified:
+                continue
+            self.tab_bar.setCurrentIndex(index)
             file_name = self.file_info.file_name or "untitled file"
             reply = QMessageBox.question(
                 self,
@@ -587,18 +2350,28 @@ class MainGui(QMainWindow):
                 QMessageBox.Save
             )
             if reply == QMessageBox.Save:
-                if self.save():
-                    event.accept()
-                else:
+                if not self.save(wait=True):
                     event.ignore()
-            elif reply == QMessageBox.Discard:
-                event.accept()
-            else:
+                    return
+            elif reply != QMessageBox.Discard:
                 event.ignore()
-        else:
-            event.accept()
+                return
+        event.accept()
+        self.close_large_file()
+        if self.folder_scanner:
+            self.folder_scanner.stop()
+        if self.find_panel:
+            self.find_panel.stop_search()
+        for counter in (self.word_counter, self.folder_word_counter):
+            if counter:
+                counter.cancel()
+        # 已经保存或者选择了放弃修改，不再需要恢复
+        self.journal.discard()
+        for tab in self.inactive_tabs:
+            tab.journal.discard()
 
 if __name__ == '__main__':
+    instrument.enable_from_environment(sys.argv[1:])
     app = QApplication(sys.argv)
     window = MainGui()
     window.show()
@@ -0,0 +1,263 @@
+"""与界面无关的大文件并行首遍分词
+
+打开大文件后的第一遍高亮里，分词要占一半左右的时间，而且只能用一个
+核。这里把文档按 CHUNK_LINES 行切段，交给进程池（和在文件夹里查找
+共用）并行分词，界面线程只剩下按结果设置格式。
+
+每段的入口状态要等前一段分完才知道，所以先一律猜 0（不在任何多行结构
+里，绝大多数时候猜得对）并行地分。协调线程按顺序接上各段：猜错了就用
+前一段真正的行尾状态重跑这一段，重跑到某一行的行尾状态和猜测时的结果
+一致就停下，后面的行直接用猜测时的结果。
+
+结果用紧凑的整数数组返回，跨进程传输和反序列化都很便宜。分词期间的
+编辑由 PreparedTokens.edit 把改到的行从段里切掉、把后面的段平移；界面
+线程使用时还会核对每行的入口状态和长度，所以没来得及重跑的段、被编辑
+改了状态的行都只会退回普通分词，不会用错结果。
+"""
+import os
+import queue
+import threading
+from array import array
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from find_in_files import executor
+from languages import registry
+from tokenizer import Tokenizer
+
+# 每个进程池任务分词的行数
+CHUNK_LINES = 4000
+
+# 进程池里按语言名缓存的分词器
+_tokenizers = {}
+
+
+def tokenize_chunk(name, text, state=0, known_states=None):
+    """进程池里执行：从入口状态 state 开始给一段文本逐行分词
+
+    返回 (片段, 行边界, 行尾状态, 行长)，都是 array：片段是每个有样式
+    的片段的 (开始, 长度, 样式序号) 依次排开，样式序号是它在
+    Language.styles 里的位置；第 i 行的片段在 [行边界[i], 行边界[i + 1])
+    之间（按整数计）。给了 known_states（上次猜测入口状态时的行尾状态）
+    时，某一行的行尾状态和它一致就停下，后面的行不用再分。
+    """
+    tokenizer = _tokenizers.get(name)
+    if tokenizer is None:
+        language = registry.get(name)
+        tokenizer = _tokenizers[name] = Tokenizer(language)
+        tokenizer.style_ids = {style: index for index, style in enumerate(language.styles)}
+    style_ids = tokenizer.style_ids
+    tokens = array('i')
+    bounds = array('i', [0])
+    states = array('i')
+    lengths = array('i')
+    for index, line in enumerate(text.split('\n')):
+        line_tokens, state = tokenizer.tokens(line, state)
+        for start, length, style, _ in line_tokens:
+            style_id = style_ids.get(style)
+            if style_id is not None:
+                tokens.extend((start, length, style_id))
+        bounds.append(len(tokens))
+        states.append(state)
+        lengths.append(len(line))
+        if known_states is not None and state == known_states[index]:
+            break
+    return tokens, bounds, states, lengths
+
+
+class PreparedChunk:
+    """文档里从第 first 行开始的 count 行分词结果，对应数组里从 offset 开始的行"""
+
+    def __init__(self, first, entry_state, result, offset=0, count=None):
+        self.first = first
+        self.entry_state = entry_state
+        self.result = result
+        self.tokens, self.bounds, self.states, self.lengths = result
+        self.offset = offset
+        self.count = len(self.states) - offset if count is None else count
+
+    def end_state(self):
+        return self.states[self.offset + self.count - 1]
+
+    def lookup(self, line, state, text):
+        """第 line 行（相对于 first）的 (片段, 行尾状态)；入口状态或长度对不上时返回 None"""
+        if not 0 <= line < self.count:
+            return None
+        index = self.offset + line
+        expected = self.states[index - 1] if line else self.entry_state
+        if state != expected or self.lengths[index] != len(text):
+            return None
+        return self.tokens[self.bounds[index]:self.bounds[index + 1]], self.states[index]
+
+
+class PreparedTokens:
+    """界面线程里按行号查找已经分好的段；编辑时切掉改到的行，后面的段跟着平移"""
+
+    def __init__(self):
+        self.chunks = []
+        self.firsts = []
+        # 分词开始之后的编辑，之后才到的段也要按这些切开、平移
+        self.edits = []
+        # 上一次命中的段，按顺序高亮时大多还是它
+        self.last = None
+
+    def add(self, chunk):
+        parts = [chunk]
+        for edit in self.edits:
+            parts = [part for chunk in parts for part in self.edit_chunk(chunk, *edit)]
+        for chunk in parts:
+            index = bisect_right(self.firsts, chunk.first)
+            self.chunks.insert(index, chunk)
+            self.firsts.insert(index, chunk.first)
+
+    @staticmethod
+    def edit_chunk(chunk, line, removed_lines, added_lines):
+        """第 line 行到第 line + removed_lines 行换成 added_lines + 1 行之后，这一段还能用的部分"""
+        end = chunk.first + chunk.count
+        if end <= line:
+            return [chunk]
+        tail = line + removed_lines + 1
+        if chunk.first >= tail:
+            chunk.first += added_lines - removed_lines
+            return [chunk]
+        parts = []
+        if chunk.first < line:
+            parts.append(PreparedChunk(chunk.first, chunk.entry_state, chunk.result, chunk.offset, line - chunk.first))
+        if tail < end:
+            # 入口状态按编辑之前算，对不上时 lookup 会发现
+            skip = tail - chunk.first
+            parts.append(PreparedChunk(line + added_lines + 1, chunk.states[chunk.offset + skip - 1], chunk.result,
+                                       chunk.offset + skip, chunk.count - skip))
+        return parts
+
+    def edit(self, line, removed_lines, added_lines):
+        """从第 line 行开始的 removed_lines + 1 行被换成了 added_lines + 1 行"""
+        self.edits.append((line, removed_lines, added_lines))
+        self.chunks = [part for chunk in self.chunks for part in self.edit_chunk(chunk, line, removed_lines, added_lines)]
+        self.firsts = [chunk.first for chunk in self.chunks]
+        self.last = None
+
+    def discard_before(self, line):
+        """第 line 行之前都已经高亮过了，释放完全在它前面的段"""
+        index = 0
+        while index < len(self.chunks) and self.chunks[index].first + self.chunks[index].count <= line:
+            index += 1
+        if index:
+            del self.chunks[:index]
+            del self.firsts[:index]
+            self.last = None
+
+    def lookup(self, line, state, text):
+        chunk = self.last
+        if chunk is None or not chunk.first <= line < chunk.first + chunk.count:
+            index = bisect_right(self.firsts, line) - 1
+            if index < 0:
+                return None
+            chunk = self.last = self.chunks[index]
+        return chunk.lookup(line - chunk.first, state, text)
+
+
+def split_chunks(texts, lines=CHUNK_LINES):
+    """把任意切分的文本块重新切成每段 lines 行，产生 (第一行的行号, 文本)"""
+    pending = []
+    partial = ''
+    first = 0
+    for text in texts:
+        parts = (partial + text).split('\n')
+        partial = parts.pop()
+        pending.extend(parts)
+        while len(pending) >= lines:
+            yield first, '\n'.join(pending[:lines])
+            del pending[:lines]
+            first += lines
+    pending.append(partial)
+    yield first, '\n'.join(pending)
+
+
+class ParallelTokenizer(threading.Thread):
+    """协调线程：把 texts（文档内容，按顺序的若干文本块）切段交给进程池，
+    按顺序接上各段的入口状态，接好的 PreparedChunk 放进队列 results
+
+    结束（或出错、取消）之后会放入一个 None 作为结束标记，出错时 error
+    记录异常；界面线程这时退回普通分词就行。
+    """
+
+    def __init__(self, name, texts):
+        super().__init__(daemon=True)
+        self.name = name
+        self.texts = texts
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            self.tokenize()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.results.put(None)
+
+    def tokenize(self):
+        pool = executor()
+        # 同时在跑的任务数有上限，取消时不会留下一大堆排队的任务
+        limit = 2 * (os.cpu_count() or 1)
+        # 段号 -> (第一行的行号, 文本)，接上之前都要留着，猜错了要重跑
+        texts = {}
+        # future -> (段号, 是否重跑)
+        pending = {}
+        # 段号 -> 猜测入口状态为 0 时的结果
+        finished = {}
+        next_index = 0
+        state = 0
+        rerunning = False
+        chunks = enumerate(split_chunks(self.texts))
+        exhausted = False
+        while not self.cancelled.is_set():
+            while not exhausted and len(pending) < limit:
+                try:
+                    index, (first, text) = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                texts[index] = first, text
+                pending[pool.submit(tokenize_chunk, self.name, text)] = index, False
+            if not pending:
+                break
+            done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, rerun = pending.pop(future)
+                result = future.result()
+                if not rerun:
+                    finished[index] = result
+                    continue
+                # 重跑的结果接在猜测的结果前面
+                first, _ = texts.pop(index)
+                guessed = finished.pop(index)
+                chunk = PreparedChunk(first, state, result)
+                self.results.put(chunk)
+                state = chunk.end_state()
+                if chunk.count < len(guessed[2]):
+                    chunk = PreparedChunk(first + chunk.count, state, guessed, chunk.count)
+                    self.results.put(chunk)
+                    state = chunk.end_state()
+                next_index += 1
+                rerunning = False
+            while not rerunning and next_index in finished:
+                first, text = texts[next_index]
+                if state != 0:
+                    # 猜错了入口状态，从真正的状态重跑到和猜测的结果接上为止
+                    pending[pool.submit(tokenize_chunk, self.name, text, state, finished[next_index][2])] = \
+                        next_index, True
+                    rerunning = True
+                    break
+                del texts[next_index]
+                chunk = PreparedChunk(first, 0, finished.pop(next_index))
+                self.results.put(chunk)
+                state = chunk.end_state()
+                next_index += 1
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,355 @@
+"""与界面无关的 piece table 文档模型
+
+文本不整段复制：原始内容是一块缓冲区，插入的文本都追加到共用的追加
+缓冲区里，文档只是按顺序引用这些缓冲区片段（piece）的一棵平衡树。
+缓冲区只在末尾追加，已有内容不变，旧的 piece 和快照一直有效。
+"""
+import random
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, count
+
+from undo_history import UndoHistory
+
+# 追加缓冲区长到这么多字符以后换一块新的：字符串追加要复制，每次复制的量有上限
+ADD_BUFFER_SIZE = 64 * 1024
+
+
+class Buffer:
+    """一块只在末尾追加的文本，附带每个换行符之后位置的索引，用来 O(log n) 数行"""
+
+    __slots__ = ('text', 'line_starts')
+
+    def __init__(self, text=''):
+        self.text = ''
+        self.line_starts = array('Q')
+        self.append(text)
+
+    def append(self, text):
+        base = len(self.text)
+        parts = text.split('\n')
+        # 先整个算好再接上，别的线程读快照时看到的索引总是完整的
+        self.line_starts.extend(array('Q', (base + start for start in
+                                            accumulate(map((1).__add__, map(len, parts[:-1]))))))
+        self.text += text
+
+    def count_newlines(self, start, end):
+        return bisect_left(self.line_starts, end + 1) - bisect_left(self.line_starts, start + 1)
+
+
+class Piece:
+    """树节点：引用 buffer 里 [start, start + length) 这一段
+
+    节点创建后不再修改，编辑时沿路径复制新节点，所以旧的根节点就是
+    一份完整、只读的快照，可以交给别的线程去读。
+    """
+
+    __slots__ = ('buffer', 'start', 'length', 'newlines', 'priority', 'left', 'right', 'size', 'lines')
+
+    def __init__(self, buffer, start, length, newlines, priority, left, right):
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.newlines = newlines
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.size = length
+        self.lines = newlines
+        if left:
+            self.size += left.size
+            self.lines += left.lines
+        if right:
+            self.size += right.size
+            self.lines += right.lines
+
+    def with_children(self, left, right):
+        return Piece(self.buffer, self.start, self.length, self.newlines, self.priority, left, right)
+
+
+def split(node, position):
+    """把树切成前 position 个字符和剩下的部分，原来的树不变"""
+    if node is None:
+        return None, None
+    left_size = node.left.size if node.left else 0
+    if position <= left_size:
+        left, right = split(node.left, position)
+        return left, node.with_children(right, node.right)
+    end = left_size + node.length
+    if position >= end:
+        left, right = split(node.right, position - end)
+        return node.with_children(node.left, left), right
+    # 切点落在这个 piece 中间，拆成两半
+    offset = position - left_size
+    newlines = node.buffer.count_newlines(node.start, node.start + offset)
+    head = Piece(node.buffer, node.start, offset, newlines, node.priority, node.left, None)
+    tail = Piece(node.buffer, node.start + offset, node.length - offset,
+                 node.newlines - newlines, node.priority, None, node.right)
+    return head, tail
+
+
+def extend_last(node, length, newlines):
+    """最右边的 piece 加长 length 个字符（缓冲区里紧接着它追加的内容），沿右侧路径复制"""
+    if node.right:
+        return node.with_children(node.left, extend_last(node.right, length, newlines))
+    return Piece(node.buffer, node.start, node.length + length, node.newlines + newlines,
+                 node.priority, node.left, None)
+
+
+def merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        return left.with_children(left.left, merge(left.right, right))
+    return right.with_children(merge(left, right.left), right.right)
+
+
+def iter_chunks(node, limit=None):
+    """按顺序产出树里每个 piece 的文本，limit 限制每段的最大长度"""
+    stack = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        end = node.start + node.length
+        step = limit or node.length
+        for start in range(node.start, end, step):
+            yield node.buffer.text[start:min(start + step, end)]
+        node = node.right
+
+
+def iter_range(node, start, end):
+    """按顺序产出 [start, end) 落在每个 piece 里的那段文本；只读，不像 split 那样复制节点"""
+    # 栈里是还要读的 (节点, 它在文档里的起点)：先下到 start 所在的 piece，路上往左拐过的节点排在它后面
+    stack = []
+    base = 0
+    while node:
+        node_start = base + (node.left.size if node.left else 0)
+        if start < node_start:
+            stack.append((node, node_start))
+            node = node.left
+        elif start < node_start + node.length:
+            stack.append((node, node_start))
+            break
+        else:
+            base = node_start + node.length
+            node = node.right
+    while stack:
+        node, node_start = stack.pop()
+        if node_start >= end:
+            return
+        offset = node.start - node_start
+        yield node.buffer.text[max(start, node_start) + offset:min(end, node_start + node.length) + offset]
+        # 右子树里最左边的一串接在它后面
+        base = node_start + node.length
+        node = node.right
+        while node:
+            node_start = base + (node.left.size if node.left else 0)
+            stack.append((node, node_start))
+            node = node.left
+
+
+class PieceTable:
+    """piece table 文档
+
+    插入、删除都是 O(log pieces)，与文件大小无关。撤销历史（UndoHistory）
+    只记每次编辑删掉的文本和插入的长度，不留旧的根节点，所以不会把删掉
+    的缓冲区一直留在内存里，总量受内存预算限制。每次编辑得到一个新的
+    版本号，撤销、重做回到对应的版本号；保存时记住当时的版本号，是否
+    修改过就是比较这两个号。
+    """
+
+    def __init__(self, original='', undo_budget=None):
+        self.root = self.make_piece(original)
+        self.add_buffer = Buffer()
+        self.revisions = count(1)
+        self.revision = 0
+        self.saved_revision = 0
+        self.history = UndoHistory(undo_budget)
+
+    @staticmethod
+    def make_piece(text):
+        if not text:
+            return None
+        buffer = Buffer(text)
+        return Piece(buffer, 0, len(text), len(buffer.line_starts), random.random(), None, None)
+
+    def append_text(self, node, text):
+        """text 追加到追加缓冲区，接在树 node 的最后；最后一个 piece 正好停在缓冲区
+        末尾时（连续输入）直接加长它，不增加 piece"""
+        buffer = self.add_buffer
+        if len(buffer.text) + len(text) > ADD_BUFFER_SIZE:
+            if len(text) > ADD_BUFFER_SIZE:
+                # 大段粘贴自己一块，不用复制进追加缓冲区
+                return merge(node, self.make_piece(text))
+            buffer = self.add_buffer = Buffer()
+        start = len(buffer.text)
+        newlines = len(buffer.line_starts)
+        buffer.append(text)
+        newlines = len(buffer.line_starts) - newlines
+        last = node
+        while last and last.right:
+            last = last.right
+        if last and last.buffer is buffer and last.start + last.length == start:
+            return extend_last(node, len(text), newlines)
+        return merge(node, Piece(buffer, start, len(text), newlines, random.random(), None, None))
+
+    def __len__(self):
+        return self.root.size if self.root else 0
+
+    def line_count(self):
+        return (self.root.lines if self.root else 0) + 1
+
+    def insert(self, position, text):
+        if not text:
+            return
+        if self.continues_typing(position, text):
+            # 连续输入合并成一步撤销
+            self.root = self.splice(position, 0, text)
+            self.revision = next(self.revisions)
+            self.history.extend_last(len(text), self.revision)
+            return
+        self.commit(position, 0, text)
+
+    def continues_typing(self, position, text):
+        if self.history.redo_stack or '\n' in text or self.revision == self.saved_revision:
+            return False
+        edit = self.history.last_edit()
+        return edit is not None and edit.removed_length == 0 and edit.position + edit.added_length == position
+
+    def delete(self, position, length):
+        if length <= 0:
+            return
+        self.commit(position, length, '')
+
+    def replace(self, position, length, text):
+        """删掉再插入，算一步撤销（比如全部替换）"""
+        self.commit(position, length, text)
+
+    def splice(self, position, length, text):
+        left, rest = split(self.root, position)
+        _, right = split(rest, length)
+        if text:
+            left = self.append_text(left, text)
+        return merge(left, right)
+
+    def commit(self, position, removed, text):
+        removed_text = self.text(position, position + removed)
+        before = self.revision
+        self.root = self.splice(position, removed, text)
+        self.revision = next(self.revisions)
+        self.history.record(position, removed_text, len(text), before, self.revision)
+
+    def begin_group(self):
+        """到配对的 end_group 为止的编辑算一步撤销，可以嵌套"""
+        self.history.begin_group()
+
+    def end_group(self):
+        self.history.end_group()
+
+    def can_undo(self):
+        return bool(self.history.undo_stack)
+
+    def can_redo(self):
+        return bool(self.history.redo_stack)
+
+    def undo(self):
+        """撤销一步，逐个产生 (位置, 要删掉的长度, 要插回的文本)，界面照此更新
+
+        一步里可能有好几处编辑（编辑事务），每产生一个时 piece table 正好
+        改到这一处，所以调用方必须迭代完。没有可撤销的时候什么也不产生。
+        """
+        step = self.history.undo()
+        if step is None:
+            return
+        for edit in reversed(step.edits):
+            end = edit.position + edit.added_length
+            if edit.added is None:
+                self.history.store_added(step, edit, self.text(edit.position, end))
+            text = self.history.load(edit.removed)
+            self.root = self.splice(edit.position, edit.added_length, text)
+            yield edit.position, edit.added_length, text
+        self.revision = step.before
+
+    def redo(self):
+        """重做一步，产生的内容和要求同 undo"""
+        step = self.history.redo()
+        if step is None:
+            return
+        for edit in step.edits:
+            text = self.history.load(edit.added)
+            self.root = self.splice(edit.position, edit.removed_length, text)
+            yield edit.position, edit.removed_length, text
+        self.revision = step.after
+
+    def clear_history(self):
+        self.history.clear()
+
+    def is_modified(self):
+        return self.revision != self.saved_revision
+
+    def mark_saved(self, revision=None):
+        """记下保存时的版本号；后台保存完成时传入开始保存时的 revision"""
+        self.saved_revision = self.revision if revision is None else revision
+
+    def mark_unsaved(self):
+        """保存失败：哪个版本都不算保存过"""
+        self.saved_revision = -1
+
+    def snapshot(self):
+        """当前内容的只读快照（就是当前的根节点），可以交给 iter_chunks 在别的线程里读"""
+        return self.root
+
+    def chunks(self, limit=None):
+        return iter_chunks(self.root, limit)
+
+    def text(self, start=0, end=None):
+        if end is None:
+            end = len(self)
+        if start >= end:
+            return ''
+        return ''.join(iter_range(self.root, start, end))
+
+    def line_start(self, line):
+        """第 line 行（从 0 开始）行首的字符位置"""
+        if line <= 0 or self.root is None:
+            return 0
+        if line > self.root.lines:
+            return len(self)
+        node = self.root
+        base = 0
+        while True:
+            left_lines = node.left.lines if node.left else 0
+            left_size = node.left.size if node.left else 0
+            if line <= left_lines:
+                node = node.left
+            elif line <= left_lines + node.newlines:
+                starts = node.buffer.line_starts
+                index = bisect_left(starts, node.start + 1) + line - left_lines - 1
+                return base + left_size + starts[index] - node.start
+            else:
+                line -= left_lines + node.newlines
+                base += left_size + node.length
+                node = node.right
+
+    def line_column(self, position):
+        """字符位置对应的 (行, 列)，都从 0 开始"""
+        node = self.root
+        line = 0
+        offset = position
+        while node:
+            left_size = node.left.size if node.left else 0
+            if offset < left_size:
+                node = node.left
+            elif offset < left_size + node.length or node.right is None:
+                line += node.left.lines if node.left else 0
+                line += node.buffer.count_newlines(node.start, node.start + min(offset - left_size, node.length))
+                break
+            else:
+                line += (node.left.lines if node.left else 0) + node.newlines
+                offset -= left_size + node.length
+                node = node.right
+        return line, position - self.line_start(line)
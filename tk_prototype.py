@@ -1,17 +1,51 @@
 import tkinter as tk
+from tkinter import ttk
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Any
 from tkinter import filedialog
 from tkinter import messagebox
 from tkinter import Event
+from tkinter import font as tkfont
 import os
+import queue
+import re
+import time
+from bisect import bisect
+
+from file_io import ChunkReader, AtomicSaver, SAVE_BLOCK_SIZE, disk_state, file_digest
+from piece_table import PieceTable, iter_chunks
+from journal import RecoveryJournal, find_journals, read_records, remove_journal, base_changed, replay
+from folder_scan import FolderScanner, entry_key
+from find_in_files import FileSearch, SearchCache
+from find_replace import MatchIndex
+from file_watch import check_file, changed_regions
+from languages import registry, DETECT_SIZE
+from tokenizer import Tokenizer
+
+# 恢复日志写盘的间隔（毫秒）
+JOURNAL_FLUSH_INTERVAL = 1000
+# 侧边栏每次最多插入的批数，剩下的留给下一次 after
+FOLDER_BATCHES_PER_TICK = 8
+# 在文件夹里查找：停止输入这么久（毫秒）之后才开始搜
+FIND_DEBOUNCE = 150
+# 每次 after 最多取出的搜索结果（文件）数
+FIND_FILES_PER_TICK = 64
+# 列表里最多显示的匹配行数，更多的只计数
+FIND_MAX_RESULTS = 5000
+# 检查文件有没有被别的程序改过的间隔（毫秒），平时只是一次 stat
+WATCH_INTERVAL = 1000
+# 高亮：每批分词、打标签的行数，以及每次空闲时最多占用的秒数
+HIGHLIGHT_BATCH = 200
+HIGHLIGHT_SLICE = 0.02
 @dataclass
 class FileState:
     file_path: Optional[Path] = None
     file_name: Optional[str] = None
     is_modified: bool = False
     file_exists: bool = False
+    # 最后一次读写时磁盘上文件的 (修改时间, 大小, 哈希)
+    disk_state: Optional[tuple] = None
 
 class AdorableKatze:
     def __init__(self):
@@ -22,8 +56,49 @@ class AdorableKatze:
             is_modified = False,
             file_exists = False
         )
-        self.original_content = ""
+        # 文本内容的 piece table 镜像，用来判断是否修改、保存和撤销
+        self.piece_table = PieceTable()
+        self.reader: Optional[ChunkReader] = None
+        self.saver: Optional[AtomicSaver] = None
+        self.saving_snapshot: Any = None
+        self.saving_revision = 0
+        self.saving_path: Optional[str] = None
+        # 崩溃恢复日志，位置按字符计
+        self.journal = RecoveryJournal(None, "chars")
+        self.folder_scanner: Optional[FolderScanner] = None
+        self.folder_tree: Optional[ttk.Treeview] = None
+        # 每个已展开目录里子节点的排序键，分批到达的结果按它插到正确位置
+        self.folder_keys: dict = {}
+        self.folder_path: Optional[str] = None
+        self.find_window: Optional[tk.Toplevel] = None
+        self.folder_search: Optional[FileSearch] = None
+        # 多次搜索共用，同一个查询再搜时没变的文件直接用上次的结果
+        self.find_cache = SearchCache()
+        self.find_folder: Optional[str] = None
+        self.find_after: Optional[str] = None
+        # 列表里每一行对应的 (路径, 行号)
+        self.find_locations: list = []
+        self.find_match_count = 0
+        # 文件读完后要跳到的行（从在文件夹里查找的结果打开时）
+        self.pending_line: Optional[int] = None
+        # 查找栏：匹配位置在 piece table 上随编辑增量维护
+        self.find_index = MatchIndex()
+        self.find_bar: Optional[tk.Frame] = None
+        self.find_anchor = 0
+        self.find_refresh_pending = False
+        # 语法高亮：line_states[n] 是第 n 行结尾的分词状态，只存已经高亮过的那些行；
+        # frontier 之前的行都是对的，dirty_end 及之前的行不管状态如何都要重新分词
+        self.tokenizer: Optional[Tokenizer] = None
+        self.syntax_tags: dict = {}
+        self.line_states: list = []
+        self.highlight_frontier = 0
+        self.highlight_dirty_end = -1
+        self.highlight_line_count = 1
+        self.highlight_pending = False
         self.setup_interface()
+        self.root.after(JOURNAL_FLUSH_INTERVAL, self.flush_journal)
+        self.root.after(WATCH_INTERVAL, self.watch_file)
+        self.root.after(0, self.offer_recovery)
     def setup_interface(self):
         # init win
         self.root = tk.Tk()
@@ -32,6 +107,8 @@ class AdorableKatze:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.Menu_bar()
         self.Main_frame()
+        # Ctrl+Shift+F
+        self.root.bind("<Control-F>", self.find_in_folder)
         self.Status_bar()
     def Menu_bar(self):
         # init bar
@@ -43,6 +120,7 @@ class AdorableKatze:
         file_menu.add_command(label="new", command=self.new)
         file_menu.add_command(label="open file", command=self.open_file)
         file_menu.add_command(label="open folder", command=self.open_folder)
+        file_menu.add_command(label="find in folder", command=self.find_in_folder)
         file_menu.add_command(label="save", command=self.save)
         file_menu.add_command(label="save as", command=self.save_as)
     def new(self):
@@ -54,15 +132,18 @@ class AdorableKatze:
             if save_changes == None:
                 return
             elif save_changes:
-                if not self.save():
+                if not self.save(wait=True):
                     return
         self.text.delete(1.0, tk.END)
+        self.piece_table = PieceTable()
+        self.start_journal()
         self.file_state = FileState()
+        self.setup_highlighting()
         self.update_title()
 
     def open_file(self):
         if self.file_state.is_modified:
-            if not self.save():
+            if not self.save(wait=True):
                 return
         file_path = filedialog.askopenfilename(
             title="select file",
@@ -72,25 +153,99 @@ class AdorableKatze:
         )
         if not file_path:
             return
+        self.load_file(file_path)
+
+    def load_file(self, file_path: str) -> None:
+        # 后台线程分块读取，after 定时把读好的文本块追加进来
+        self.cancel_loading()
         try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = file.read()
-            self.text.delete(1.0, tk.END)
-            self.text.insert(1.0, content)
-            self.file_state = FileState(
-                file_path = Path(file_path),
-                file_name = os.path.basename(file_path),
-                is_modified = False,
-                file_exists = True
-            )
-            self.original_content = content
-            self.text.edit_modified(False)
-            self.update_title()
-            if hasattr(self, 'update_statusbar'):
-                self.update_statusbar()
-            self.text.focus_set()
+            self.reader = ChunkReader(file_path, "utf-8")
         except Exception as e:
             messagebox.showerror("Error", f"an error occurred: {str(e)}")
+            return
+        self.text.delete(1.0, tk.END)
+        self.piece_table = PieceTable()
+        self.file_state = FileState()
+        self.setup_highlighting()
+        self.update_title()
+        self.text.config(state=tk.DISABLED)
+        self.root.bind("<Escape>", self.cancel_loading)
+        self.reader.start()
+        self.root.after(1, self.append_chunks, file_path)
+
+    def append_chunks(self, file_path: str) -> None:
+        if not self.reader:
+            return
+        self.text.config(state=tk.NORMAL)
+        try:
+            for _ in range(4):
+                try:
+                    content = self.reader.chunks.get_nowait()
+                except queue.Empty:
+                    break
+                if content is None:
+                    self.finish_loading(file_path)
+                    return
+                self.text.insert(tk.END + "-1c", content)
+        finally:
+            if self.reader:
+                self.text.config(state=tk.DISABLED)
+        self.status_var.set(f"Loading {os.path.basename(file_path)} {self.reader.progress()}% (Esc to cancel)")
+        self.root.after(1, self.append_chunks, file_path)
+
+    def finish_loading(self, file_path: str) -> None:
+        reader = self.reader
+        self.stop_loading()
+        if reader.error:
+            self.pending_line = None
+            self.text.delete(1.0, tk.END)
+            self.piece_table = PieceTable()
+            self.start_journal()
+            self.text.edit_modified(False)
+            self.update_statusbar()
+            messagebox.showerror("Error", f"an error occurred: {str(reader.error)}")
+            return
+        self.file_state = FileState(
+            file_path = Path(file_path),
+            file_name = os.path.basename(file_path),
+            is_modified = False,
+            file_exists = True,
+            disk_state = reader.disk_state
+        )
+        # 读进来的内容不算一次编辑
+        self.piece_table.clear_history()
+        self.piece_table.mark_saved()
+        self.start_journal(file_path)
+        self.setup_highlighting(file_path)
+        self.text.edit_modified(False)
+        self.text.mark_set(tk.INSERT, 1.0)
+        self.update_title()
+        self.update_statusbar()
+        self.text.focus_set()
+        if self.find_bar and self.find_bar.winfo_ismapped():
+            # 查找栏开着时，在新文档里重新搜
+            self.find_anchor = 0
+            self.find_search()
+        line, self.pending_line = self.pending_line, None
+        if line is not None:
+            self.go_to_line(line)
+
+    def cancel_loading(self, event: Optional[Any] = None) -> None:
+        if self.reader:
+            self.pending_line = None
+            self.stop_loading()
+            self.text.delete(1.0, tk.END)
+            self.piece_table = PieceTable()
+            self.start_journal()
+            self.text.edit_modified(False)
+            self.update_statusbar()
+
+    def stop_loading(self) -> None:
+        self.reader.cancel()
+        self.reader = None
+        self.root.unbind("<Escape>")
+        self.text.config(state=tk.NORMAL)
+
     def update_statusbar(self):
         status = "Ready"
         if self.file_state.file_name:
@@ -98,49 +253,437 @@ class AdorableKatze:
         if self.file_state.is_modified:
             status += "* Modified"
         self.status_var.set(status)
-    def open_folder(self):
-        pass
-    def save(self):
-        if not self.file_state.file_path:
-            return self.save_as()
+
+    def flush_journal(self) -> None:
         try:
-            content = self.text.get(1.0, tk.END)
-            with open(self.file_state.file_path, "w", encoding="utf-8") as file:
-                file.write(content.rstrip())
-            self.file_state.is_modified = False
-            self.original_content = content
-            self.text.edit_modified(False)
-            self.update_title()
-            self.update_statusbar()
-            return True
+            self.journal.flush()
+        except OSError as e:
+            print(e)
+        self.root.after(JOURNAL_FLUSH_INTERVAL, self.flush_journal)
+
+    def start_journal(self, file_path: Optional[str] = None, records: Any = ()) -> None:
+        # 换一个文档时丢掉旧的恢复日志，records 是恢复出来、还没保存的修改
+        self.journal.discard()
+        self.journal = RecoveryJournal(file_path, "chars")
+        for record in records:
+            self.journal.record(*record)
+
+    def offer_recovery(self) -> None:
+        # 上次没有正常退出时，提示从恢复日志里找回没保存的修改
+        journals = find_journals("chars")
+        if not journals:
+            return
+        journal_path, header = journals[0]
+        file_path = header.get("path")
+        file_name = os.path.basename(file_path) if file_path else "untitled file"
+        message = f"{file_name} has unsaved changes from a previous session. Recover them ?"
+        if file_path and base_changed(header):
+            message += f"\n{file_name} has been changed on disk since then, the recovered text may be wrong."
+        records = None
+        if messagebox.askyesno("Recover changes", message):
+            try:
+                records = read_records(journal_path)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Error", f"an error occurred: {str(e)}")
+        try:
+            remove_journal(journal_path)
+        except OSError as e:
+            print(e)
+        if records is not None:
+            self.recover(file_path, records)
+
+    def recover(self, file_path: Optional[str], records: list) -> None:
+        try:
+            content = ""
+            if file_path and os.path.exists(file_path):
+                with open(file_path, "r", encoding="utf-8") as file:
+                    content = file.read()
+            table = replay(content, records)
         except Exception as e:
             messagebox.showerror("Error", f"an error occurred: {str(e)}")
-            return False
-    def save_as(self):
+            return
+        self.cancel_loading()
+        # 绕过代理直接换掉内容，piece table 用重放出来的那份（保存点是磁盘上的原文件）
+        self.root.tk.call(self.text_command, "delete", "1.0", tk.END)
+        self.root.tk.call(self.text_command, "insert", "1.0", table.text())
+        self.piece_table = table
+        self.start_journal(file_path, records)
+        self.setup_highlighting(file_path)
+        state = None
+        if file_path and os.path.exists(file_path):
+            try:
+                state = disk_state(file_path, file_digest(file_path))
+            except OSError as e:
+                print(e)
+        self.file_state = FileState(
+            file_path = Path(file_path) if file_path else None,
+            file_name = os.path.basename(file_path) if file_path else None,
+            is_modified = table.is_modified(),
+            file_exists = bool(file_path and os.path.exists(file_path)),
+            disk_state = state
+        )
+        self.text.edit_modified(False)
+        self.update_title()
+        self.update_statusbar()
+
+    def open_folder(self):
+        folder_path = filedialog.askdirectory(title="select folder")
+        if not folder_path:
+            return
+        folder_path = os.path.abspath(folder_path)
+        self.folder_path = folder_path
+        if self.find_window and self.find_window.winfo_viewable():
+            self.find_in_folder()
+        if not self.folder_tree:
+            self.setup_folder_tree()
+        if self.folder_scanner:
+            self.folder_scanner.stop()
+        # 每个文件夹一个扫描线程，换文件夹时旧线程丢掉还没处理的请求
+        self.folder_scanner = FolderScanner()
+        self.folder_scanner.start()
+        self.folder_tree.delete(*self.folder_tree.get_children())
+        self.folder_keys = {}
+        self.folder_tree.insert("", tk.END, iid=folder_path, text=os.path.basename(folder_path) or folder_path,
+                                open=True, values=("dir",))
+        self.request_folder(folder_path)
+
+    def setup_folder_tree(self) -> None:
+        self.sidebar.config(width=220)
+        self.sidebar.pack_propagate(False)
+        scrollbar = tk.Scrollbar(self.sidebar)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.folder_tree = ttk.Treeview(self.sidebar, show="tree", columns=("kind",), displaycolumns=(),
+                                        yscrollcommand=scrollbar.set)
+        self.folder_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=self.folder_tree.yview)  # type: ignore
+        self.folder_tree.bind("<<TreeviewOpen>>", self.on_folder_open)
+        self.folder_tree.bind("<Double-1>", self.on_folder_activate)
+        self.folder_tree.bind("<Return>", self.on_folder_activate)
+
+    def request_folder(self, folder_path: str) -> None:
+        # 先放一个占位子节点（iid 是目录加一个分隔符，不会和真实路径重名），等第一批结果回来再换掉
+        self.folder_tree.insert(folder_path, tk.END, iid=folder_path + os.sep, text="loading...")
+        self.folder_tree.item(folder_path, values=("loading",))
+        self.folder_scanner.request(folder_path)
+        if self.folder_scanner.pending == 1:
+            self.root.after(10, self.poll_folder, self.folder_scanner)
+
+    def on_folder_open(self, event: Optional[Any] = None) -> None:
+        folder_path = self.folder_tree.focus()
+        # 只有第一次展开时才扫描，之后就是普通的展开/收起
+        if self.folder_tree.set(folder_path, "kind") == "dir":
+            self.folder_tree.delete(*self.folder_tree.get_children(folder_path))
+            self.request_folder(folder_path)
+
+    def poll_folder(self, scanner: FolderScanner) -> None:
+        if scanner is not self.folder_scanner:
+            return
+        for _ in range(FOLDER_BATCHES_PER_TICK):
+            result = scanner.take()
+            if result is None:
+                break
+            folder_path, entries, done, error = result
+            if not self.folder_tree.exists(folder_path):
+                continue
+            keys = self.folder_keys.get(folder_path)
+            if keys is None:
+                keys = self.folder_keys[folder_path] = []
+                self.folder_tree.delete(folder_path + os.sep)
+            # 每批在工作线程里已经排好序，这里按键归并进已有的子节点
+            for entry in entries:
+                key = entry_key(entry)
+                index = bisect(keys, key)
+                keys.insert(index, key)
+                name, is_directory = entry
+                path = os.path.join(folder_path, name)
+                if is_directory:
+                    self.folder_tree.insert(folder_path, index, iid=path, text=name, values=("dir",))
+                    # 占位子节点让目录显示展开箭头
+                    self.folder_tree.insert(path, tk.END, iid=path + os.sep, text="")
+                else:
+                    self.folder_tree.insert(folder_path, index, iid=path, text=name, values=("file",))
+            if done:
+                self.folder_tree.item(folder_path, values=("loaded",))
+                if error:
+                    self.status_var.set(f"cannot list {folder_path}: {error}")
+        if scanner.pending:
+            self.root.after(10, self.poll_folder, scanner)
+
+    def on_folder_activate(self, event: Optional[Any] = None) -> Optional[str]:
+        file_path = self.folder_tree.focus()
+        if not file_path or self.folder_tree.set(file_path, "kind") != "file":
+            return None
+        if self.file_state.is_modified:
+            if not self.save(wait=True):
+                return "break"
+        self.load_file(file_path)
+        return "break"
+
+    def find_in_folder(self, event: Optional[Any] = None) -> None:
+        if not self.folder_path:
+            self.open_folder()
+            if not self.folder_path:
+                return
+        if not self.find_window:
+            self.setup_find_window()
+        self.find_window.deiconify()
+        self.find_window.lift()
+        self.folder_entry.focus_set()
+        self.folder_entry.select_range(0, tk.END)
+        if self.find_folder != self.folder_path:
+            self.find_folder = self.folder_path
+            self.start_folder_search()
+
+    def setup_find_window(self) -> None:
+        self.find_window = tk.Toplevel(self.root)
+        self.find_window.title("find in folder")
+        self.find_window.geometry("640x420")
+        self.find_window.protocol("WM_DELETE_WINDOW", self.close_find_window)
+        options = tk.Frame(self.find_window)
+        options.pack(side=tk.TOP, fill=tk.X)
+        self.folder_query = tk.StringVar()
+        self.find_regex = tk.BooleanVar(value=False)
+        self.find_case = tk.BooleanVar(value=True)
+        self.folder_entry = tk.Entry(options, textvariable=self.folder_query)
+        self.folder_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Checkbutton(options, text="regex", variable=self.find_regex).pack(side=tk.LEFT)
+        tk.Checkbutton(options, text="case", variable=self.find_case).pack(side=tk.LEFT)
+        self.find_status = tk.StringVar()
+        tk.Label(self.find_window, textvariable=self.find_status, anchor=tk.W).pack(side=tk.BOTTOM, fill=tk.X)
+        scrollbar = tk.Scrollbar(self.find_window)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.find_list = tk.Listbox(self.find_window, font=("Consolas", 10), yscrollcommand=scrollbar.set)
+        self.find_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=self.find_list.yview)  # type: ignore
+        for variable in (self.folder_query, self.find_regex, self.find_case):
+            variable.trace_add("write", self.schedule_folder_search)
+        self.folder_entry.bind("<Return>", lambda event: self.start_folder_search())
+        self.find_list.bind("<Double-1>", self.on_find_activate)
+        self.find_list.bind("<Return>", self.on_find_activate)
+
+    def close_find_window(self) -> None:
+        self.stop_folder_search()
+        self.find_window.withdraw()
+
+    def schedule_folder_search(self, *args: Any) -> None:
+        # 边输入边搜：每次修改都推迟开始，停下来之后才真正搜索
+        if self.find_after:
+            self.root.after_cancel(self.find_after)
+        self.find_after = self.root.after(FIND_DEBOUNCE, self.start_folder_search)
+
+    def start_folder_search(self) -> None:
+        if self.find_after:
+            self.root.after_cancel(self.find_after)
+            self.find_after = None
+        self.stop_folder_search()
+        self.find_list.delete(0, tk.END)
+        self.find_locations = []
+        self.find_match_count = 0
+        query = self.folder_query.get()
+        if not query or not self.find_folder:
+            self.find_status.set("")
+            return
+        self.folder_search = FileSearch(self.find_folder, query, self.find_regex.get(), self.find_case.get(),
+                                      self.find_cache)
+        self.folder_search.start()
+        self.find_status.set("searching...")
+        self.root.after(10, self.poll_folder_search, self.folder_search)
+
+    def stop_folder_search(self) -> None:
+        if self.folder_search:
+            self.folder_search.cancel()
+            self.folder_search = None
+
+    def poll_folder_search(self, search: FileSearch) -> None:
+        if search is not self.folder_search:
+            return
+        for _ in range(FIND_FILES_PER_TICK):
+            try:
+                result = search.results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.finish_folder_search(search)
+                return
+            file_path, matches = result
+            relative_path = os.path.relpath(file_path, self.find_folder)
+            for line, column, text in matches:
+                self.find_match_count += 1
+                if self.find_match_count > FIND_MAX_RESULTS:
+                    continue
+                self.find_list.insert(tk.END, f"{relative_path}:{line + 1}: {text.strip()}")
+                self.find_locations.append((file_path, line))
+        self.find_status.set(f"searching... {self.find_match_count} matches in {search.files_matched} files")
+        self.root.after(10, self.poll_folder_search, search)
+
+    def finish_folder_search(self, search: FileSearch) -> None:
+        self.folder_search = None
+        if search.error:
+            self.find_status.set(f"error: {search.error}")
+            return
+        shown = "" if self.find_match_count <= FIND_MAX_RESULTS else f" (showing {FIND_MAX_RESULTS})"
+        self.find_status.set(
+            f"{self.find_match_count} matches in {search.files_matched} of {search.files_searched} files{shown}"
+        )
+
+    def on_find_activate(self, event: Optional[Any] = None) -> str:
+        selection = self.find_list.curselection()
+        if selection:
+            self.open_at(*self.find_locations[selection[0]])
+        return "break"
+
+    def open_at(self, file_path: str, line: int) -> None:
+        # 打开文件并跳到指定行（从 0 开始），已经打开的文件直接跳
+        if self.file_state.file_path == Path(file_path) and not self.reader:
+            self.go_to_line(line)
+            return
+        if self.file_state.is_modified:
+            if not self.save(wait=True):
+                return
+        self.load_file(file_path)
+        if self.reader:
+            # 还在后台读，读完之后再跳
+            self.pending_line = line
+
+    def go_to_line(self, line: int) -> None:
+        index = f"{line + 1}.0"
+        self.text.mark_set(tk.INSERT, index)
+        self.text.see(index)
+        self.text.focus_set()
+    def save(self, wait: bool = False) -> bool:
+        if not self.file_state.file_path:
+            return self.save_as(wait)
+        if not self.saver:
+            # 打开之后被别的程序改过时先问一下，不悄悄覆盖
+            changed, _ = check_file(str(self.file_state.file_path), self.file_state.disk_state)
+            if changed and not messagebox.askyesno(
+                "File changed",
+                f"{self.file_state.file_name} has been changed on disk by another program. Overwrite it ?"
+            ):
+                return False
+        return self.start_saving(str(self.file_state.file_path), wait)
+    def save_as(self, wait: bool = False) -> bool:
         file_path = filedialog.asksaveasfilename(
             title="Save as",
             filetypes=[("all", "*.*")]
         )
         if not file_path:
             return False
-        try:
-            content = self.text.get(1.0, tk.END)
-            with open(file_path, "w", encoding="utf-8") as file:
-                file.write(content.rstrip())
-            self.file_state = FileState(
-                file_path = Path(file_path),
-                file_name = os.path.basename(file_path),
-                is_modified = False,
-                file_exists = True
-            )
-            self.original_content = content
-            self.text.edit_modified(False)
-            self.update_title()
+        return self.start_saving(file_path, wait)
+
+    def start_saving(self, file_path: str, wait: bool) -> bool:
+        # 后台线程按 piece 逐段写临时文件再改名，保存期间可以继续编辑；
+        # wait 为 True 时等写完，返回是否保存成功
+        if self.reader:
+            return False
+        if self.saver:
+            self.finish_saving()
+        self.journal.set_checkpoint()
+        self.saving_snapshot = self.piece_table.snapshot()
+        self.saving_revision = self.piece_table.revision
+        self.saving_path = file_path
+        self.saver = AtomicSaver(file_path, iter_chunks(self.saving_snapshot, SAVE_BLOCK_SIZE), "utf-8")
+        self.saver.start()
+        self.status_var.set(f"Saving {os.path.basename(file_path)}...")
+        if wait:
+            return self.finish_saving()
+        self.root.after(20, self.check_saving)
+        return True
+
+    def check_saving(self) -> None:
+        if not self.saver:
+            return
+        if self.saver.done.is_set():
+            self.finish_saving()
+        else:
+            self.root.after(20, self.check_saving)
+
+    def finish_saving(self) -> bool:
+        saver = self.saver
+        saver.join()
+        self.saver = None
+        if saver.error:
+            self.journal.checkpoint = None
             self.update_statusbar()
-            return True
+            messagebox.showerror("Error", f"an error occurred: {str(saver.error)}")
+            return False
+        self.piece_table.mark_saved(self.saving_revision)
+        self.saving_snapshot = None
+        try:
+            # 保存期间的输入以刚保存的文件为基准留在日志里
+            self.journal.rebase(self.saving_path)
+        except OSError as e:
+            print(e)
+        file_path = Path(self.saving_path)
+        renamed = file_path != self.file_state.file_path
+        self.file_state = FileState(
+            file_path = file_path,
+            file_name = file_path.name,
+            is_modified = self.piece_table.is_modified(),
+            file_exists = True,
+            disk_state = saver.disk_state
+        )
+        if renamed:
+            # 另存为换了扩展名时语言也可能变了
+            self.setup_highlighting(self.saving_path)
+        self.update_title()
+        self.update_statusbar()
+        return True
+
+    def watch_file(self) -> None:
+        # Tk 没有文件变动的通知，定时检查；修改时间和大小没变时只是一次 stat
+        self.check_external_change()
+        self.root.after(WATCH_INTERVAL, self.watch_file)
+
+    def check_external_change(self) -> None:
+        if not self.file_state.file_path or self.reader or self.saver:
+            return
+        file_path = str(self.file_state.file_path)
+        changed, state = check_file(file_path, self.file_state.disk_state)
+        # 只是被 touch 过时也记下新的修改时间，下次不用再算哈希
+        self.file_state.disk_state = state
+        if not changed:
+            return
+        if self.file_state.is_modified and not messagebox.askyesno(
+            "File changed",
+            f"{self.file_state.file_name} has been changed on disk by another program. "
+            f"Reload it and lose your changes ?"
+        ):
+            # 保留自己的修改，之后保存时覆盖磁盘上的版本
+            return
+        self.reload_from_disk(file_path)
+
+    def reload_from_disk(self, file_path: str) -> None:
+        # 只把变了的几段改进 Text，没变的部分的标记、光标和滚动位置都不动
+        try:
+            with open(file_path, "r", encoding="utf-8") as file:
+                content = file.read()
         except Exception as e:
             messagebox.showerror("Error", f"an error occurred: {str(e)}")
-            return False
+            return
+        old_length = len(self.piece_table)
+        regions = changed_regions(self.piece_table.text(), content)
+        if regions:
+            # 从后往前改，前面的位置还能按改之前的 piece table 换算；绕过代理，
+            # piece table 把整个改动范围作为一次替换，重新加载是一步撤销
+            for start, end, replacement in regions:
+                index = self.text_index(start)
+                self.root.tk.call(self.text_command, "delete", index, self.text_index(end))
+                self.root.tk.call(self.text_command, "insert", index, replacement)
+            first, last = regions[-1][0], regions[0][1]
+            span = content[first:len(content) - (old_length - last)]
+            self.piece_table.replace(first, last - first, span)
+            self.highlight_changed(first, span)
+            if self.find_index.expression is not None:
+                self.find_index.update(self.piece_table, first, last - first, len(span))
+                self.schedule_find_refresh()
+        # 现在的内容就是磁盘上的文件，保存点和恢复日志都以它为准
+        self.piece_table.mark_saved()
+        self.start_journal(file_path)
+        self.file_state.is_modified = False
+        self.text.edit_modified(False)
+        self.update_title()
+        self.update_statusbar()
 
     def Main_frame(self):
         main_container = tk.Frame(self.root)
@@ -149,25 +692,376 @@ class AdorableKatze:
         self.sidebar.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 10)) # x 侧边距0~10
         edit_area = tk.Frame(main_container)
         edit_area.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
+        self.edit_area = edit_area
         scrollbar = tk.Scrollbar(edit_area)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text_scrollbar = scrollbar
         self.text = tk.Text(
             edit_area,
             wrap=tk.WORD,
-            yscrollcommand=scrollbar.set
+            # 撤销历史由 piece table 记（有内存预算），Text 自己不留撤销栈
+            undo=False,
+            yscrollcommand=self.on_text_scroll
         )
         self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True) # right 放滚动条
+        self.setup_text_proxy()
+        self.text.bind("<Control-z>", self.undo)
+        self.text.bind("<Control-y>", self.redo)
+        self.text.bind("<Control-f>", self.show_find_bar)
+        self.text.bind("<Control-h>", lambda event: self.show_find_bar(replace=True))
+        self.text.tag_configure("found", background="#FFE678")
+        self.text.tag_lower("found", "sel")
         scrollbar.config(command=self.text.yview) # type: ignore
         self.text.bind('<<Modified>>', self.on_text_modified)
         self.text.edit_modified(False)
         def on_mousewheel(event: Event):
             self.text.yview_scroll(int(-1 * (event.delta / 120)), "units")
         self.text.bind("<MouseWheel>", on_mousewheel)
+    def setup_text_proxy(self) -> None:
+        # 把 Text 的 Tcl 命令换成代理，insert/delete 执行的同时同步到 piece table
+        self.text_command = self.text._w + "_orig"
+        self.root.tk.call("rename", self.text._w, self.text_command)
+        self.root.tk.createcommand(self.text._w, self.text_proxy)
+
+    def text_proxy(self, command: str, *args: Any) -> Any:
+        call = self.root.tk.call
+        # 真正的文本命令放在 try 外面：它的 TclError（比如没有选区时 get sel.first）
+        # 要照常抛给 Tk 自己的绑定，那些绑定靠捕获它来判断
+        if command not in ("insert", "delete", "replace") or \
+                str(call(self.text_command, "cget", "-state")) != tk.NORMAL:
+            return call(self.text_command, command, *args)
+        if command == "delete" and len(args) > 2:
+            # 一次删多段的少见用法，直接按执行后的内容重建
+            length = len(self.piece_table)
+            result = call(self.text_command, command, *args)
+            self.piece_table = PieceTable(call(self.text_command, "get", "1.0", "end-1c"))
+            self.record_change(0, length, self.piece_table.text())
+            return result
+        # 位置要在改动之前算；下标写错时交给真正的命令去报错
+        try:
+            start = self.text_offset(args[0])
+            end = self.text_offset(args[1]) if command != "insert" and len(args) > 1 else start + 1
+        except (tk.TclError, IndexError):
+            return call(self.text_command, command, *args)
+        result = call(self.text_command, command, *args)
+        # 命令成功之后再同步到片段表
+        removed = 0
+        content = ""
+        if command == "insert":
+            content = "".join(args[1::2])
+            self.piece_table.insert(start, content)
+        else:
+            removed = max(min(end, len(self.piece_table)) - start, 0)
+            if command == "replace":
+                # 删除和插入算一步撤销
+                content = "".join(args[2::2])
+                self.piece_table.replace(start, removed, content)
+            else:
+                self.piece_table.delete(start, removed)
+        self.record_change(start, removed, content)
+        return result
+
+    def record_change(self, position: int, removed: int, content: str) -> None:
+        # 读文件时插进来的内容不算编辑，不进恢复日志
+        if not self.reader and (removed or content):
+            self.journal.record(position, removed, content)
+            self.highlight_changed(position, content)
+            if self.find_index.expression is not None:
+                self.find_index.update(self.piece_table, position, removed, len(content))
+                self.schedule_find_refresh()
+
+    def text_offset(self, index: str) -> int:
+        line, column = map(int, str(self.root.tk.call(self.text_command, "index", index)).split("."))
+        return min(self.piece_table.line_start(line - 1) + column, len(self.piece_table))
+
+    def undo(self, event: Optional[Any] = None) -> str:
+        for change in self.piece_table.undo():
+            self.apply_change(change)
+        return "break"
+
+    def redo(self, event: Optional[Any] = None) -> str:
+        for change in self.piece_table.redo():
+            self.apply_change(change)
+        return "break"
+
+    def apply_change(self, change: tuple) -> None:
+        # 撤销/重做已经改好了 piece table，这里绕过代理只更新界面
+        position, length, content = change
+        line, column = self.piece_table.line_column(position)
+        index = f"{line + 1}.{column}"
+        self.root.tk.call(self.text_command, "delete", index, f"{index} + {length} chars")
+        self.root.tk.call(self.text_command, "insert", index, content)
+        self.record_change(position, length, content)
+        self.text.mark_set(tk.INSERT, f"{index} + {len(content)} chars")
+        self.text.see(tk.INSERT)
+
+    def text_index(self, offset: int) -> str:
+        line, column = self.piece_table.line_column(offset)
+        return f"{line + 1}.{column}"
+
+    def on_text_scroll(self, first: str, last: str) -> None:
+        self.text_scrollbar.set(first, last)
+        self.schedule_find_refresh()
+
+    def show_find_bar(self, event: Optional[Any] = None, replace: bool = False) -> str:
+        if not self.find_bar:
+            self.setup_find_bar()
+        selection = self.text.tag_ranges("sel")
+        if selection:
+            self.find_anchor = self.text_offset(selection[0])
+            selected = self.text.get(selection[0], selection[1])
+            if "\n" not in selected:
+                self.find_query.set(selected)
+        else:
+            self.find_anchor = self.text_offset(tk.INSERT)
+        if not self.find_bar.winfo_ismapped():
+            self.find_bar.pack(side=tk.BOTTOM, fill=tk.X, before=self.text_scrollbar)
+            self.find_bar.update_idletasks()
+        self.find_search()
+        entry = self.find_replace_entry if replace else self.find_entry
+        entry.focus_set()
+        entry.select_range(0, tk.END)
+        return "break"
+
+    def setup_find_bar(self) -> None:
+        self.find_bar = tk.Frame(self.edit_area)
+        self.find_query = tk.StringVar()
+        self.find_replacement = tk.StringVar()
+        self.find_bar_regex = tk.BooleanVar(value=False)
+        self.find_bar_case = tk.BooleanVar(value=True)
+        self.find_bar_status = tk.StringVar()
+        self.find_entry = tk.Entry(self.find_bar, textvariable=self.find_query, width=24)
+        self.find_entry.pack(side=tk.LEFT)
+        tk.Checkbutton(self.find_bar, text="regex", variable=self.find_bar_regex).pack(side=tk.LEFT)
+        tk.Checkbutton(self.find_bar, text="case", variable=self.find_bar_case).pack(side=tk.LEFT)
+        tk.Label(self.find_bar, textvariable=self.find_bar_status, width=12, anchor=tk.W).pack(side=tk.LEFT)
+        tk.Button(self.find_bar, text="prev", command=self.find_previous).pack(side=tk.LEFT)
+        tk.Button(self.find_bar, text="next", command=self.find_next).pack(side=tk.LEFT)
+        self.find_replace_entry = tk.Entry(self.find_bar, textvariable=self.find_replacement, width=24)
+        self.find_replace_entry.pack(side=tk.LEFT, padx=(8, 0))
+        tk.Button(self.find_bar, text="replace", command=self.replace_current).pack(side=tk.LEFT)
+        tk.Button(self.find_bar, text="all", command=self.replace_all).pack(side=tk.LEFT)
+        for variable in (self.find_query, self.find_bar_regex, self.find_bar_case):
+            variable.trace_add("write", lambda *args: self.find_search())
+        self.find_entry.bind("<Return>", lambda event: self.find_next())
+        self.find_entry.bind("<Shift-Return>", lambda event: self.find_previous())
+        self.find_replace_entry.bind("<Return>", lambda event: self.replace_current())
+        for entry in (self.find_entry, self.find_replace_entry):
+            entry.bind("<Escape>", self.hide_find_bar)
+
+    def hide_find_bar(self, event: Optional[Any] = None) -> str:
+        self.find_bar.pack_forget()
+        self.find_index.clear()
+        self.text.tag_remove("found", "1.0", tk.END)
+        self.text.focus_set()
+        return "break"
+
+    def find_search(self) -> None:
+        if not self.find_bar or not self.find_bar.winfo_ismapped():
+            return
+        try:
+            self.find_index.search(self.piece_table, self.find_query.get(), self.find_bar_regex.get(),
+                                   self.find_bar_case.get())
+        except re.error:
+            self.find_index.clear()
+            self.find_bar_status.set("bad regex")
+            self.refresh_find_tags()
+            return
+        self.select_match_from(self.find_anchor)
+
+    def select_match_from(self, position: int, backwards: bool = False) -> None:
+        count = len(self.find_index)
+        if not count:
+            self.find_bar_status.set("no matches" if self.find_query.get() else "")
+            self.refresh_find_tags()
+            return
+        index = self.find_index.first_starting_at(position)
+        if backwards:
+            index -= 1
+        index %= count
+        start, end = self.find_index.span(index)
+        self.text.tag_remove("sel", "1.0", tk.END)
+        self.text.tag_add("sel", self.text_index(start), self.text_index(end))
+        self.text.mark_set(tk.INSERT, self.text_index(start))
+        self.text.see(tk.INSERT)
+        self.find_bar_status.set(f"{index + 1} of {count}")
+        self.refresh_find_tags()
+
+    def find_next(self) -> None:
+        selection = self.text.tag_ranges("sel")
+        position = self.text_offset(selection[0]) + 1 if selection else self.text_offset(tk.INSERT)
+        self.select_match_from(position)
+        self.find_anchor = self.text_offset(tk.INSERT)
+
+    def find_previous(self) -> None:
+        self.select_match_from(self.text_offset(tk.INSERT), backwards=True)
+        self.find_anchor = self.text_offset(tk.INSERT)
+
+    def current_match(self) -> Optional[int]:
+        # 选区正好是一个匹配时返回它的序号
+        selection = self.text.tag_ranges("sel")
+        if not selection:
+            return None
+        start, end = self.text_offset(selection[0]), self.text_offset(selection[1])
+        index = self.find_index.first_starting_at(start)
+        if index < len(self.find_index) and self.find_index.span(index) == (start, end):
+            return index
+        return None
+
+    def replace_current(self) -> None:
+        index = self.current_match()
+        if index is None:
+            self.find_next()
+            return
+        start, end = self.find_index.span(index)
+        try:
+            content = self.find_index.replacement(index, self.find_replacement.get())
+        except re.error:
+            self.find_bar_status.set("bad replacement")
+            return
+        self.text.replace(self.text_index(start), self.text_index(end), content)
+        self.select_match_from(start + len(content))
+
+    def replace_all(self) -> None:
+        try:
+            result = self.find_index.replace_all(self.find_replacement.get())
+        except re.error:
+            self.find_bar_status.set("bad replacement")
+            return
+        if result is None:
+            return
+        # 逐个替换匹配到的地方，在 piece table 里算一步撤销
+        delta = 0
+        self.piece_table.begin_group()
+        try:
+            for start, end, content in result:
+                self.text.replace(self.text_index(start + delta), self.text_index(end + delta), content)
+                delta += len(content) - (end - start)
+        finally:
+            self.piece_table.end_group()
+        self.find_bar_status.set(f"replaced {len(result)}")
+
+    def schedule_find_refresh(self) -> None:
+        if not self.find_refresh_pending and self.find_bar and self.find_bar.winfo_ismapped():
+            self.find_refresh_pending = True
+            self.root.after_idle(self.refresh_find_tags)
+
+    def refresh_find_tags(self) -> None:
+        # 只给视口里的匹配打标签，文档再大每次也只处理几十个
+        self.find_refresh_pending = False
+        self.text.tag_remove("found", "1.0", tk.END)
+        if not len(self.find_index):
+            return
+        first = self.text_offset("@0,0")
+        last = self.text_offset(f"@0,{self.text.winfo_height()} lineend")
+        for start, end in self.find_index.spans_between(first, last + 1):
+            self.text.tag_add("found", self.text_index(start), self.text_index(end))
+
+    def setup_highlighting(self, file_path: Optional[str] = None) -> None:
+        # 按文件名（认不出来时按开头的内容）选语言，整篇从头重新高亮；没有路径时不高亮
+        if self.syntax_tags:
+            self.text.tag_delete(*self.syntax_tags.values())
+        self.syntax_tags = {}
+        self.line_states = []
+        self.highlight_frontier = 0
+        self.highlight_dirty_end = -1
+        self.highlight_line_count = self.piece_table.line_count()
+        language = registry.detect(file_path, self.piece_table.text(0, DETECT_SIZE)) if file_path else None
+        self.tokenizer = Tokenizer(language) if language else None
+        if not self.tokenizer:
+            return
+        base = tkfont.Font(font=self.text.cget("font")).actual()
+        for name, style in language.styles.items():
+            tag = f"syntax_{name}"
+            options = {}
+            if "color" in style:
+                options["foreground"] = style["color"]
+            if style.get("bold") or style.get("italic") or "family" in style:
+                weight = "bold" if style.get("bold") else "normal"
+                slant = "italic" if style.get("italic") else "roman"
+                options["font"] = (style.get("family", base["family"]), base["size"], weight, slant)
+            self.text.tag_configure(tag, **options)
+            # 选中和查找结果的颜色盖在语法颜色上面
+            self.text.tag_lower(tag)
+            self.syntax_tags[name] = tag
+        self.schedule_highlight()
+
+    def highlight_changed(self, position: int, content: str) -> None:
+        # 按改动前后的行数差把各行状态对齐，改动的那几行标记为要重新分词
+        if not self.tokenizer:
+            return
+        line_count = self.piece_table.line_count()
+        line, _ = self.piece_table.line_column(position)
+        added = content.count("\n")
+        delta = line_count - self.highlight_line_count
+        removed = added - delta
+        self.highlight_line_count = line_count
+        if line < len(self.line_states):
+            # 改动的最后一行接着原来改动范围最后一行的结尾状态，用来判断后面的行还对不对；
+            # 前面的几行是新的，用 -1 占位，不会和算出来的状态相等
+            self.line_states[line:line + removed] = [-1] * added
+        if self.highlight_dirty_end >= line + removed:
+            self.highlight_dirty_end += delta
+        self.highlight_dirty_end = max(self.highlight_dirty_end, line + added)
+        self.highlight_frontier = min(self.highlight_frontier, line)
+        self.schedule_highlight()
+
+    def schedule_highlight(self) -> None:
+        if not self.highlight_pending:
+            self.highlight_pending = True
+            self.root.after_idle(self.highlight_step)
+
+    def highlight_step(self) -> None:
+        # 每次空闲时从 frontier 开始分几批；一行的结尾状态和原来一样、而且已经
+        # 过了改动的范围时，后面已经高亮过的行都不用动，直接跳到它们后面
+        self.highlight_pending = False
+        if not self.tokenizer or self.reader:
+            return
+        deadline = time.perf_counter() + HIGHLIGHT_SLICE
+        states = self.line_states
+        line_count = self.piece_table.line_count()
+        line = self.highlight_frontier
+        while line < line_count and time.perf_counter() < deadline:
+            batch_end = min(line + HIGHLIGHT_BATCH, line_count)
+            text = self.piece_table.text(self.piece_table.line_start(line), self.piece_table.line_start(batch_end))
+            lines = text.split("\n")[:batch_end - line]
+            state = states[line - 1] if line > 0 else 0
+            ranges: dict = {}
+            number = line
+            for tokens, state in self.tokenizer.tokenize_lines(lines, state):
+                for start, length, style, _ in tokens:
+                    tag = self.syntax_tags.get(style)
+                    if tag and length:
+                        ranges.setdefault(tag, []).extend((f"{number + 1}.{start}", f"{number + 1}.{start + length}"))
+                converged = self.highlight_dirty_end <= number < len(states) and states[number] == state
+                if number < len(states):
+                    states[number] = state
+                else:
+                    states.append(state)
+                number += 1
+                if converged:
+                    break
+            # 这一批的行先去掉所有语法标签，再每种标签一次 tag add 加上全部范围
+            for tag in self.syntax_tags.values():
+                self.text.tag_remove(tag, f"{line + 1}.0", f"{number + 1}.0")
+            for tag, indices in ranges.items():
+                self.text.tag_add(tag, *indices)
+            line = len(states) if converged else number
+        self.highlight_frontier = line
+        if line < line_count:
+            self.schedule_highlight()
+        else:
+            self.highlight_dirty_end = -1
+
     def on_text_modified(self, event: Optional[Any] = None) -> None:
+        if self.reader:
+            return
         if self.text.edit_modified():
-            if not self.file_state.is_modified:
-                self.file_state.is_modified = True
+            is_modified = self.piece_table.is_modified()
+            if is_modified != self.file_state.is_modified:
+                self.file_state.is_modified = is_modified
                 self.update_title()
+                self.update_statusbar()
             self.text.edit_modified(False)
     def update_title(self):
         title = "adorable_katze"
@@ -185,6 +1079,9 @@ class AdorableKatze:
         # run
         self.root.mainloop()
     def on_closing(self):
+        self.cancel_loading()
+        if self.saver:
+            self.finish_saving()
         if self.file_state.is_modified:
             save_changes = messagebox.askyesnocancel(
                 "Quit",
@@ -193,8 +1090,13 @@ class AdorableKatze:
             if save_changes is None:
                 return
             elif save_changes:
-                if not self.save():
+                if not self.save(wait=True):
                     return
+        # 已经保存或者选择了放弃修改，不再需要恢复
+        self.journal.discard()
+        if self.folder_scanner:
+            self.folder_scanner.stop()
+        self.stop_folder_search()
         self.root.destroy()
 if __name__ == "__main__":
     app = AdorableKatze()
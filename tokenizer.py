@@ -0,0 +1,153 @@
+"""与界面无关的分词核心：按 languages 注册表里的一种语言把一行切成带样式的片段
+
+Qt 的 QSyntaxHighlighter 和 Tk 的 Text 标签都只是它的适配层；不需要
+QApplication，可以直接测试和做基准。
+
+每行从左到右只扫描一遍：规则合并成 Language 编译好的组合正则，关键字
+不单独写正则，而是对匹配到的单词做一次集合查找。状态是这一行结束时还
+在第几条多行规则里（0 表示不在任何多行结构里），下一行从这个状态开始。
+
+同样的行（重复的代码、日志、数据文件，以及滚动、撤销、重新挂上高亮器
+时重排的行）在同样的入口状态下结果一定相同，所以按 (语言, 入口状态,
+行文本) 缓存在所有文档共用的 token_cache 里，命中时完全不用分词。
+"""
+import os
+from collections import OrderedDict
+
+import instrument
+
+# 按行缓存的分词结果最多保留的条数，环境变量 ADORABLE_KATZE_TOKEN_CACHE 可以调整（0 表示不缓存）
+TOKEN_CACHE_SIZE = 20000
+# 比这更长的行不缓存：很少重复，占的内存却多
+TOKEN_CACHE_MAX_LINE = 1000
+
+
+class TokenCache:
+    """(语言, 入口状态, 行文本) -> (片段元组, 行尾状态) 的 LRU 缓存
+
+    键里直接放行文本而不是它的哈希：字符串自己缓存着哈希值，查一次只多
+    一次相等比较，也不会因为哈希碰撞拿到别的行的结果。hits、misses 用来
+    按实际数据调整大小，由 instrument 的计数器导出。
+    """
+
+    def __init__(self, size=TOKEN_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if self.size <= 0:
+            return
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def cache_size_from_environment():
+    try:
+        return int(os.environ.get('ADORABLE_KATZE_TOKEN_CACHE', TOKEN_CACHE_SIZE))
+    except ValueError:
+        return TOKEN_CACHE_SIZE
+
+
+token_cache = TokenCache(cache_size_from_environment())
+instrument.register_counters('token_cache', token_cache.stats)
+
+
+class Tokenizer:
+    """一种语言的分词器；组合正则由 Language 编译一次，同一语言的分词器共用"""
+
+    def __init__(self, language, cache=token_cache):
+        language.compile()
+        self.cache = cache if cache is not None and cache.size > 0 else None
+        self.name = language.name
+        self.expression = language.expression
+        self.multiline_groups = language.multiline_groups
+        self.multiline_ends = language.multiline_ends
+        self.group_styles = language.group_styles
+        self.keywords = language.keywords
+        self.keyword_style = language.keyword_style
+
+    def tokenize(self, text, state=0):
+        """逐个产生 (开始, 长度, 样式名, 结束状态)，位置是 text 里的下标
+
+        结束状态是这个片段之后的状态。没有样式的单词不产生片段；多行结构
+        的片段总会产生（样式名可能是 None），所以一行的结束状态就是最后
+        一个片段的结束状态，一个片段都没有时是 0。
+        """
+        search = self.expression.search
+        keywords = self.keywords
+        position = 0
+        if state > 0:
+            position = yield from self.multiline(text, 0, 0, state)
+        while position is not None:
+            match = search(text, position)
+            if not match:
+                return
+            start, end = match.span()
+            position = end if end > start else end + 1
+            name = match.lastgroup
+            if name in self.multiline_groups:
+                position = yield from self.multiline(text, start, end, self.multiline_groups[name])
+                continue
+            style = self.keyword_style if match.group() in keywords else self.group_styles[name]
+            if style is not None:
+                yield start, end - start, style, 0
+
+    def multiline(self, text, start, search_from, state):
+        """从 start 开始的第 state 条多行结构，返回结束位置；本行没闭合时返回 None"""
+        end_expression, style = self.multiline_ends[state]
+        match = end_expression.search(text, search_from)
+        if match:
+            yield start, match.end() - start, style, 0
+            return match.end()
+        yield start, len(text) - start, style, state
+        return None
+
+    def tokens(self, text, state=0):
+        """一行的 (片段元组, 行尾状态)，先查缓存"""
+        cache = self.cache
+        if cache is None or len(text) > TOKEN_CACHE_MAX_LINE:
+            tokens = tuple(self.tokenize(text, state))
+            return tokens, tokens[-1][3] if tokens else 0
+        key = (self.name, state, text)
+        entry = cache.get(key)
+        if entry is None:
+            tokens = tuple(self.tokenize(text, state))
+            entry = tokens, tokens[-1][3] if tokens else 0
+            cache.put(key, entry)
+        return entry
+
+    def tokenize_lines(self, lines, state=0):
+        """对连续的几行逐行分词，产生 (片段元组, 行尾状态)"""
+        for text in lines:
+            tokens, state = self.tokens(text, state)
+            yield tokens, state
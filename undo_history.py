@@ -0,0 +1,201 @@
+"""与界面无关的撤销历史：紧凑的差量、按内存预算淘汰最老的步骤
+
+PieceTable 的每次编辑记成一个 Edit：位置、删掉的文本、插入的长度。插入
+的文本还在文档里，不用存；第一次撤销时才从文档里取出来存上，之后撤销、
+重做来回切换不用再取。大段的文本先压缩，再大的写进一个匿名临时文件，
+内存里只留它在文件里的位置。
+
+所有步骤（包括 Edit 本身的开销）按大小计入预算，超出时从最老的一步开
+始丢掉。撤销、重做只动栈顶的一步，耗时只和这一步改了多少有关，和历史
+有多长无关。
+"""
+import os
+import sys
+import tempfile
+import zlib
+from collections import deque
+
+# 撤销历史默认的内存预算（MB），环境变量 ADORABLE_KATZE_UNDO_BUDGET_MB 可以调整
+UNDO_BUDGET_MB = 64
+# 超过这么多字符的文本压缩后再存
+COMPRESS_SIZE = 64 * 1024
+# 超过这么多字符的文本写进临时文件，内存里只留位置
+SPILL_SIZE = 4 * 1024 * 1024
+# 每个 Edit 本身（对象、整数）大约占的字节数，也算进预算，很多小编辑一样会被淘汰
+EDIT_OVERHEAD = 200
+
+
+def budget_from_environment():
+    try:
+        return int(os.environ.get('ADORABLE_KATZE_UNDO_BUDGET_MB', UNDO_BUDGET_MB)) * 1024 * 1024
+    except ValueError:
+        return UNDO_BUDGET_MB * 1024 * 1024
+
+
+class Edit:
+    """一次替换：position 处的 removed_length 个字符换成了 added_length 个字符
+
+    removed、added 是两边文本存下来的样子（见 UndoHistory.store），还不
+    知道时是 None。
+    """
+
+    __slots__ = ('position', 'removed', 'removed_length', 'added', 'added_length')
+
+    def __init__(self, position, removed, removed_length, added_length):
+        self.position = position
+        self.removed = removed
+        self.removed_length = removed_length
+        self.added = None
+        self.added_length = added_length
+
+
+class Step:
+    """一步撤销：按顺序做的若干 Edit，before、after 是前后的版本号"""
+
+    __slots__ = ('edits', 'before', 'after', 'size')
+
+    def __init__(self, before):
+        self.edits = []
+        self.before = before
+        self.after = before
+        self.size = 0
+
+
+class UndoHistory:
+    """撤销栈和重做栈；栈顶在右边，撤销栈的左边是最老的一步"""
+
+    def __init__(self, budget=None):
+        self.budget = budget_from_environment() if budget is None else budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+        # 编辑事务打开时，之后的编辑都并进同一步
+        self.group_depth = 0
+        self.group = None
+        self.spill_file = None
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+    def store(self, text):
+        """返回 (存下来的样子, 占用的内存)"""
+        if len(text) < COMPRESS_SIZE:
+            return text, sys.getsizeof(text)
+        data = zlib.compress(text.encode('utf-8', 'surrogatepass'), 1)
+        if len(text) < SPILL_SIZE:
+            return data, len(data)
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='adorable-katze-undo-')
+        self.spill_file.seek(0, os.SEEK_END)
+        offset = self.spill_file.tell()
+        self.spill_file.write(data)
+        self.spilled += 1
+        return (offset, len(data)), 0
+
+    def load(self, stored):
+        if isinstance(stored, str):
+            return stored
+        if isinstance(stored, tuple):
+            offset, length = stored
+            self.spill_file.seek(offset)
+            stored = self.spill_file.read(length)
+        return zlib.decompress(stored).decode('utf-8', 'surrogatepass')
+
+    def release(self, stored):
+        if isinstance(stored, tuple):
+            self.spilled -= 1
+            if not self.spilled:
+                # 写进文件的都丢掉了，把文件清空
+                self.spill_file.truncate(0)
+
+    def begin_group(self):
+        self.group_depth += 1
+
+    def end_group(self):
+        self.group_depth -= 1
+        if not self.group_depth:
+            self.group = None
+
+    def record(self, position, removed_text, added_length, before, after):
+        """记下一次编辑；removed_text 是被删掉的文本"""
+        step = self.group
+        if step is None or not self.undo_stack or self.undo_stack[-1] is not step:
+            step = Step(before)
+            self.undo_stack.append(step)
+            if self.group_depth:
+                self.group = step
+        self.drop_redo()
+        removed, size = self.store(removed_text)
+        step.edits.append(Edit(position, removed, len(removed_text), added_length))
+        step.after = after
+        self.grow(step, size + EDIT_OVERHEAD)
+
+    def last_edit(self):
+        """撤销栈顶只有一次编辑、而且不在编辑事务里时返回它，用来合并连续输入
+
+        撤销过又重做的一步已经存下了插入的文本，不能再往里合并。
+        """
+        if self.group_depth or not self.undo_stack:
+            return None
+        step = self.undo_stack[-1]
+        if len(step.edits) != 1 or step.edits[0].added is not None:
+            return None
+        return step.edits[0]
+
+    def extend_last(self, added_length, after):
+        step = self.undo_stack[-1]
+        step.edits[0].added_length += added_length
+        step.after = after
+
+    def undo(self):
+        """撤销栈顶的一步移到重做栈，返回它；没有可撤销的返回 None"""
+        if not self.undo_stack:
+            return None
+        step = self.undo_stack.pop()
+        self.redo_stack.append(step)
+        self.group = None
+        return step
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        step = self.redo_stack.pop()
+        self.undo_stack.append(step)
+        self.group = None
+        return step
+
+    def store_added(self, step, edit, text):
+        """第一次撤销时存下当时插入的文本，重做时要用"""
+        edit.added, size = self.store(text)
+        self.grow(step, size)
+
+    def grow(self, step, size):
+        step.size += size
+        self.size += size
+        # 超出预算时从最老的一步开始丢，至少留下一步
+        while self.size > self.budget and len(self.undo_stack) + len(self.redo_stack) > 1:
+            if self.undo_stack:
+                self.drop(self.undo_stack.popleft())
+            else:
+                self.drop(self.redo_stack.pop(0))
+
+    def drop(self, step):
+        self.size -= step.size
+        if step is self.group:
+            self.group = None
+        for edit in step.edits:
+            self.release(edit.removed)
+            self.release(edit.added)
+
+    def drop_redo(self):
+        for step in self.redo_stack:
+            self.drop(step)
+        self.redo_stack.clear()
+
+    def clear(self):
+        for step in self.undo_stack:
+            self.drop(step)
+        self.undo_stack.clear()
+        self.drop_redo()
+        self.group = None
@@ -0,0 +1,191 @@
+"""与界面无关的标识符索引，给单词补全用
+
+WordIndex 记着每个标识符出现的次数（引用计数），另外留一份按字典序排好
+的单词列表：补全时二分找到前缀的位置，只往后看 limit 个，耗时只和 limit
+有关，和文档多大无关。文档改动时只比较改动前后那几整行里的单词，次数
+从 0 变成正数或者反过来时才在列表里插入、删除。
+
+次数可以暂时是负的：后台统计整篇文档的快照时，界面线程照样把之后的改动
+记进来，统计结果到了再加上去，和一开始就统计好的一样。整篇文档和文件夹
+里的其他文件都由 WordCounter 交给进程池统计（和在文件夹里查找、并行分词
+共用）。
+"""
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from find_in_files import SNIFF_SIZE, executor, walk
+from parallel_highlight import split_chunks
+
+# 比这短的单词不值得补全，也不记
+MIN_WORD_LENGTH = 3
+# 以字母或下划线开头的单词；分词器只产生有样式的片段，普通的标识符不在里面，所以单独扫一遍
+IDENTIFIER = re.compile(r'\b[^\W\d]\w{%d,}' % (MIN_WORD_LENGTH - 1))
+# 补全列表最多给出的单词数
+COMPLETION_LIMIT = 50
+# 一次改动前后的文本都比这短时直接在界面线程里增量更新，否则在后台重新统计整篇
+INLINE_SIZE = 256 * 1024
+# 文件夹里比这大的文件（多半是数据、日志）不统计
+FOLDER_FILE_SIZE = 2 * 1024 * 1024
+# 每个进程池任务统计的文件数
+FILES_PER_TASK = 32
+
+
+def count_words(text):
+    """进程池里也执行：text 里每个标识符出现的次数"""
+    return Counter(IDENTIFIER.findall(text))
+
+
+def count_files(files):
+    """进程池里执行：一组 (路径, 修改时间, 大小) 里的单词次数合在一起，跳过二进制文件"""
+    counts = Counter()
+    for path, _, size in files:
+        if size > FOLDER_FILE_SIZE:
+            continue
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            continue
+        if b'\0' in data[:SNIFF_SIZE]:
+            continue
+        counts.update(IDENTIFIER.findall(data.decode('utf-8', 'replace')))
+    return counts
+
+
+class WordIndex:
+    """单词 -> 出现次数，以及次数为正的单词的有序列表"""
+
+    def __init__(self):
+        self.counts = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def update(self, added, removed=None):
+        """added、removed 是 {单词: 次数}；改动很多时整个重新排序，比逐个插入快"""
+        counts = self.counts
+        changes = len(added) + (len(removed) if removed else 0)
+        if changes > max(1000, len(self.words) // 8):
+            for word, count in added.items():
+                counts[word] = counts.get(word, 0) + count
+            for word, count in (removed or {}).items():
+                counts[word] = counts.get(word, 0) - count
+            self.words = sorted(word for word, count in counts.items() if count > 0)
+            return
+        words = self.words
+        for word, count in added.items():
+            old = counts.get(word, 0)
+            new = counts[word] = old + count
+            if old <= 0 < new:
+                insort(words, word)
+            elif not new:
+                del counts[word]
+        for word, count in (removed or {}).items():
+            old = counts.get(word, 0)
+            new = counts[word] = old - count
+            if new <= 0 < old:
+                del words[bisect_left(words, word)]
+            if not new:
+                del counts[word]
+
+    def edit(self, old, new):
+        """old 这几整行换成了 new；只有两边次数不同的单词才会动"""
+        old_counts = count_words(old)
+        new_counts = count_words(new)
+        self.update(new_counts - old_counts, old_counts - new_counts)
+
+    def complete(self, prefix, limit=COMPLETION_LIMIT):
+        """以 prefix 开头的单词（不包括 prefix 自己），按字典序最多 limit 个"""
+        words = self.words
+        index = bisect_left(words, prefix)
+        result = []
+        while index < len(words) and len(result) < limit:
+            word = words[index]
+            if not word.startswith(prefix):
+                break
+            if word != prefix:
+                result.append(word)
+            index += 1
+        return result
+
+
+def complete(prefix, indexes, limit=COMPLETION_LIMIT):
+    """几个索引的补全合在一起，去掉重复，仍按字典序"""
+    words = set()
+    for index in indexes:
+        words.update(index.complete(prefix, limit))
+    return sorted(words)[:limit]
+
+
+class WordCounter(threading.Thread):
+    """后台统计单词次数：texts（文档快照的文本块）或者 folder 里的所有文件
+
+    结束时 counts 是合在一起的 Counter，done 被设上；出错时 error 记录异常，
+    取消之后 counts 是 None。
+    """
+
+    def __init__(self, texts=None, folder=None):
+        super().__init__(daemon=True)
+        self.texts = texts
+        self.folder = folder
+        self.counts = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            if self.folder is not None:
+                tasks = self.folder_tasks()
+            else:
+                tasks = ((count_words, text) for _, text in split_chunks(self.texts))
+            counts = self.count(tasks)
+            if not self.cancelled.is_set():
+                self.counts = counts
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def folder_tasks(self):
+        batch = []
+        for entry in walk(self.folder, self.cancelled):
+            batch.append(entry)
+            if len(batch) >= FILES_PER_TASK:
+                yield count_files, batch
+                batch = []
+        if batch:
+            yield count_files, batch
+
+    def count(self, tasks):
+        pool = executor()
+        # 同时在跑的任务数有上限，取消时不会留下一大堆排队的任务
+        limit = 2 * (os.cpu_count() or 1)
+        counts = Counter()
+        pending = set()
+        for function, argument in tasks:
+            if self.cancelled.is_set():
+                break
+            pending.add(pool.submit(function, argument))
+            while len(pending) >= limit and not self.cancelled.is_set():
+                pending = self.collect(pending, counts)
+        while pending and not self.cancelled.is_set():
+            pending = self.collect(pending, counts)
+        for future in pending:
+            future.cancel()
+        return counts
+
+    @staticmethod
+    def collect(pending, counts):
+        done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        for future in done:
+            counts.update(future.result())
+        return pending